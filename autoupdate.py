@@ -1,9 +1,18 @@
 import bindirpatch
+import blockmap
+import instrument
+import utils
 import shutil
 import sys
 import os
-from ftplib import FTP
-from utils import unzip_directory, find_application_version, Progress
+import time
+import heapq
+import threading
+import ftplib
+import stat as statmodule
+from ftplib import error_perm
+from blockmap import BlockMapException
+from utils import find_application_version, Progress
 
 """
     Ensures that the latest version of an application is installed.
@@ -13,10 +22,40 @@ from utils import unzip_directory, find_application_version, Progress
     because then the updater would think that v57 is the latest version.
     
     Update Server must have following directory structure:
-    www.example.com/some/path/latest        -> latest version of the application as 7z archive
+    www.example.com/some/path/latest        -> latest version of the application as a patch from an empty directory
     www.example.com/some/path/patches/v2    -> patch from v1 to v2
     www.example.com/some/path/patches/v3    -> patch from v2 to v3
     ...                                     -> there must be a patch for every version
+    www.example.com/some/path/patches/v1-3  -> optional patch that skips from v1 to v3
+    www.example.com/some/path/releases      -> release manifest: sizes and digests of all of the above
+    www.example.com/some/path/blockmap      -> block checksums of the files of the latest version
+    www.example.com/some/path/files/<sha1>  -> the files of the latest version by SHA-1 digest
+    www.example.com/some/path/manifests/v3  -> sizes and digests of the files of v3 (see bindirpatch.write_manifest)
+
+    The updater picks the combination of patches with the least bytes to download.
+    Patches are downloaded over several connections at once (see DownloadPipeline), and each
+    patch is installed as soon as it's downloaded, while the next ones are still downloading.
+    Partial downloads are kept in the temp directory and resumed by the next run.
+    It only needs the release manifest for that, which is cached and only downloaded again
+    if its modification time on the server changed. Servers without a release manifest
+    are queried for the list of patches and their sizes instead.
+
+    If the full version is needed but an older or damaged copy is installed, the files that are
+    still correct are reused and only the missing blocks of the others are downloaded from the
+    files directory (see the blockmap module), unless that would take more traffic than the
+    full archive.
+
+    New versions are built next to the application (in a shadow tree or in the temp dir) and swapped
+    in at the end, so an interrupted update leaves either the old or the new version behind
+    (see bindirpatch.stage_tree and bindirpatch.commit_tree).
+
+    With --verify, the installed files are checked against the manifest of the installed version
+    before updating, and the missing or corrupt ones are downloaded from the files directory.
+    The digests are cached by inode, size and mtime, so only files that changed since the last
+    check are read again (see find_corrupt_files).
+
+    With --report, the downloads are recorded along with the installation (see the instrument
+    module); the download phase is the time the installation had to wait for the downloads.
 """
 
 PROJECT_DIR = ''
@@ -26,6 +65,26 @@ UPDATE_SERVER_USER = 'anonymous'
 UPDATE_SERVER_PWD = 'anonymous'
 UPDATE_SERVER_PATH = '/'
 PATCH_NOTES = None
+# where the release manifest is cached between runs, default: <tempDir>_cache
+CACHE_DIR = None
+# apply all pending patches in one go instead of one after another
+CHAIN_APPLY = False
+# number of ftp connections used to download patches at the same time
+DOWNLOAD_CONNECTIONS = 3
+DOWNLOAD_BLOCK_SIZE = 256 * 1024
+# at most this many patches are downloaded ahead of the one being installed
+MAX_PENDING_DOWNLOADS = 4
+# bytes of patches in the temp dir that aren't installed yet, None for no limit
+TEMP_DISK_BUDGET = None
+# rebuild the full version from the installed files where possible, see download_seeded
+SEEDED_DOWNLOAD = True
+# check and repair the installed files before updating, see verify_application
+VERIFY_INSTALL = False
+# files whose mtime is closer than this to the time they're hashed aren't cached,
+# they could still change within the resolution of the mtime
+HASH_CACHE_MIN_AGE = 2
+# name of the digest cache of the installed files in the cache dir
+HASH_CACHE = 'hashes'
 
 class AutoUpdateException(Exception):
     def __init__(self, arg):
@@ -35,40 +94,55 @@ class ConnectionError(AutoUpdateException):
     def __init__(self, arg):
         self.args = arg
 
+class DownloadException(AutoUpdateException):
+    def __init__(self, errors):
+        self.errors = errors
+
+    def msg(self):
+        return 'Download failed:\n    ' + '\n    '.join(self.errors) + \
+            '\nPlease try again, finished downloads are kept.'
+
+class DownloadCancelled(Exception):
+    pass
+
 
 def update_application():
+    # finish an installation that was interrupted while swapping the directories
+    bindirpatch.recover_tree(PROJECT_DIR)
+    if VERIFY_INSTALL and find_current_version() is not None:
+        verify_application()
     ftp = ftp_connect()
 
     if PATCH_NOTES != None:
         download_patch_notes(ftp)
         show_patch_notes()
     
+    releases = download_release_manifest(ftp)
     currentVersion = find_current_version()
     if currentVersion == None:
         print 'Could not find current version'
-        download_full_game(ftp)
+        download_full_game(ftp, releases)
         return
     
-    (patches, numPatchBytes) = find_available_patches(ftp)
-    if len(patches) == 0:
+    (patches, numPatchBytes) = find_available_patches(ftp, releases)
+    if patches is not None and len(patches) == 0:
         print 'Already up to date.'
         return
 
-    fullGameBytes = find_full_game_size(ftp)
-    if numPatchBytes > fullGameBytes:
+    fullGameBytes = find_full_game_size(ftp, releases)
+    if patches is None or numPatchBytes > fullGameBytes:
         print 'Too far behind'
-        download_full_game(ftp)
+        download_full_game(ftp, releases)
         return
 
-    download_patches(ftp, patches, numPatchBytes)
     ftp.quit()
-
-    install_patches(patches)
+    install_patches(patches, numPatchBytes, releases)
         
 
-def ftp_connect():
-    print 'Connecting to Server'
-    ftp = FTP(UPDATE_SERVER_URL)
+def ftp_connect(silent=False):
+    if not silent:
+        print 'Connecting to Server'
+    ftp = utils.open_ftp(UPDATE_SERVER_URL)
     ftp.login(UPDATE_SERVER_USER, UPDATE_SERVER_PWD)
     ftp.cwd(UPDATE_SERVER_PATH)
     return ftp
@@ -78,84 +152,711 @@ def find_current_version():
     return find_application_version(PROJECT_DIR)
 
 
-def clear_temp_dir():
-    if os.path.exists(TEMP_DIR):
-        os.rename(TEMP_DIR, TEMP_DIR + '_deleteme')
-        shutil.rmtree(TEMP_DIR + '_deleteme')
-    os.makedirs(TEMP_DIR)
-
-
-def find_available_patches(ftp):
+def clear_temp_dir(keep=()):
+    """Removes everything from the temp dir, except the (partial) downloads named in <keep>."""
+    if not os.path.exists(TEMP_DIR):
+        os.makedirs(TEMP_DIR)
+        return
+    keep = set(keep) | set(name + '.part' for name in keep)
+    for name in os.listdir(TEMP_DIR):
+        if name in keep:
+            continue
+        path = os.path.join(TEMP_DIR, name)
+        if os.path.isdir(path):
+            os.rename(path, path + '_deleteme')
+            shutil.rmtree(path + '_deleteme')
+        else:
+            os.remove(path)
+
+
+def download_release_manifest(ftp):
+    """Returns the (latest, patches) tuple from the release manifest (see utils.write_release_manifest),
+        or None if the server has none."""
+    manifestPath = download_cached(ftp, utils.RELEASE_MANIFEST)
+    if manifestPath is None:
+        return None
+    return utils.read_release_manifest(manifestPath)
+
+
+def cache_dir():
+    return CACHE_DIR if CACHE_DIR is not None else TEMP_DIR + '_cache'
+
+def download_cached(ftp, remoteFileName):
+    """Downloads the file into the cache dir and returns its path, or None if the server has
+        no such file. The cached copy is used if the modification time on the server didn't
+        change, which takes a single round trip."""
+    cachePath = os.path.join(cache_dir(), remoteFileName)
+    try:
+        modified = ftp.sendcmd('MDTM ' + remoteFileName)
+    except error_perm:
+        # no such file, or the server doesn't support MDTM
+        modified = None
+
+    if modified is not None and os.path.isfile(cachePath) and os.path.isfile(cachePath + '.mdtm'):
+        with open(cachePath + '.mdtm', 'r') as f:
+            if f.read() == modified:
+                return cachePath
+
+    if not os.path.exists(os.path.dirname(cachePath)):
+        os.makedirs(os.path.dirname(cachePath))
+    try:
+        with open(cachePath, 'wb') as f:
+            ftp.retrbinary('RETR ' + remoteFileName, f.write)
+    except error_perm:
+        os.remove(cachePath)
+        return None
+    if modified is not None:
+        with open(cachePath + '.mdtm', 'w') as f:
+            f.write(modified)
+    elif os.path.exists(cachePath + '.mdtm'):
+        os.remove(cachePath + '.mdtm')
+    return cachePath
+
+
+def find_available_patches(ftp, releases=None):
+    """Returns the cheapest list of patches from the current to the latest version and
+        its size in bytes. The list is None if the latest version can't be reached with patches.
+        The patches are taken from the release manifest <releases> if there is one,
+        otherwise the server is asked for each of them."""
     print 'Checking for Updates...'
     currentVersion = find_current_version()
-    remoteBaseDir = ftp.pwd()
-    ftp.cwd('patches')
 
-    patches = ftp.nlst()
-    patches = sorted(patches)
-    patches = [x for x in patches if x[1:].isdigit() and int(x[1:]) > currentVersion]
-    
-    totalBytes = 0
-    for patch in patches:
-        ftp.voidcmd('TYPE I')
-        totalBytes += ftp.size(patch)
-
-    ftp.cwd(remoteBaseDir)
-    return (patches, totalBytes)
-
-
-def download_patches(ftp, patches, numPatchBytes):
+    edges = []
+    if releases is not None:
+        for (patch, size, digest) in releases[1]:
+            versions = parse_patch_name(patch)
+            if versions is not None and versions[0] >= currentVersion:
+                edges.append( (versions[0], versions[1], size, patch) )
+        latestVersion = max(currentVersion, releases[0][0])
+    else:
+        remoteBaseDir = ftp.pwd()
+        ftp.cwd('patches')
+        for patch in ftp.nlst():
+            versions = parse_patch_name(patch)
+            if versions is not None and versions[0] >= currentVersion:
+                ftp.voidcmd('TYPE I')
+                edges.append( (versions[0], versions[1], ftp.size(patch), patch) )
+        ftp.cwd(remoteBaseDir)
+        latestVersion = max([currentVersion] + [toVersion for (fromVersion, toVersion, size, patch) in edges])
+    return find_cheapest_path(edges, currentVersion, latestVersion)
+
+
+def parse_patch_name(patch):
+    """Returns the (fromVersion, toVersion) tuple for patches named v<to> or v<from>-<to>"""
+    parts = patch[1:].split('-')
+    if not patch.startswith('v') or len(parts) > 2 or not all(x.isdigit() for x in parts):
+        return None
+    if len(parts) == 1:
+        return (int(parts[0]) - 1, int(parts[0]))
+    return (int(parts[0]), int(parts[1]))
+
+
+def find_cheapest_path(edges, startVersion, goalVersion):
+    """Dijkstra's algorithm over the version graph. <edges> are (from, to, bytes, patch) tuples.
+        Returns (patches, totalBytes), or (None, None) if there is no path."""
+    outgoing = {}
+    for edge in edges:
+        outgoing.setdefault(edge[0], []).append(edge)
+
+    queue = [(0, startVersion, [])]
+    visited = set()
+    while len(queue) > 0:
+        (totalBytes, version, patches) = heapq.heappop(queue)
+        if version == goalVersion:
+            return (patches, totalBytes)
+        if version in visited:
+            continue
+        visited.add(version)
+        for (fromVersion, toVersion, size, patch) in outgoing.get(version, []):
+            if toVersion not in visited:
+                heapq.heappush(queue, (totalBytes + size, toVersion, patches + [patch]))
+    return (None, None)
+
+
+def install_patches(patches, numPatchBytes, releases=None):
+    """Downloads the patches and installs them in order. Each patch is installed as soon as it's
+        downloaded, and removed right after, while the next ones keep downloading.
+        If a download or an installation fails, the remaining downloads are cancelled.
+        The chain mode (CHAIN_APPLY) needs all patches at once, so they are all downloaded first.
+        Returns True if all patches were installed."""
     print 'Downloading ' + str(len(patches)) + ' Patches (' + str(numPatchBytes / 1000000) + ' MB)'
-    clear_temp_dir()
+    clear_temp_dir(patches)
     progress = Progress(numPatchBytes, 50)
     progress.print_header(10)
 
-    remoteBaseDir = ftp.pwd()
-    ftp.cwd('patches')
-    
+    known = {}
+    if releases is not None:
+        known = dict( (patch, (size, digest)) for (patch, size, digest) in releases[1] )
+    files = []
     for patch in patches:
-        download_file(ftp, patch, os.path.join(TEMP_DIR, patch), progress)
-
-    ftp.cwd(remoteBaseDir)
+        (size, digest) = known.get(patch, (None, None))
+        files.append( ('patches/' + patch, os.path.join(TEMP_DIR, patch), size, digest) )
 
-
-def install_patches(patches):
-    for patch in patches:
-        print 'Installing patch ' + patch
-        patchFilePath = os.path.join(TEMP_DIR, patch)
-        bindirpatch.apply_patch(patchFilePath, PROJECT_DIR)
+    chain = CHAIN_APPLY and len(patches) > 1
+    if chain:
+        pipeline = DownloadPipeline(files, progress)
+    else:
+        pipeline = DownloadPipeline(files, progress, MAX_PENDING_DOWNLOADS, TEMP_DISK_BUDGET)
+    pipeline.start()
+    try:
+        if chain:
+            with instrument.phase('download'):
+                for i in xrange(len(files)):
+                    pipeline.wait(i)
+            print 'Installing patches ' + ', '.join(patches)
+            if not bindirpatch.apply_patches([localPath for (remotePath, localPath, size, digest) in files], PROJECT_DIR):
+                print 'Run the update with --verify to repair the installed files.'
+                return False
+        else:
+            for (i, patch) in enumerate(patches):
+                with instrument.phase('download'):
+                    pipeline.wait(i)
+                print 'Installing patch ' + patch
+                if not bindirpatch.apply_patch(files[i][1], PROJECT_DIR):
+                    print 'Installation stopped, the remaining patches are not installed.'
+                    print 'Run the update with --verify to repair the installed files.'
+                    return False
+                os.remove(files[i][1])
+                pipeline.release(i)
+    except DownloadException as ex:
+        print ex.msg()
+        return False
+    finally:
+        pipeline.cancel()
+        pipeline.join()
     shutil.rmtree(TEMP_DIR)
+    return True
     
 
-def find_full_game_size(ftp):
+def find_full_game_size(ftp, releases=None):
+    if releases is not None:
+        return releases[0][1]
     ftp.voidcmd('TYPE I')
     return ftp.size('latest')
 
-def download_full_game(ftp):
-    fileSize = find_full_game_size(ftp)
+def download_full_game(ftp, releases=None):
+    fileSize = find_full_game_size(ftp, releases)
+    if SEEDED_DOWNLOAD and os.path.isdir(PROJECT_DIR):
+        with instrument.phase('compare'):
+            plan = plan_seeded_download(ftp, fileSize, releases)
+        if plan is not None:
+            download_seeded(ftp, plan)
+            return
     print 'Downloading full application (' + str(fileSize / 1000000) + ' MB)...'
-    clear_temp_dir()
+    clear_temp_dir(['latest'])
     progress = Progress(fileSize, 50)
     progress.print_header(10)
     filename = os.path.join(TEMP_DIR, 'latest')
-    download_file(ftp, 'latest', filename, progress)
+    try:
+        with instrument.phase('download'):
+            download_files([ ('latest', filename, fileSize, releases[0][2] if releases is not None else None) ], progress)
+    except DownloadException as ex:
+        print ex.msg()
+        return
     print 'Extracting files...'
-    unzip_directory(filename, TEMP_DIR)
-    if os.path.exists(PROJECT_DIR):
-        print 'Deleting old files...'
-        shutil.rmtree(PROJECT_DIR)
-    print 'Copying new files...'
-    os.rename(os.path.join(TEMP_DIR, 'bin'), PROJECT_DIR)
+    binDir = os.path.join(TEMP_DIR, 'bin')
+    os.makedirs(binDir)
+    if not bindirpatch.apply_patch(filename, binDir):
+        print 'Could not extract the full application.'
+        return
+    install_release(binDir)
+
+def install_release(binDir):
+    """Replaces the application with the new version in <binDir>. The old version is removed
+        only after the new one is in place, see bindirpatch.commit_tree."""
+    print 'Installing new files...'
+    try:
+        with instrument.phase('apply'):
+            bindirpatch.commit_tree(PROJECT_DIR, binDir)
+    except OSError as ex:
+        print 'Could not replace the old files: ' + str(ex)
+        return
     shutil.rmtree(TEMP_DIR)
     print 'Done.'
 
 
-def download_file(ftp, remoteFileName, outFileName, progress):
-    with open(outFileName, 'wb') as outFile:
+def plan_seeded_download(ftp, fullGameBytes, releases=None):
+    """Finds out which parts of the latest version are already in PROJECT_DIR, using the block map
+        published by deploy. Installed files with the right content are reused as they are, the
+        others are scanned for the blocks of the file at the same path.
+        Returns a list of (entry, localPath, segments) tuples, see download_seeded, or None if
+        there is no block map or if the missing parts are bigger than the full archive."""
+    blockMapPath = download_cached(ftp, utils.BLOCK_MAP)
+    if blockMapPath is None:
+        return None
+    try:
+        (version, entries) = blockmap.read_block_map(blockMapPath)
+    except BlockMapException as ex:
+        print ex.msg()
+        return None
+    if releases is not None and version != releases[0][0]:
+        return None
+
+    print 'Checking installed files...'
+    localFiles = hash_local_files(set(entry.size for entry in entries))
+    plan = []
+    numMissingBytes = 0
+    for entry in entries:
+        if entry.digest in localFiles:
+            plan.append( (entry, localFiles[entry.digest], None) )
+            continue
+        seedPath = os.path.join(PROJECT_DIR, entry.path)
+        segments = None
+        if entry.size == 0:
+            # nothing to download, download_seeded creates it without a seed
+            segments = []
+        elif os.path.isfile(seedPath):
+            segments = blockmap.plan_file(entry, blockmap.match_blocks(seedPath, entry))
+            if blockmap.missing_bytes(segments) == entry.size:
+                segments = None
+        plan.append( (entry, None, segments) )
+        numMissingBytes += entry.size if segments is None else blockmap.missing_bytes(segments)
+    if numMissingBytes >= fullGameBytes:
+        return None
+    return plan
+
+def hash_local_files(sizes):
+    """Returns a dict that maps the SHA-1 digests of the files in PROJECT_DIR to their relative paths.
+        Only files with one of the <sizes> are read."""
+    work = []
+    for (relPath, oldStat, newStat) in bindirpatch.walk_trees(None, PROJECT_DIR):
+        if newStat[0] in sizes:
+            work.append( (relPath, os.path.join(PROJECT_DIR, relPath), None) )
+    pool = bindirpatch.create_pool(bindirpatch.NUM_WORKERS)
+    try:
+        entries = bindirpatch.parallel_map(pool, bindirpatch.visit_added_file, work)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return dict( (entry.payload, entry.path) for entry in entries )
+
+def download_seeded(ftp, plan):
+    """Builds the latest version in the temp dir from the plan of plan_seeded_download and installs it.
+        Files with a <localPath> are taken from PROJECT_DIR, as hardlinks if the path is the same.
+        Files with <segments> (see blockmap.plan_file) are put together from the blocks of the
+        installed file and the missing ranges, which are downloaded from the files directory on the server.
+        All other files, and files that don't have the right digest in the end, are downloaded
+        completely."""
+    numMissingBytes = sum(entry.size if segments is None else blockmap.missing_bytes(segments)
+                          for (entry, localPath, segments) in plan if localPath is None)
+    print 'Downloading changed files (' + str(numMissingBytes / 1000000) + ' MB)...'
+    clear_temp_dir()
+    binDir = os.path.join(TEMP_DIR, 'bin')
+    progress = Progress(numMissingBytes, 50)
+    progress.print_header(10)
+
+    downloads = []
+    for (entry, localPath, segments) in plan:
+        dstPath = os.path.join(binDir, entry.path)
+        bindirpatch.mkdir_if_not_exists(os.path.dirname(dstPath))
+        remotePath = utils.FILE_STORE + '/' + entry.digest
+        if entry.size == 0:
+            open(dstPath, 'wb').close()
+            continue
+        if localPath is not None:
+            # a file that's reused for other paths too must not end up with several names
+            if localPath == entry.path:
+                bindirpatch.link_file(os.path.join(PROJECT_DIR, localPath), dstPath)
+            else:
+                shutil.copyfile(os.path.join(PROJECT_DIR, localPath), dstPath)
+            continue
+        if segments is not None:
+            try:
+                start = time.time()
+                build_seeded_file(ftp, remotePath, os.path.join(PROJECT_DIR, entry.path), segments, dstPath, progress)
+                if verify_file(dstPath, entry.size, entry.digest):
+                    missing = blockmap.missing_bytes(segments)
+                    instrument.record_file('download', entry.path, time.time() - start, missing, entry.size,
+                                           instrument.ratio(missing, entry.size))
+                    continue
+            except DownloadException as ex:
+                print ex.msg()
+            except (EnvironmentError, EOFError) + ftplib.all_errors as ex:
+                print remotePath + ': ' + str(ex)
+            if os.path.exists(dstPath):
+                os.remove(dstPath)
+        downloads.append( (remotePath, dstPath, entry.size, entry.digest) )
+
+    try:
+        with instrument.phase('download'):
+            download_files(downloads, progress)
+    except DownloadException as ex:
+        print ex.msg()
+        return
+    install_release(binDir)
+
+def build_seeded_file(ftp, remotePath, seedPath, segments, dstPath, progress):
+    """Writes the (offset, length, seedOffset) segments to <dstPath>, copying them from <seedPath>
+        or downloading them from <remotePath>."""
+    with open(seedPath, 'rb') as seedFile:
+        with open(dstPath, 'wb') as outFile:
+            for (offset, length, seedOffset) in segments:
+                if seedOffset is None:
+                    download_range(ftp, remotePath, offset, length, outFile, progress)
+                    continue
+                seedFile.seek(seedOffset)
+                while length > 0:
+                    block = seedFile.read(min(length, DOWNLOAD_BLOCK_SIZE))
+                    if not block:
+                        raise DownloadException([seedPath + ' changed while it was read'])
+                    outFile.write(block)
+                    length -= len(block)
+
+def download_range(ftp, remoteFileName, offset, length, outFile, progress):
+    """Downloads <length> bytes of the file, starting at <offset>. Ftp has no ranges, so the
+        transfer is started at the offset and the connection closed once there's enough."""
+    ftp.voidcmd('TYPE I')
+    connection = ftp.transfercmd('RETR ' + remoteFileName, offset if offset > 0 else None)
+    remaining = length
+    try:
+        while remaining > 0:
+            block = connection.recv(min(remaining, DOWNLOAD_BLOCK_SIZE))
+            if not block:
+                break
+            outFile.write(block)
+            progress.add_progress(len(block))
+            remaining -= len(block)
+    finally:
+        connection.close()
+    try:
+        ftp.voidresp()
+    except (ftplib.error_temp, ftplib.error_reply):
+        # the server reports the closed connection as an aborted transfer
+        pass
+    if remaining > 0:
+        raise DownloadException([remoteFileName + ': the file on the server is too short'])
+
+
+def verify_application():
+    """Checks the installed files against the manifest of the installed version and downloads
+        the missing and corrupt ones from the files directory on the server.
+        Files that aren't in the manifest are left alone. Returns True if all files are intact
+        in the end."""
+    version = find_current_version()
+    if version is None:
+        print 'Could not find current version, nothing to verify'
+        return False
+    ftp = ftp_connect()
+    try:
+        expected = download_version_manifest(ftp, version)
+    finally:
+        ftp.quit()
+    if expected is None:
+        print 'The server has no manifest of version ' + str(version) + ', cannot verify the installation.'
+        return False
+
+    print 'Verifying ' + str(len(expected)) + ' files...'
+    cachePath = os.path.join(cache_dir(), HASH_CACHE)
+    cache = read_hash_cache(cachePath)
+    with instrument.phase('validate'):
+        corrupt = find_corrupt_files(expected, cache)
+    success = True
+    if len(corrupt) == 0:
+        print 'All files are intact.'
+    else:
+        print str(len(corrupt)) + ' files are missing or corrupt:'
+        for relPath in corrupt:
+            print '    ' + relPath
+        success = repair_files(corrupt, expected, cache)
+    write_hash_cache(cachePath, cache)
+    return success
+
+def download_version_manifest(ftp, version):
+    """Returns a dict that maps the paths of the files of <version> to their (size, digest) tuples,
+        or None if the server doesn't know them. Servers without manifests have at least the
+        block map of the latest version."""
+    manifestPath = download_cached(ftp, utils.VERSION_MANIFESTS + '/v' + str(version))
+    if manifestPath is not None:
+        return dict( (relPath, (stat[0], fileHash[1])) for (relPath, (stat, fileHash))
+                     in bindirpatch.read_manifest(manifestPath).items() )
+    blockMapPath = download_cached(ftp, utils.BLOCK_MAP)
+    if blockMapPath is None:
+        return None
+    try:
+        (mapVersion, entries) = blockmap.read_block_map(blockMapPath)
+    except BlockMapException as ex:
+        print ex.msg()
+        return None
+    if mapVersion != version:
+        return None
+    return dict( (entry.path, (entry.size, entry.digest)) for entry in entries )
+
+def find_corrupt_files(expected, cache):
+    """Returns the sorted paths of the files that don't match their expected (size, digest).
+        Files with the wrong size aren't read. The digests of the others are taken from <cache>
+        if their (inode, size, mtime) didn't change, otherwise they're hashed in parallel and
+        added to <cache>."""
+    corrupt = []
+    digests = {}
+    keys = {}
+    work = []
+    for (relPath, (size, digest)) in sorted(expected.items()):
+        path = os.path.join(PROJECT_DIR, relPath)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            corrupt.append(relPath)
+            continue
+        if not statmodule.S_ISREG(stat.st_mode) or stat.st_size != size:
+            corrupt.append(relPath)
+            continue
+        keys[relPath] = (stat.st_ino, stat.st_size, stat.st_mtime)
+        if relPath in cache and cache[relPath][0] == keys[relPath]:
+            digests[relPath] = cache[relPath][1]
+        else:
+            work.append( (relPath, path, None) )
+
+    if len(work) > 0:
+        print 'Hashing ' + str(len(work)) + ' files...'
+        pool = bindirpatch.create_pool(bindirpatch.NUM_WORKERS)
+        try:
+            entries = bindirpatch.parallel_map(pool, bindirpatch.visit_added_file, work)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        now = time.time()
+        for entry in entries:
+            digests[entry.path] = entry.payload
+            if now - keys[entry.path][2] >= HASH_CACHE_MIN_AGE:
+                cache[entry.path] = (keys[entry.path], entry.payload)
+
+    corrupt.extend(relPath for (relPath, digest) in digests.items() if digest != expected[relPath][1])
+    return sorted(corrupt)
+
+def repair_files(corrupt, expected, cache):
+    """Downloads the files with the paths <corrupt> from the files directory and puts them in
+        place. Partial downloads are kept for the next run. Returns True on success."""
+    clear_temp_dir(['repair'])
+    repairDir = os.path.join(TEMP_DIR, 'repair')
+    files = []
+    for relPath in corrupt:
+        (size, digest) = expected[relPath]
+        localPath = os.path.join(repairDir, relPath)
+        bindirpatch.mkdir_if_not_exists(os.path.dirname(localPath))
+        files.append( (utils.FILE_STORE + '/' + digest, localPath, size, digest) )
+    numBytes = sum(size for (remotePath, localPath, size, digest) in files)
+    print 'Downloading ' + str(len(files)) + ' files (' + str(numBytes / 1000000) + ' MB)...'
+    progress = Progress(max(numBytes, 1), 50)
+    progress.print_header(10)
+    try:
+        with instrument.phase('download'):
+            download_files(files, progress)
+    except DownloadException as ex:
+        print ex.msg()
+        return False
+
+    for (relPath, (remotePath, localPath, size, digest)) in zip(corrupt, files):
+        dstPath = os.path.join(PROJECT_DIR, relPath)
+        if os.path.isdir(dstPath):
+            shutil.rmtree(dstPath)
+        elif os.path.exists(dstPath):
+            os.remove(dstPath)
+        bindirpatch.mkdir_if_not_exists(os.path.dirname(dstPath))
+        os.rename(localPath, dstPath)
+        stat = os.stat(dstPath)
+        cache[relPath] = ((stat.st_ino, stat.st_size, stat.st_mtime), digest)
+    shutil.rmtree(TEMP_DIR)
+    print 'Repaired ' + str(len(corrupt)) + ' files.'
+    return True
+
+def read_hash_cache(cachePath):
+    """Reads the cache written by write_hash_cache. Returns a dict that maps each path to an
+        ((inode, size, mtime), digest) tuple."""
+    cache = {}
+    if not os.path.isfile(cachePath):
+        return cache
+    with open(cachePath, 'r') as f:
+        for line in f:
+            parts = line.rstrip('\n').split(' ', 4)
+            if len(parts) == 5:
+                cache[parts[4]] = ((int(parts[0]), int(parts[1]), float(parts[2])), parts[3])
+    return cache
+
+def write_hash_cache(cachePath, cache):
+    """Each line has the form '<inode> <size> <mtime> <digest> <path>'"""
+    bindirpatch.mkdir_if_not_exists(os.path.dirname(cachePath))
+    with open(cachePath + '.tmp', 'w') as f:
+        for (relPath, ((inode, size, mtime), digest)) in sorted(cache.items()):
+            f.write(str(inode) + ' ' + str(size) + ' ' + repr(mtime) + ' ' + digest + ' ' + relPath + '\n')
+    if os.path.exists(cachePath):
+        os.remove(cachePath)
+    os.rename(cachePath + '.tmp', cachePath)
+
+
+def download_files(files, progress):
+    """Downloads the (remotePath, localPath, size, digest) tuples, see DownloadPipeline.
+        Raises a DownloadException if any of the files couldn't be downloaded."""
+    pipeline = DownloadPipeline(files, progress)
+    pipeline.start()
+    errors = []
+    try:
+        for i in xrange(len(files)):
+            try:
+                pipeline.wait(i)
+            except DownloadException as ex:
+                errors.extend(ex.errors)
+    finally:
+        pipeline.cancel()
+        pipeline.join()
+    if len(errors) > 0:
+        raise DownloadException(errors)
+
+
+class DownloadPipeline:
+    """Downloads the (remotePath, localPath, size, digest) tuples in order over up to
+        DOWNLOAD_CONNECTIONS connections at once, each connection takes the next file when
+        it's done with one. <size> and <digest> (SHA-1) are the expected values, or None if unknown.
+        The consumer waits for each file in turn and releases it when it's done with it. At most
+        <maxPending> files, and at most <diskBudget> bytes, are downloading or downloaded but not
+        released at any time; a single file that is bigger than the budget is still downloaded
+        once all others are released. Files of unknown size don't count towards the budget."""
+    def __init__(self, files, progress, maxPending=None, diskBudget=None):
+        self.files = files
+        self.progress = progress
+        self.maxPending = maxPending if maxPending is not None else len(files)
+        self.diskBudget = diskBudget
+        self.condition = threading.Condition()
+        # index of the next file to download, number of released files and their bytes on disk
+        self.next = 0
+        self.released = 0
+        self.reserved = 0
+        # True for downloaded files, a list of error messages for failed ones
+        self.results = [None] * len(files)
+        self.cancelled = False
+        self.threads = []
+
+    def start(self):
+        self.threads = [threading.Thread(target=self._download_worker) for i in xrange(min(DOWNLOAD_CONNECTIONS, len(self.files)))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def wait(self, i):
+        """Blocks until file <i> is downloaded. Raises a DownloadException if it failed."""
+        with self.condition:
+            while self.results[i] is None:
+                if not any(thread.is_alive() for thread in self.threads):
+                    raise DownloadException([self.files[i][0] + ': download was stopped'])
+                # with a timeout, so that Ctrl+C still works
+                self.condition.wait(0.5)
+            if self.results[i] is not True:
+                raise DownloadException(self.results[i])
+
+    def release(self, i):
+        """The consumer is done with file <i> and removed it, so the next ones may be downloaded."""
+        with self.condition:
+            self.released += 1
+            self.reserved -= self.files[i][2] or 0
+            self.condition.notify_all()
+
+    def cancel(self):
+        """Stops all downloads, partial files are kept for the next run."""
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def _may_start_next(self):
+        if self.next - self.released >= self.maxPending:
+            return False
+        size = self.files[self.next][2] or 0
+        return self.diskBudget is None or self.reserved == 0 or self.reserved + size <= self.diskBudget
+
+    def _download_worker(self):
+        ftp = None
+        try:
+            while True:
+                with self.condition:
+                    while not self.cancelled and self.next < len(self.files) and not self._may_start_next():
+                        self.condition.wait()
+                    if self.cancelled or self.next >= len(self.files):
+                        return
+                    i = self.next
+                    self.next += 1
+                    self.reserved += self.files[i][2] or 0
+
+                (remotePath, localPath, size, digest) = self.files[i]
+                try:
+                    if ftp is None:
+                        ftp = ftp_connect(silent=True)
+                    download_verified(ftp, remotePath, localPath, size, digest, self.progress, self.is_cancelled)
+                    result = True
+                except DownloadCancelled:
+                    # the transfer was aborted halfway, so don't wait for a reply
+                    ftp.close()
+                    ftp = None
+                    return
+                except DownloadException as ex:
+                    result = ex.errors
+                except (EnvironmentError, EOFError) + ftplib.all_errors as ex:
+                    result = [remotePath + ': ' + str(ex)]
+                    # the connection may be broken, use a new one for the next file
+                    if ftp is not None:
+                        ftp.close()
+                        ftp = None
+                with self.condition:
+                    self.results[i] = result
+                    self.condition.notify_all()
+        finally:
+            if ftp is not None:
+                try:
+                    ftp.quit()
+                except ftplib.all_errors:
+                    ftp.close()
+
+def download_verified(ftp, remotePath, localPath, size, digest, progress, is_cancelled=None):
+    """Downloads a file to <localPath>, going through <localPath>.part. A partial download
+        from an earlier run is resumed. The file is only renamed to <localPath> once its size
+        and digest are verified. If it's corrupt, it's downloaded once more from the start."""
+    if size is None:
+        ftp.voidcmd('TYPE I')
+        size = ftp.size(remotePath)
+    if os.path.isfile(localPath) and verify_file(localPath, size, digest):
+        progress.add_progress(size)
+        return
+
+    partPath = localPath + '.part'
+    offset = os.path.getsize(partPath) if os.path.isfile(partPath) else 0
+    if offset > size:
+        offset = 0
+    for attempt in xrange(2):
+        progress.add_progress(offset)
+        start = time.time()
+        download_file(ftp, remotePath, partPath, progress, offset, is_cancelled)
+        if verify_file(partPath, size, digest):
+            if os.path.exists(localPath):
+                os.remove(localPath)
+            os.rename(partPath, localPath)
+            instrument.record_file('download', remotePath, time.time() - start, size - offset, size - offset)
+            return
+        os.remove(partPath)
+        offset = 0
+    raise DownloadException([remotePath + ' does not have the expected size or digest'])
+
+def verify_file(path, size, digest):
+    if os.path.getsize(path) != size:
+        return False
+    return digest is None or bindirpatch.hash_file(path)[1] == digest
+
+def download_file(ftp, remoteFileName, outFileName, progress, offset=0, is_cancelled=None):
+    """Downloads the file, or the rest of it starting at <offset>.
+        Raises DownloadCancelled as soon as <is_cancelled> returns True."""
+    with open(outFileName, 'ab' if offset > 0 else 'wb') as outFile:
+        outFile.truncate(offset)
         def write_downloaded_block(block):
+            if is_cancelled is not None and is_cancelled():
+                raise DownloadCancelled()
             outFile.write(block)
             progress.add_progress(len(block))
-        ftp.retrbinary('RETR ' + remoteFileName, write_downloaded_block, 102400)
+        ftp.retrbinary('RETR ' + remoteFileName, write_downloaded_block, DOWNLOAD_BLOCK_SIZE, offset if offset > 0 else None)
 
 
 def download_patch_notes(ftp):
@@ -168,7 +869,8 @@ def show_patch_notes():
     
 
 def parseExtraArgs(i):
-    global UPDATE_SERVER_USER, UPDATE_SERVER_PWD, UPDATE_SERVER_PATH, PATCH_NOTES
+    global UPDATE_SERVER_USER, UPDATE_SERVER_PWD, UPDATE_SERVER_PATH, PATCH_NOTES, CHAIN_APPLY, CACHE_DIR
+    global DOWNLOAD_CONNECTIONS, TEMP_DISK_BUDGET, SEEDED_DOWNLOAD, VERIFY_INSTALL
     if len(sys.argv) <= i:
         return
     arg = sys.argv[i]
@@ -182,6 +884,26 @@ def parseExtraArgs(i):
             UPDATE_SERVER_PATH = '/' + UPDATE_SERVER_PATH
     elif arg.startswith('--patchnotes='):
         PATCH_NOTES = arg.split('=', 1)[1]
+    elif arg.startswith('--backend='):
+        utils.set_diff_backend(arg.split('=', 1)[1])
+    elif arg.startswith('-j'):
+        bindirpatch.NUM_WORKERS = int(arg[2:])
+    elif arg == '--chain':
+        CHAIN_APPLY = True
+    elif arg.startswith('--cache='):
+        CACHE_DIR = arg.split('=', 1)[1]
+    elif arg.startswith('--connections='):
+        DOWNLOAD_CONNECTIONS = max(1, int(arg.split('=', 1)[1]))
+    elif arg.startswith('--disk-budget='):
+        TEMP_DISK_BUDGET = int(arg.split('=', 1)[1]) * 1000000
+    elif arg == '--no-seed':
+        SEEDED_DOWNLOAD = False
+    elif arg == '--verify':
+        VERIFY_INSTALL = True
+    elif arg.startswith('--report='):
+        instrument.set_report(arg.split('=', 1)[1])
+    elif arg.startswith('--profile='):
+        instrument.set_profile(arg.split('=', 1)[1])
     else:
         print 'Invalid argument: ' + sys.argv[i]
         usage()
@@ -194,6 +916,16 @@ def usage():
     print 'Options:'
     print ' -aU:P   Authentication, (Username:Password), ex: -auser101:abc123'
     print ' -pPath  Set base path on the remove server.'
+    print ' --backend=exe|python  Patch engine: bspatch.exe or the built-in one'
+    print ' -j#     Jobs, sets number of worker processes for installing patches, ex: -j4'
+    print ' --chain Install all pending patches in one go, writing every file only once'
+    print ' --cache=dir  Where to keep the release manifest between runs, default: <tempDir>_cache'
+    print ' --connections=#  Number of patches downloaded at the same time, default: 3'
+    print ' --disk-budget=#  MB of downloaded patches that may wait for installation in tempDir'
+    print ' --no-seed  Always download the full archive instead of reusing installed files'
+    print ' --verify  Check the installed files first and download the missing or corrupt ones'
+    print ' --report=file  Write the time and bytes of every download and installed file to a JSON (or .csv) report'
+    print ' --profile=file  Write cProfile statistics of the main process to this file'
     sys.exit(0)
 
 if __name__ == '__main__':
@@ -212,4 +944,4 @@ if __name__ == '__main__':
     #print 'Password: ', UPDATE_SERVER_PWD
     #print 'Base Path: ', UPDATE_SERVER_PATH
     
-    update_application()
+    instrument.run(update_application)
@@ -0,0 +1,444 @@
+import os
+import sys
+import shutil
+import time
+import math
+import json
+import random
+import multiprocessing
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import bindirpatch
+import deploy
+import autoupdate
+import localftp
+import utils
+from utils import find_application_version
+
+"""
+    Benchmark of bindirpatch, deploy and autoupdate on synthetic releases.
+
+    Two releases are generated from a seed, so every run with the same settings works on the same
+    data: the old release has FILE_COUNT files in DIRECTORY_COUNT directories with log-normally
+    distributed sizes around MEAN_FILE_SIZE, plus LARGE_FILE_COUNT big binaries. Part of each file
+    is random bytes, the rest is text that compresses to about half (COMPRESSIBLE). The new
+    release modifies, deletes, renames and adds files at the given rates; modified files get a
+    few replaced, inserted or deleted ranges, the big binaries are always modified.
+
+    Then the steps are timed: create_patch and apply_patch of bindirpatch, a deploy to a
+    localftp server on localhost and an update of a client that has the old release.
+    Each step runs in its own process, so its peak RSS (including the worker processes it
+    starts) can be measured; that needs the resource module, so it's not measured on Windows.
+    With REPEAT, every step is run several times and the fastest run counts.
+
+    The results (time, throughput on the new release, peak RSS and the patch size) can be
+    stored as baseline. When a baseline is given, every value that is worse than the baseline by
+    more than TOLERANCE is reported as regression and the exit code is 1. The built-in diff engine
+    is slow on big files, so the defaults are kept small enough for a run of a few minutes.
+"""
+
+WORK_DIR = None
+SEED = 1
+FILE_COUNT = 200
+DIRECTORY_COUNT = 20
+MEAN_FILE_SIZE = 32 * 1024
+LARGE_FILE_COUNT = 1
+LARGE_FILE_SIZE = 8 * 1024 * 1024
+# rates are the fractions of the files of the old release
+CHANGE_RATE = 0.1
+DELETE_RATE = 0.02
+RENAME_RATE = 0.02
+ADD_RATE = 0.02
+# fraction of the content that is text instead of random bytes
+COMPRESSIBLE = 0.5
+REPEAT = 1
+STEPS = ['diff', 'patch', 'deploy', 'update']
+BASELINE = None
+SAVE_BASELINE = None
+TOLERANCE = 0.1
+VERBOSE = False
+# data is generated in blocks of this size, each block is either random or text
+BLOCK_SIZE = 64 * 1024
+
+
+def benchmark():
+    """Generates the releases, runs the steps and compares with the baseline.
+        Returns False if a step failed or there is a regression."""
+    if os.path.exists(WORK_DIR):
+        shutil.rmtree(WORK_DIR)
+    oldDir = os.path.join(WORK_DIR, 'old')
+    newDir = os.path.join(WORK_DIR, 'new')
+    print 'Generating releases...'
+    rnd = random.Random(SEED)
+    generate_release(oldDir, rnd)
+    mutate_release(oldDir, newDir, rnd)
+    newBytes = tree_size(newDir)
+    print 'Old release: ' + describe_tree(oldDir)
+    print 'New release: ' + describe_tree(newDir)
+
+    results = {'settings': settings(), 'steps': {}}
+    for i in xrange(REPEAT):
+        for (name, seconds, peakRss, patchSize) in run_steps(oldDir, newDir):
+            if seconds is None:
+                print 'Step ' + name + ' failed'
+                return False
+            best = results['steps'].get(name)
+            if best is None or seconds < best['seconds']:
+                results['steps'][name] = {'seconds': seconds, 'throughput': newBytes / seconds / 1000000.0,
+                                          'peakRss': peakRss}
+            if patchSize is not None:
+                results['patchSize'] = patchSize
+    print_results(results)
+
+    success = True
+    if BASELINE is not None:
+        with open(BASELINE, 'r') as f:
+            success = compare_results(json.load(f), results)
+    if SAVE_BASELINE is not None:
+        with open(SAVE_BASELINE, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print 'Baseline written to ' + SAVE_BASELINE
+    return success
+
+def settings():
+    """The settings that change the results, a baseline is only comparable if they match"""
+    return {'seed': SEED, 'files': FILE_COUNT, 'directories': DIRECTORY_COUNT, 'meanSize': MEAN_FILE_SIZE,
+            'largeFiles': LARGE_FILE_COUNT, 'largeSize': LARGE_FILE_SIZE, 'changeRate': CHANGE_RATE,
+            'deleteRate': DELETE_RATE, 'renameRate': RENAME_RATE, 'addRate': ADD_RATE,
+            'compressible': COMPRESSIBLE, 'workers': bindirpatch.NUM_WORKERS, 'backend': utils.DIFF_BACKEND}
+
+
+def generate_release(releaseDir, rnd):
+    """Writes a release with version 1 to <releaseDir>"""
+    os.makedirs(releaseDir)
+    with open(os.path.join(releaseDir, 'VERSION'), 'w') as f:
+        f.write('1')
+    for i in xrange(FILE_COUNT):
+        write_file(os.path.join(releaseDir, file_name(rnd, i)), rnd, file_size(rnd))
+    for i in xrange(LARGE_FILE_COUNT):
+        write_file(os.path.join(releaseDir, 'data', 'large' + str(i) + '.pak'), rnd, LARGE_FILE_SIZE)
+
+def mutate_release(oldDir, newDir, rnd):
+    """Writes a copy of the release at <oldDir> to <newDir> with modified, deleted, renamed and
+        added files"""
+    shutil.copytree(oldDir, newDir)
+    paths = sorted(path for (path, size) in list_files(newDir) if path != 'VERSION')
+    large = [path for path in paths if path.startswith('data' + os.sep)]
+    small = [path for path in paths if path not in large]
+    rnd.shuffle(small)
+    counts = [int(round(len(small) * rate)) for rate in (CHANGE_RATE, DELETE_RATE, RENAME_RATE)]
+    modified = small[0:counts[0]] + large
+    deleted = small[counts[0]:counts[0] + counts[1]]
+    renamed = small[counts[0] + counts[1]:sum(counts)]
+
+    for path in modified:
+        filePath = os.path.join(newDir, path)
+        mutate_file(filePath, filePath + '.tmp', rnd)
+        os.remove(filePath)
+        os.rename(filePath + '.tmp', filePath)
+    for path in deleted:
+        os.remove(os.path.join(newDir, path))
+    for (i, path) in enumerate(renamed):
+        dstPath = os.path.join(newDir, 'moved' + str(rnd.randrange(DIRECTORY_COUNT)), str(i) + '_' + os.path.basename(path))
+        bindirpatch.mkdir_if_not_exists(os.path.dirname(dstPath))
+        os.rename(os.path.join(newDir, path), dstPath)
+    for i in xrange(int(round(len(small) * ADD_RATE))):
+        write_file(os.path.join(newDir, 'added', file_name(rnd, FILE_COUNT + i)), rnd, file_size(rnd))
+
+def mutate_file(srcPath, dstPath, rnd):
+    """Copies the file with 1 to 4 edits: a range is replaced, inserted or deleted"""
+    size = os.path.getsize(srcPath)
+    edits = sorted(rnd.randrange(size + 1) for i in xrange(rnd.randint(1, 4)))
+    with open(srcPath, 'rb') as f:
+        with open(dstPath, 'wb') as outFile:
+            position = 0
+            for offset in edits:
+                if offset < position:
+                    continue
+                copy_range(f, outFile, offset - position)
+                position = offset
+                length = rnd.randint(1, 4096)
+                kind = rnd.choice(['replace', 'insert', 'delete'])
+                if kind != 'delete':
+                    outFile.write(random_data(rnd, length))
+                if kind != 'insert':
+                    f.seek(min(size, position + length))
+                    position = f.tell()
+            copy_range(f, outFile, size - position)
+
+def copy_range(f, outFile, length):
+    while length > 0:
+        block = f.read(min(length, BLOCK_SIZE))
+        if not block:
+            return
+        outFile.write(block)
+        length -= len(block)
+
+def file_name(rnd, i):
+    return os.path.join('dir' + str(rnd.randrange(DIRECTORY_COUNT)), 'file' + str(i) + '.bin')
+
+def file_size(rnd):
+    """Log-normal, so there are many small and a few big files, with MEAN_FILE_SIZE on average"""
+    sigma = 1.5
+    mu = math.log(MEAN_FILE_SIZE) - sigma * sigma / 2
+    return min(int(rnd.lognormvariate(mu, sigma)), MEAN_FILE_SIZE * 64)
+
+def write_file(path, rnd, size):
+    bindirpatch.mkdir_if_not_exists(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        while size > 0:
+            data = random_data(rnd, min(size, BLOCK_SIZE))
+            f.write(data)
+            size -= len(data)
+
+def random_data(rnd, size):
+    """Random bytes, or hex digits (which compress to about half) with probability COMPRESSIBLE"""
+    if rnd.random() < COMPRESSIBLE:
+        return '%0*x' % (size, rnd.getrandbits(size * 4))
+    return ('%0*x' % (size * 2, rnd.getrandbits(size * 8))).decode('hex')
+
+def list_files(rootDir):
+    """Returns (relPath, size) tuples of all files below <rootDir>"""
+    return [ (relPath, newStat[0]) for (relPath, oldStat, newStat) in bindirpatch.walk_trees(None, rootDir) ]
+
+def tree_size(rootDir):
+    return sum(size for (path, size) in list_files(rootDir))
+
+def describe_tree(rootDir):
+    files = list_files(rootDir)
+    return str(len(files)) + ' files, ' + format_bytes(sum(size for (path, size) in files))
+
+
+def run_steps(oldDir, newDir):
+    """Runs the STEPS, each on a fresh copy of what it needs. Yields (name, seconds, peakRss, patchSize)
+        tuples; seconds is None if the step failed."""
+    runDir = os.path.join(WORK_DIR, 'run')
+    if os.path.exists(runDir):
+        shutil.rmtree(runDir)
+    os.makedirs(runDir)
+    patchPath = os.path.join(runDir, 'diff', 'patch_temp.bdp')
+
+    if 'diff' in STEPS or 'patch' in STEPS:
+        os.makedirs(os.path.join(runDir, 'diff'))
+        (seconds, peakRss) = run_step('diff', oldDir, newDir, os.path.join(runDir, 'diff'))
+        if 'diff' in STEPS:
+            yield ('diff', seconds, peakRss, os.path.getsize(patchPath) if seconds is not None else None)
+    if 'patch' in STEPS:
+        targetDir = os.path.join(runDir, 'target')
+        shutil.copytree(oldDir, targetDir)
+        (seconds, peakRss) = run_step('patch', patchPath, targetDir)
+        yield ('patch', seconds, peakRss, None)
+
+    if 'deploy' in STEPS or 'update' in STEPS:
+        serverDir = os.path.join(runDir, 'server')
+        outDir = os.path.join(runDir, 'out')
+        releaseDir = os.path.join(runDir, 'release')
+        for path in (os.path.join(serverDir, 'patches'), os.path.join(outDir, 'patches'), os.path.join(outDir, 'manifests')):
+            os.makedirs(path)
+        # deploy writes the new version number into the release
+        shutil.copytree(newDir, releaseDir)
+        server = localftp.LocalFTPServer(serverDir)
+        server.start()
+        try:
+            url = '127.0.0.1:' + str(server.port)
+            (seconds, peakRss) = run_step('deploy', oldDir, releaseDir, os.path.join(runDir, 'deploy_tmp'), outDir, url)
+            if 'deploy' in STEPS:
+                yield ('deploy', seconds, peakRss, None)
+            if 'update' in STEPS:
+                clientDir = os.path.join(runDir, 'client')
+                shutil.copytree(oldDir, clientDir)
+                (seconds, peakRss) = run_step('update', clientDir, os.path.join(runDir, 'client_tmp'), url)
+                yield ('update', seconds, peakRss, None)
+        finally:
+            server.stop()
+
+def run_step(name, *args):
+    """Runs the step in a new process. Returns (seconds, peakRss), seconds is None if it failed."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=step_process,
+                                      args=(queue, name, args, utils.DIFF_BACKEND, bindirpatch.NUM_WORKERS, VERBOSE))
+    process.start()
+    result = queue.get()
+    process.join()
+    print '    ' + name + ': ' + ('failed' if result[0] is None else '%.2f s' % result[0])
+    return result
+
+def step_process(queue, name, args, diffBackend, numWorkers, verbose):
+    """Entry point of the process of a step, puts its (seconds, peakRss) tuple into <queue>"""
+    utils.set_diff_backend(diffBackend)
+    bindirpatch.NUM_WORKERS = numWorkers
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    try:
+        success = globals()['step_' + name](*args)
+    except Exception as ex:
+        sys.stderr.write(name + ': ' + repr(ex) + '\n')
+        success = False
+    seconds = time.time() - start
+    queue.put( (seconds if success else None, peak_rss()) )
+
+def step_diff(oldDir, newDir, outDir):
+    return bindirpatch.create_patch(oldDir, newDir, outDir) is not None
+
+def step_patch(patchPath, targetDir):
+    return bindirpatch.apply_patch(patchPath, targetDir)
+
+def step_deploy(oldDir, newDir, tempDir, outDir, url):
+    deploy.OLD_DIR = oldDir
+    deploy.NEW_DIR = newDir
+    deploy.TEMP_DIR = tempDir
+    deploy.OUT_DIR = outDir
+    deploy.UPDATE_SERVER_URL = url
+    deploy.UPDATE_SERVER_USER = 'benchmark'
+    deploy.UPDATE_SERVER_PWD = 'benchmark'
+    deploy.UPDATE_SERVER_PATH = '/'
+    deploy.deploy()
+    return True
+
+def step_update(projectDir, tempDir, url):
+    autoupdate.PROJECT_DIR = projectDir
+    autoupdate.TEMP_DIR = tempDir
+    autoupdate.UPDATE_SERVER_URL = url
+    autoupdate.update_application()
+    return find_application_version(projectDir) == 2
+
+def peak_rss():
+    """Peak resident memory in bytes of this process or of the biggest of its finished children,
+        or None if it can't be measured"""
+    if resource is None:
+        return None
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kilobytes on Linux, bytes on macOS
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def print_results(results):
+    print ''
+    print '%-8s %10s %12s %12s' % ('step', 'time', 'throughput', 'peak RSS')
+    for name in STEPS:
+        step = results['steps'][name]
+        print '%-8s %8.2f s %7.1f MB/s %12s' % (name, step['seconds'], step['throughput'],
+                                                format_bytes(step['peakRss']) if step['peakRss'] is not None else '-')
+    if 'patchSize' in results:
+        print 'Patch size: ' + format_bytes(results['patchSize'])
+
+def compare_results(baseline, results):
+    """Prints the values that are worse than in <baseline> by more than TOLERANCE.
+        Returns False if there are any, or if the baseline was made with other settings."""
+    if baseline.get('settings') != results['settings']:
+        print 'The baseline ' + BASELINE + ' was made with different settings, the results are not comparable.'
+        return False
+    regressions = []
+    values = [ ('patch size', baseline.get('patchSize'), results.get('patchSize')) ]
+    for name in STEPS:
+        if name not in baseline['steps']:
+            continue
+        for key in ('seconds', 'peakRss'):
+            values.append( (name + ' ' + key, baseline['steps'][name][key], results['steps'][name][key]) )
+    for (label, old, new) in values:
+        if old is not None and new is not None and new > old * (1 + TOLERANCE):
+            regressions.append(label + ': ' + str(round(new, 2)) + ' instead of ' + str(round(old, 2)) +
+                               ' (+' + str(int(round((new / float(old) - 1) * 100))) + '%)')
+    if len(regressions) > 0:
+        print 'REGRESSIONS against ' + BASELINE + ':\n    ' + '\n    '.join(regressions)
+        return False
+    print 'No regressions against ' + BASELINE
+    return True
+
+def format_bytes(size):
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return str(round(size, 1)) + ' ' + unit
+        size /= 1024.0
+    return str(round(size, 1)) + ' GB'
+
+
+def parseExtraArgs(i):
+    global SEED, FILE_COUNT, DIRECTORY_COUNT, MEAN_FILE_SIZE, LARGE_FILE_COUNT, LARGE_FILE_SIZE
+    global CHANGE_RATE, DELETE_RATE, RENAME_RATE, ADD_RATE, COMPRESSIBLE
+    global REPEAT, STEPS, BASELINE, SAVE_BASELINE, TOLERANCE, VERBOSE
+    if len(sys.argv) <= i:
+        return
+    arg = sys.argv[i]
+    value = arg.split('=', 1)[1] if '=' in arg else None
+
+    if arg.startswith('-j'):
+        bindirpatch.NUM_WORKERS = int(arg[2:])
+    elif arg == '-v':
+        VERBOSE = True
+    elif arg.startswith('--backend='):
+        utils.set_diff_backend(value)
+    elif arg.startswith('--seed='):
+        SEED = int(value)
+    elif arg.startswith('--files='):
+        FILE_COUNT = int(value)
+    elif arg.startswith('--dirs='):
+        DIRECTORY_COUNT = max(1, int(value))
+    elif arg.startswith('--size='):
+        MEAN_FILE_SIZE = int(value) * 1024
+    elif arg.startswith('--large='):
+        LARGE_FILE_COUNT = int(value)
+    elif arg.startswith('--large-size='):
+        LARGE_FILE_SIZE = int(value) * 1024 * 1024
+    elif arg.startswith('--change='):
+        CHANGE_RATE = float(value) / 100
+    elif arg.startswith('--delete='):
+        DELETE_RATE = float(value) / 100
+    elif arg.startswith('--rename='):
+        RENAME_RATE = float(value) / 100
+    elif arg.startswith('--add='):
+        ADD_RATE = float(value) / 100
+    elif arg.startswith('--compressible='):
+        COMPRESSIBLE = float(value) / 100
+    elif arg.startswith('--repeat='):
+        REPEAT = max(1, int(value))
+    elif arg.startswith('--steps='):
+        STEPS = [step for step in ['diff', 'patch', 'deploy', 'update'] if step in value.split(',')]
+    elif arg.startswith('--baseline='):
+        BASELINE = value
+    elif arg.startswith('--save-baseline='):
+        SAVE_BASELINE = value
+    elif arg.startswith('--tolerance='):
+        TOLERANCE = float(value) / 100
+    else:
+        print 'Invalid argument: ' + arg
+        usage()
+    parseExtraArgs(i+1)
+
+def usage():
+    print 'Usage: python benchmark.py <workDir> [options]'
+    print '  workDir: where the releases are generated. This directory will be deleted!'
+    print ''
+    print 'Options:'
+    print ' -j#     Jobs, number of worker processes, ex: -j4'
+    print ' --backend=exe|python  Diff engine: bsdiff.exe or the built-in one'
+    print ' -v      Show the output of the steps'
+    print ' --seed=#  Seed of the generated releases, default: 1'
+    print ' --files=#  Number of files, default: 200'
+    print ' --dirs=#  Number of directories, default: 20'
+    print ' --size=KB  Mean file size, default: 32'
+    print ' --large=#  Number of large binaries, default: 1'
+    print ' --large-size=MB  Size of the large binaries, default: 8'
+    print ' --change=%  Modified files, default: 10'
+    print ' --delete=%  Deleted files, default: 2'
+    print ' --rename=%  Renamed files, default: 2'
+    print ' --add=%  Added files, default: 2'
+    print ' --compressible=%  Text content instead of random bytes, default: 50'
+    print ' --repeat=#  Run every step this many times, the fastest run counts'
+    print ' --steps=diff,patch,deploy,update  Steps to run, default: all'
+    print ' --baseline=file  Report regressions against this baseline'
+    print ' --save-baseline=file  Store the results as baseline'
+    print ' --tolerance=%  Allowed difference to the baseline, default: 10'
+    sys.exit(1)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        usage()
+    WORK_DIR = sys.argv[1]
+    parseExtraArgs(2)
+    if not benchmark():
+        sys.exit(1)
@@ -2,37 +2,122 @@
 import os
 import sys
 import shutil
-import filecmp
+import itertools
+import collections
+import difflib
+import struct
+import binascii
+import hashlib
 import zlib
+import mmap
+import time
 import multiprocessing
-from utils import BSDIFF_EXE, BSPATCH_EXE, SEVENZIP_EXE
-from utils import bsdiff, bspatch, zip_directory, unzip_directory
+import ctypes
+import stat as statmodule
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+import utils
+from utils import BSDIFF_EXE, BSPATCH_EXE
+from utils import bsdiff, bspatch
+import delta
+import chunkdelta
+import transforms
+import instrument
+from delta import DeltaException
+from container import Container, ContainerWriter, ContainerException, CODEC_NAMES, pack_file
 
 """
     Directory-wide diff and patch.
-    Patch files are 7z archives containing an index file and a files directory.
-    The index file has a list of modified files. Each entry consists of an operation
-    (A/M/D = Added/Modified/Deleted), the Adler32 checksums of the old and the new version
-    and the relative path to the file.
+    Patch files are containers (see the container module) holding an index and a files directory.
+    The entries are read straight from the patch file, nothing is extracted to a temp directory.
+    The index file has a list of modified files, sorted by path. Each entry consists of an operation
+    (A/M/D/R = Added/Modified/Deleted/Renamed), the Adler32 checksums of the old and the new version
+    and the relative path to the file. Renamed files also have the path they are moved from,
+    they are detected by matching the content of deleted and added files and need no payload.
+    Added files that are similar to a file of the old version are stored as a bsdiff patch
+    against that file (C = Copied from source and patched).
+    See write_index for the binary format.
     The files directory contains all added files and, for all modified files, the bsdiff
-    patches that can convert the old to the new version. The directory structure within
-    the files directory is the same as in the target directory.
+    patches that can convert the old to the new version. These payloads are named by their
+    SHA-1 digest, which the index entries refer to, so identical payloads are only stored once.
+    Each payload is compressed on its own, with a codec chosen from its content.
+
+    Optionally, a manifest with the size, mtime and hashes of each file of the new version is
+    written. When it is passed back in for the next patch, unchanged files are detected without
+    reading them. Together with a content store (the files of each version, stored by SHA-1 digest),
+    the old version doesn't need to be kept on disk at all.
+
+    A patch is applied to a shadow tree next to the target directory (see stage_tree), whose files
+    are hardlinks of the installed ones. Only the changed files are written there, the installed
+    version stays intact until the shadow tree is validated and swapped with the target directory.
+    An interrupted swap is finished by the next run (see commit_tree and recover_tree).
 
     Creating a patch can be multithreaded to make use of multiple cpu cores.
-    To avoid conflicts, each process writes to its own index file, they are merged at the end.
+    The worker processes return their index entries to the main process, which writes the index.
+    With --report, the time and bytes of every phase and file are written to a report, the
+    worker processes return their records along with their results (see the instrument module).
 
-    Requires the command-line version of 7zip and the Windows version of bsdiff/bspatch.
+    The binary diffs are created either with the Windows version of bsdiff/bspatch
+    or with the built-in delta module (see utils.DIFF_BACKEND). Files that are too big for bsdiff
+    get a chunk delta instead (see the chunkdelta module), which is streamed when it's applied.
+    Archives like zip files are diffed on their uncompressed content (see the transforms module).
 """
 
 VERBOSITY_LEVEL = 0
 NUM_WORKERS = 1
+OLD_MANIFEST = None
+NEW_MANIFEST = None
+CONTENT_STORE = None
+CHUNK_SIZE = 1024 * 1024
+LARGE_FILE_SIZE = 1024 * 1024
+SMALL_FILE_CHUNKS = 32
+# similarity search for added files, see select_bases
+MIN_SIMILARITY_SIZE = 4096
+# old files with the same number of shared fingerprints that are compared by name
+MAX_SIMILARITY_CANDIDATES = 16
+SIMILARITY_DIFFS = 2
+SIMILARITY_RATIO = 0.5
+# average size of the chunks whose checksums are the fingerprints, see fingerprints. Small enough
+# that a file of MIN_SIMILARITY_SIZE has a few of them; big files keep one in FINGERPRINT_SAMPLING.
+FINGERPRINT_BLOCK = 1024
+FINGERPRINT_SAMPLING = 16
+FINGERPRINT_SAMPLED = 256
+# names of the shadow tree, the replaced tree and the commit file next to the target directory
+STAGED_SUFFIX = '.staged'
+OLD_SUFFIX = '.old'
+COMMIT_SUFFIX = '.commit'
+# scratch files of interrupted patches, they aren't taken over into the shadow tree
+# (the last three are written by transforms.patch_file)
+TEMP_SUFFIXES = ('.patch_tmp', '.patch_tmp2', '.delta_tmp', '.old_tmp', '.new_tmp', '.inner_tmp')
+# ioctl that clones a file on Linux filesystems with copy-on-write (Btrfs, XFS)
+FICLONE = 0x40049409
 
-def create_patch(oldDir, newDir, outDir):
+def create_patch(oldDir, newDir, outDir, oldManifestPath=None, newManifestPath=None, contentStore=None):
+    """Creates a patch from <oldDir> to <newDir>. Optionally, a manifest of <newDir> is written to
+        <newManifestPath> and its files are added to <contentStore>. If the manifest of the old
+        version is passed in <oldManifestPath>, files that match it are not read again.
+        With a manifest and a content store, <oldDir> doesn't need to exist anymore."""
     patchDir = os.path.join(outDir, 'patch_temp')
     
-    if not os.path.exists(oldDir):
-        print 'Directory to the old version is invalid! Aborting.'
-        return None
+    oldManifest = None
+    if oldManifestPath is not None and os.path.isfile(oldManifestPath):
+        oldManifest = read_manifest(oldManifestPath)
+
+    if oldDir is None or not os.path.exists(oldDir):
+        if oldManifest is None or contentStore is None:
+            print 'Directory to the old version is invalid! Aborting.'
+            return None
+        print 'Old version not found, using manifest and content store instead.'
+        oldDir = None
     
     if not os.path.exists(newDir):
         print 'Directory to the new version is invalid! Aborting.'
@@ -46,125 +131,897 @@ def create_patch(oldDir, newDir, outDir):
     elif not is_empty_directory(patchDir):
         print 'patch_temp directory is not empty! Aborting.'
         return None
+    os.mkdir(os.path.join(patchDir, 'files'))
     
-    walk_old_dir(oldDir, newDir, patchDir)
-    walk_new_dir(oldDir, newDir, patchDir)
-    merge_index(patchDir)
-    zip_directory(patchDir, patchDir + '.7z')
-    return patchDir + '.7z'
+    (index, manifest) = diff_dirs(oldDir, newDir, patchDir, oldManifest, newManifestPath is not None, contentStore)
+    with instrument.phase('index'):
+        if newManifestPath is not None:
+            write_manifest(newManifestPath, manifest)
+        write_index(patchDir, index)
+    write_patch_file(patchDir, newDir, index, patchDir + '.bdp')
+    return patchDir + '.bdp'
 
+def create_archive(newDir, outDir, manifestPath=None, blobCache=None):
+    """Creates a patch that adds all files of <newDir> to an empty directory, e.g. for a full release.
+        Files that match the manifest at <manifestPath> are not read to get their hashes.
+        The compressed payloads are kept in <blobCache> by digest, so the next archive only needs
+        to compress the content that changed. Blobs that aren't used anymore are removed."""
+    patchDir = os.path.join(outDir, 'patch_temp')
+    if not os.path.exists(newDir):
+        print 'Directory to the new version is invalid! Aborting.'
+        return None
+    if not os.path.exists(patchDir):
+        os.mkdir(patchDir)
+    elif not is_empty_directory(patchDir):
+        print 'patch_temp directory is not empty! Aborting.'
+        return None
+
+    manifest = {}
+    if manifestPath is not None and os.path.isfile(manifestPath):
+        manifest = read_manifest(manifestPath)
+    print ''
+    print 'Checking files...'
+    work = []
+    with instrument.phase('walk'):
+        for (relPath, oldStat, newStat) in walk_trees(None, newDir):
+            knownHash = None
+            if relPath in manifest and manifest[relPath][0] == newStat:
+                knownHash = manifest[relPath][1]
+            work.append( (relPath, os.path.join(newDir, relPath), knownHash) )
+    pool = create_pool(NUM_WORKERS)
+    try:
+        with instrument.phase('compare'):
+            index = parallel_map(pool, visit_added_file, work)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-def apply_patch(patchFilePath, targetDir):
+    with instrument.phase('index'):
+        write_index(patchDir, index)
+    write_patch_file(patchDir, newDir, index, patchDir + '.bdp', blobCache)
+    if blobCache is not None:
+        prune_blob_cache(blobCache, set(entry.payload for entry in index))
+    return patchDir + '.bdp'
+
+
+def apply_patch(patchFilePath, targetDir, numWorkers=None):
+    """Applies the patch to <targetDir>, using <numWorkers> processes (default: NUM_WORKERS).
+        The new version is built in a shadow tree and only replaces <targetDir> once it's
+        complete and validated (see stage_tree). Returns True if the patch was applied successfully."""
     if not os.path.isfile(patchFilePath):
         print 'Invalid patch file path at: ' + patchFilePath
         print 'Not a file'
-        return None
+        return False
     
-    baseDir = os.path.dirname(patchFilePath)
-    patchDir = os.path.join(baseDir, 'patch_temp')
+    success = False
     if validate_environment():
+        recover_tree(targetDir)
+        pool = create_pool(numWorkers if numWorkers is not None else NUM_WORKERS)
+        stagedDir = None
         try:
-            unzip_directory(patchFilePath, baseDir, silent=True)
-            index = read_index(patchDir)
+            index = read_index(open_container(patchFilePath))
 
             print 'Checking for correct version of files...'
-            for (operation, path, checksumOld, checksumNew) in index:
-                if (operation != 'A'):
-                    print_verbose(2, path)
-                    validate_checksum_pre(os.path.join(targetDir, path), checksumOld)
+            work = [ (entry.source or entry.path, os.path.join(targetDir, entry.source or entry.path), entry.checksumOld, 'check') \
+                         for entry in index if entry.operation != 'A' ]
+            with instrument.phase('check'):
+                results = parallel_map(pool, check_file, work)
+            for (path, actualChecksum, expectedChecksum) in results:
+                if actualChecksum != expectedChecksum:
+                    raise ChecksumException(os.path.join(targetDir, path), expectedChecksum, actualChecksum)
 
             print 'Applying Patch...'
-            for (operation, path, checksumOld, checksumNew) in index:
-                print_verbose(1, operation + ' ' + path)
-                apply_file_operation(operation, path, patchDir, targetDir)
+            # an empty directory has nothing to keep intact, the files are written to it directly
+            workDir = targetDir
+            if os.path.isdir(targetDir) and not is_empty_directory(targetDir):
+                with instrument.phase('stage'):
+                    stagedDir = workDir = stage_tree(targetDir)
+            # copies must read their source before it's modified, moved or deleted. Copies and moves go
+            # to scratch files, so the old files and directories can be cleared before anything is added.
+            for operations in (['C'], ['R'], ['D']):
+                apply_operations(pool, patchFilePath, index, operations, workDir)
+            with instrument.phase('apply'):
+                clear_paths(workDir, [entry.path for entry in index if entry.operation != 'D'])
+            apply_operations(pool, patchFilePath, index, ['A', 'M'], workDir)
+            with instrument.phase('apply'):
+                for entry in index:
+                    if entry.operation in ('R', 'C'):
+                        os.rename(scratch_path(workDir, entry.path), os.path.join(workDir, entry.path))
 
             print 'Validating Result...'
-            for (operation, path, checksumOld, checksumNew) in index:
-                print_verbose(2, path)
-                if (operation != 'D'):
-                    validate_checksum_post(os.path.join(targetDir, path), checksumNew)
+            work = [ (entry.path, os.path.join(workDir, entry.path), entry.checksumNew, 'validate') \
+                         for entry in index if entry.operation != 'D' ]
+            with instrument.phase('validate'):
+                results = parallel_map(pool, check_file, work)
+            errors = [ path + ': checksum ' + str(actualChecksum) + ' instead of ' + str(expectedChecksum) \
+                           for (path, actualChecksum, expectedChecksum) in results if actualChecksum != expectedChecksum ]
+            if len(errors) > 0:
+                raise PatchException(errors)
 
+            if stagedDir is not None:
+                with instrument.phase('commit'):
+                    commit_tree(targetDir, stagedDir)
+                stagedDir = None
+            success = True
+
+        except ContainerException as ex:
+            print ex.msg()
         except ChecksumException as ex:
             print ex.msg()
+        except PatchException as ex:
+            print ex.msg()
+        except OSError as ex:
+            print 'Could not install the new version in ' + targetDir + ': ' + str(ex)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            close_containers()
+            if stagedDir is not None:
+                shutil.rmtree(stagedDir)
+
+    return success
+
+
+def apply_patches(patchFilePaths, targetDir, numWorkers=None):
+    """Applies a chain of consecutive patches to <targetDir> in one go. The file operations of
+        all patches are composed first, so every file is written and validated only once,
+        no matter how many of the patches touch it. Like apply_patch, the new version is built
+        in a shadow tree. Returns True on success."""
+    for patchFilePath in patchFilePaths:
+        if not os.path.isfile(patchFilePath):
+            print 'Invalid patch file path at: ' + patchFilePath
+            print 'Not a file'
+            return False
+    if not validate_environment():
+        return False
+
+    success = False
+    recover_tree(targetDir)
+    pool = create_pool(numWorkers if numWorkers is not None else NUM_WORKERS)
+    stagedDir = None
+    try:
+        patches = [ (patchFilePath, read_index(open_container(patchFilePath))) for patchFilePath in patchFilePaths ]
+        (recipes, required) = compose_patches(patches)
+
+        print 'Checking for correct version of files...'
+        work = [ (path, os.path.join(targetDir, path), expectedChecksum, 'check') for (path, expectedChecksum) in sorted(required.items()) ]
+        with instrument.phase('check'):
+            results = parallel_map(pool, check_file, work)
+        for (path, actualChecksum, expectedChecksum) in results:
+            if actualChecksum != expectedChecksum:
+                raise ChecksumException(os.path.join(targetDir, path), expectedChecksum, actualChecksum)
+
+        print 'Applying Patches...'
+        workDir = targetDir
+        if os.path.isdir(targetDir) and not is_empty_directory(targetDir):
+            with instrument.phase('stage'):
+                stagedDir = workDir = stage_tree(targetDir)
+        written = sorted(path for (path, recipe) in recipes.items() if recipe is not None)
+        # all results go to scratch files first, because other recipes may still read the old files
+        work = [ (path, recipes[path], workDir) for path in written ]
+        try:
+            with instrument.phase('apply'):
+                results = parallel_map(pool, build_file, work)
+            errors = [error for (path, error) in results if error is not None]
+            if len(errors) > 0:
+                raise PatchException(errors)
+        except:
+            for path in written:
+                scratchPath = scratch_path(workDir, path)
+                if os.path.exists(scratchPath):
+                    os.remove(scratchPath)
+            raise
+
+        with instrument.phase('apply'):
+            for (path, recipe) in sorted(recipes.items()):
+                if recipe is None and os.path.isfile(os.path.join(workDir, path)):
+                    delete_file(os.path.join(workDir, path))
+            clear_paths(workDir, written)
+            for path in written:
+                dstPath = os.path.join(workDir, path)
+                if os.path.exists(dstPath):
+                    os.remove(dstPath)
+                os.rename(scratch_path(workDir, path), dstPath)
+        if stagedDir is not None:
+            with instrument.phase('commit'):
+                commit_tree(targetDir, stagedDir)
+            stagedDir = None
+        success = True
+
+    except ContainerException as ex:
+        print ex.msg()
+    except ChecksumException as ex:
+        print ex.msg()
+    except PatchException as ex:
+        print ex.msg()
+    except OSError as ex:
+        print 'Could not install the new version in ' + targetDir + ': ' + str(ex)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        close_containers()
+        if stagedDir is not None:
+            shutil.rmtree(stagedDir)
+    return success
+
+
+def compose_patches(patches):
+    """Composes the index entries of consecutive patches, given as (patchFilePath, index) tuples.
+        Returns a dict that maps each touched path to its recipe (or None if it's deleted in the end)
+        and a dict with the checksums the original files must have.
+        A recipe is a (base, isOriginal, deltas, checksumNew) tuple: the file is built by
+        applying the deltas in order to either the original file <base> in the target directory or
+        to a payload. Payloads and deltas are given as (patchFilePath, entryName) tuples."""
+    recipes = {}
+    required = {}
+
+    def current(path, expectedChecksum):
+        recipe = recipes.get(path, (path, True, (), None))
+        if recipe is None:
+            raise PatchException([path + ' is used after it was deleted by an earlier patch'])
+        (base, isOriginal, deltas, checksumNew) = recipe
+        if isOriginal and len(deltas) == 0:
+            required.setdefault(base, expectedChecksum)
+        return recipe
+
+    for (patchFilePath, index) in patches:
+        # all entries of a patch see the files as they were before the patch
+        updates = {}
+        for entry in index:
+            payload = (patchFilePath, payload_name(entry.payload)) if entry.payload else None
+            if entry.operation == 'A':
+                updates[entry.path] = (payload, False, (), entry.checksumNew)
+            elif entry.operation == 'M':
+                (base, isOriginal, deltas, checksumNew) = current(entry.path, entry.checksumOld)
+                updates[entry.path] = (base, isOriginal, deltas + (payload,), entry.checksumNew)
+            elif entry.operation == 'D':
+                current(entry.path, entry.checksumOld)
+                updates[entry.path] = None
+            elif entry.operation == 'R':
+                (base, isOriginal, deltas, checksumNew) = current(entry.source, entry.checksumOld)
+                updates[entry.path] = (base, isOriginal, deltas, entry.checksumNew)
+                updates.setdefault(entry.source, None)
+            elif entry.operation == 'C':
+                (base, isOriginal, deltas, checksumNew) = current(entry.source, entry.checksumOld)
+                updates[entry.path] = (base, isOriginal, deltas + (payload,), entry.checksumNew)
+        recipes.update(updates)
 
-    shutil.rmtree(patchDir)
+    # files that end up exactly as they were don't need to be touched
+    for (path, recipe) in recipes.items():
+        if recipe is not None and recipe[0:3] == (path, True, ()):
+            del recipes[path]
+    return (recipes, required)
 
+def build_file((path, (base, isOriginal, deltas, checksumNew), targetDir)):
+    """Builds the file from its recipe (see compose_patches) and writes it to a scratch file next
+        to the target. Returns (path, errorMessage); the message is None on success."""
+    print_verbose(1, path)
+    scratchPath = scratch_path(targetDir, path)
+    start = time.time()
+    try:
+        if isOriginal and len(deltas) == 0:
+            # a file that's only moved was checked already, it's linked instead of copied
+            link_file(os.path.join(targetDir, base), scratchPath)
+            instrument.record_file('apply', path, time.time() - start, 0, 0)
+            return (path, None)
+        # chunk deltas are for files that are too big to hold in memory, transformed deltas need temp files
+        inMemory = utils.DIFF_BACKEND == 'python' and \
+            all(open_container(patchFilePath).peek(name, len(delta.MAGIC)) == delta.MAGIC for (patchFilePath, name) in deltas)
+        if inMemory:
+            if isOriginal:
+                with open(os.path.join(targetDir, base), 'rb') as f:
+                    data = f.read()
+            else:
+                data = open_container(base[0]).read(base[1])
+            for (patchFilePath, name) in deltas:
+                data = delta.patch(data, open_container(patchFilePath).read(name))
+            with open(scratchPath, 'wb') as f:
+                f.write(data)
+            actualChecksum = zlib.adler32(data) & 0xffffffff
+        else:
+            # bspatch.exe and the other delta formats work on files, so alternate between two scratch files
+            if isOriginal:
+                srcPath = os.path.join(targetDir, base)
+            else:
+                srcPath = scratchPath if len(deltas) % 2 == 0 else scratchPath + '2'
+                open_container(base[0]).extract(base[1], srcPath)
+            for (i, (patchFilePath, name)) in enumerate(deltas):
+                dstPath = scratchPath if (len(deltas) - i) % 2 == 1 else scratchPath + '2'
+                apply_delta(srcPath, dstPath, open_container(patchFilePath), name)
+                srcPath = dstPath
+            if os.path.exists(scratchPath + '2'):
+                os.remove(scratchPath + '2')
+            actualChecksum = checksum(scratchPath)
+    except (IOError, OSError, DeltaException, ContainerException) as ex:
+        return (path, path + ': ' + str(ex))
+
+    if actualChecksum != checksumNew:
+        return (path, path + ': checksum ' + str(actualChecksum) + ' instead of ' + str(checksumNew))
+    if instrument.ENABLED:
+        payloadSize = sum(open_container(patchFilePath).size(name) for (patchFilePath, name) in deltas)
+        if not isOriginal:
+            payloadSize += open_container(base[0]).size(base[1])
+        newSize = os.path.getsize(scratchPath)
+        instrument.record_file('apply', path, time.time() - start, payloadSize, newSize,
+                               instrument.ratio(payloadSize, newSize) if len(deltas) > 0 else None)
+    return (path, None)
+
+
+def check_file((path, filePath, expectedChecksum, phase)):
+    """Returns (path, actualChecksum, expectedChecksum). Missing files have the checksum None.
+        <phase> is the name of the check in the report, see the instrument module."""
+    print_verbose(2, path)
+    if not os.path.isfile(filePath):
+        return (path, None, expectedChecksum)
+    start = time.time()
+    actualChecksum = checksum(filePath)
+    instrument.record_file(phase, path, time.time() - start, os.path.getsize(filePath), 0)
+    return (path, actualChecksum, expectedChecksum)
+
+def visit_file_operation((entry, patchFilePath, targetDir)):
+    """Applies a single index entry. Returns an error message or None on success."""
+    print_verbose(1, entry.operation + ' ' + entry.path)
+    start = time.time()
+    try:
+        patchFile = open_container(patchFilePath)
+        apply_file_operation(entry, patchFile, targetDir)
+    except (IOError, OSError, DeltaException, ContainerException) as ex:
+        return entry.operation + ' ' + entry.path + ': ' + str(ex)
+    if instrument.ENABLED:
+        payloadSize = patchFile.size(payload_name(entry.payload)) if entry.payload else 0
+        newPath = scratch_path(targetDir, entry.path) if entry.operation in ('R', 'C') else os.path.join(targetDir, entry.path)
+        newSize = os.path.getsize(newPath) if entry.operation != 'D' else 0
+        instrument.record_file('apply', entry.path, time.time() - start, payloadSize, newSize,
+                               instrument.ratio(payloadSize, newSize) if entry.operation in ('M', 'C') else None)
+    return None
 
-def apply_file_operation(operation, relPath, patchDir, targetDir):
-    dstPath = os.path.join(targetDir, relPath)
-    patchPath = os.path.join(patchDir, 'files', relPath)
+def apply_operations(pool, patchFilePath, index, operations, targetDir):
+    """Applies the index entries with one of the <operations> in parallel, see visit_file_operation."""
+    work = [ (entry, patchFilePath, targetDir) for entry in index if entry.operation in operations ]
+    with instrument.phase('apply'):
+        results = parallel_map(pool, visit_file_operation, work)
+    errors = [error for error in results if error is not None]
+    if len(errors) > 0:
+        raise PatchException(errors)
 
-    if operation == 'A':
-        add_file(patchPath, dstPath)
-    if operation == 'M':
-        modify_file(dstPath, patchPath)
-    if operation == 'D':
+def apply_file_operation(entry, patchFile, targetDir):
+    """Moves and copies are written to the scratch file of their path, see scratch_path."""
+    dstPath = os.path.join(targetDir, entry.path)
+    name = payload_name(entry.payload)
+    if entry.operation == 'A' and os.path.exists(dstPath):
+        # it may be a hardlink of a file of the installed version, see stage_tree
+        os.remove(dstPath)
+
+    if entry.operation == 'A':
+        add_file(patchFile, name, dstPath)
+    if entry.operation == 'M':
+        modify_file(dstPath, patchFile, name)
+    if entry.operation == 'D':
         delete_file(dstPath)
+    if entry.operation == 'R':
+        os.rename(os.path.join(targetDir, entry.source), scratch_path(targetDir, entry.path))
+    if entry.operation == 'C':
+        apply_delta(os.path.join(targetDir, entry.source), scratch_path(targetDir, entry.path), patchFile, name)
+
+def scratch_path(targetDir, path):
+    """Returns the path of the scratch file that the new version of <path> is built in. Scratch files
+        are kept in <targetDir> itself, because the directory of <path> may still be a file."""
+    return os.path.join(targetDir, hashlib.md5(path).hexdigest() + '.patch_tmp')
 
+def clear_paths(targetDir, paths):
+    """Makes room for the files at <paths> once the old files are deleted or moved away: directories
+        of the old version in their place are removed and their own directories are created."""
+    for path in paths:
+        dstPath = os.path.join(targetDir, path)
+        if os.path.isdir(dstPath):
+            shutil.rmtree(dstPath)
+    for dirPath in sorted(set(os.path.dirname(os.path.join(targetDir, path)) for path in paths)):
+        mkdir_if_not_exists(dirPath)
 
-def walk_old_dir(oldDir, newDir, patchDir):
-    """Traverse <oldDir> and index all files that are modified or deleted in <newDir>"""
+def apply_delta(oldPath, newPath, patchFile, name):
+    """Applies the delta payload <name> from the container <patchFile> to <oldPath> and writes <newPath>.
+        The built-in engine reads the payload directly from the container, bspatch.exe needs a file.
+        Chunk deltas are streamed from the container with either backend, transformed deltas
+        are applied with either backend too."""
+    magic = patchFile.peek(name, len(delta.MAGIC))
+    if magic == chunkdelta.MAGIC:
+        with open(newPath, 'wb') as f:
+            chunkdelta.patch_stream(oldPath, f, patchFile.read_chunks(name))
+        return
+    if utils.DIFF_BACKEND == 'python' and magic != transforms.MAGIC:
+        with open(oldPath, 'rb') as f:
+            oldData = f.read()
+        with open(newPath, 'wb') as f:
+            f.write(delta.patch(oldData, patchFile.read(name)))
+        return
+    deltaPath = newPath + '.delta_tmp'
+    patchFile.extract(name, deltaPath)
+    try:
+        if magic == transforms.MAGIC:
+            transforms.patch_file(oldPath, newPath, deltaPath)
+        else:
+            bspatch(oldPath, newPath, deltaPath)
+    finally:
+        os.remove(deltaPath)
+
+def open_container(patchFilePath):
+    """Opens the patch file, or returns the already opened one. Every worker process
+        keeps its own containers open until close_containers is called."""
+    if patchFilePath not in _containerCache:
+        _containerCache[patchFilePath] = Container(patchFilePath)
+    return _containerCache[patchFilePath]
+
+def close_containers():
+    for patchFile in _containerCache.values():
+        patchFile.close()
+    _containerCache.clear()
+
+_containerCache = {}
+
+
+def diff_dirs(oldDir, newDir, patchDir, oldManifest=None, hashAll=False, contentStore=None):
+    """Traverse <oldDir> and <newDir> in a single pass and index all files that are
+        added, modified or deleted in <newDir>. Returns the index entries and the manifest entries
+        of <newDir>; unchanged files are only hashed if <hashAll> is set or a content store is used.
+        If <oldDir> is None, the old version is taken from <oldManifest> and <contentStore>."""
     print ''
-    print 'Checking for deleted or modified files..'
-    if NUM_WORKERS > 1:
-        pool = multiprocessing.Pool(processes=NUM_WORKERS)
-        pool.map(visit_old_file, walk_dir(oldDir, oldDir, newDir, patchDir))
+    print 'Checking for added, modified or deleted files...'
+    hashAll = hashAll or contentStore is not None
+    if oldDir is None:
+        tree = walk_manifest(oldManifest, newDir)
     else:
-        map(visit_old_file, walk_dir(oldDir, oldDir, newDir, patchDir))
+        tree = walk_trees(oldDir, newDir)
 
-def visit_old_file((relPath, oldPath, newPath, patchPath, indexPath)):
-    print_verbose(2, '    ' + oldPath)
+    work = []
+    # files of the old version that can serve as base for similar added files
+    oldFiles = []
+    newSizes = {}
+    with instrument.phase('walk'):
+        for (relPath, oldStat, newStat) in tree:
+            # hashes from the old manifest are only valid if the file wasn't touched since
+            oldHash = None
+            if oldManifest is not None and relPath in oldManifest:
+                (manifestStat, manifestHash) = oldManifest[relPath]
+                if manifestStat == oldStat:
+                    oldHash = manifestHash
+            if oldDir is None:
+                oldPath = content_store_path(contentStore, oldHash[1]) if oldHash is not None else None
+            else:
+                oldPath = os.path.join(oldDir, relPath)
+            work.append( (relPath, oldStat, newStat, oldHash, oldPath, os.path.join(newDir, relPath),
+                          patchDir, hashAll, contentStore) )
+            if oldStat is not None and oldPath is not None:
+                oldFiles.append( (relPath, oldPath, oldStat[0], oldHash[0] if oldHash is not None else None) )
+            if newStat is not None:
+                newSizes[relPath] = newStat[0]
 
-    if not os.path.exists(newPath):
-        add_to_index('D', relPath, indexPath, checksum(oldPath), 0)
-        return
+    pool = create_pool(NUM_WORKERS)
+    try:
+        (index, manifest) = _diff_dirs(pool, work, oldFiles, newSizes, newDir, patchDir)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for entry in index:
+        print_verbose(1, entry.operation + ' ' + entry.path + (' <- ' + entry.source if entry.source else ''))
+    return (index, manifest)
+
+def _diff_dirs(pool, work, oldFiles, newSizes, newDir, patchDir):
+    # Dispatch the most expensive files first (LPT scheduling), so that a big file
+    # doesn't start last while all other workers are idle. Small files are sent in chunks.
+    work.sort(key=estimate_cost, reverse=True)
+    with instrument.phase('compare'):
+        if pool is None:
+            results = map(visit_file, work)
+        else:
+            numLarge = len([entry for entry in work if estimate_cost(entry) >= LARGE_FILE_SIZE])
+            func = instrument.traced(visit_file)
+            results = itertools.chain(pool.imap_unordered(func, work[:numLarge], 1),
+                                      pool.imap_unordered(func, work[numLarge:], SMALL_FILE_CHUNKS))
+            results = instrument.collect(list(results))
+
+    index = []
+    manifest = []
+    digests = {}
+    for (indexEntry, digest, manifestEntry) in results:
+        if indexEntry is not None:
+            index.append(indexEntry)
+            digests[indexEntry.path] = digest
+        if manifestEntry is not None:
+            manifest.append(manifestEntry)
+    with instrument.phase('index'):
+        index = detect_renames(sorted(index, key=lambda entry: entry.path), digests)
+    with instrument.phase('diff'):
+        oldPaths = dict( (entry[0], entry[4]) for entry in work )
+        index = diff_modified(pool, index, oldPaths, newSizes, newDir, patchDir)
+        index = select_bases(pool, index, oldFiles, newSizes, newDir, patchDir)
+    return (index, manifest)
+
+def detect_renames(index, digests):
+    """Replaces pairs of deleted and added files with the same content by a single 'R' entry.
+        Files with the same name are paired first, then the rest in path order."""
+    deleted = collections.defaultdict(list)
+    for entry in index:
+        if entry.operation == 'D':
+            deleted[digests[entry.path]].append(entry)
+
+    added = [entry for entry in index if entry.operation == 'A' and digests[entry.path] in deleted]
+    moves = {}
+    for sameName in (True, False):
+        for entry in added:
+            if entry.path in moves:
+                continue
+            candidates = deleted[digests[entry.path]]
+            for source in candidates:
+                if not sameName or os.path.basename(source.path) == os.path.basename(entry.path):
+                    moves[entry.path] = source
+                    candidates.remove(source)
+                    break
+
+    sources = set(source.path for source in moves.values())
+    result = []
+    for entry in index:
+        if entry.path in moves:
+            source = moves[entry.path]
+            result.append(IndexEntry('R', entry.path, source.checksumOld, entry.checksumNew, source.path, ''))
+        elif entry.path not in sources:
+            result.append(entry)
+    return result
+
+def diff_modified(pool, index, oldPaths, newSizes, newDir, patchDir):
+    """Creates the delta payloads of the 'M' entries, the biggest files first.
+        <oldPaths> maps the paths to the files of the old version."""
+    modified = sorted((entry.path for entry in index if entry.operation == 'M'), key=lambda path: newSizes[path], reverse=True)
+    work = [ (path, oldPaths[path], os.path.join(newDir, path), patchDir) for path in modified ]
+    payloads = dict(parallel_map(pool, diff_file, work))
+    result = []
+    for entry in index:
+        if entry.path in payloads:
+            entry = IndexEntry('M', entry.path, entry.checksumOld, entry.checksumNew, '', payloads[entry.path])
+        result.append(entry)
+    return result
+
+def diff_file((relPath, oldPath, newPath, patchDir)):
+    """Returns (relPath, payload) with the digest of the delta of a modified file."""
+    print_verbose(2, '    ' + relPath)
+    patchPath = temp_payload_path(patchDir, relPath)
+    create_delta(oldPath, newPath, patchPath, relPath)
+    return (relPath, store_payload(patchDir, patchPath))
+
+def select_bases(pool, index, oldFiles, newSizes, newDir, patchDir):
+    """Finds a similar file of the old version for each added file. If a diff against it is
+        much smaller than the file, the entry is replaced by a 'C' entry (copy source and patch).
+        The fingerprints of the old files of similar size are indexed once, and each added file is
+        diffed against the old files that share the most fingerprints with it. The name
+        similarity only decides between old files with the same number of shared fingerprints."""
+    added = [entry for entry in index if entry.operation == 'A' and newSizes[entry.path] >= MIN_SIMILARITY_SIZE]
+    buckets = set(size_bucket(newSizes[entry.path]) + i for entry in added for i in (-1, 0, 1))
+    candidates = [oldFile for oldFile in oldFiles if oldFile[2] >= MIN_SIMILARITY_SIZE and size_bucket(oldFile[2]) in buckets]
+    if len(added) == 0 or len(candidates) == 0:
+        return index
+
+    work = [oldPath for (oldRelPath, oldPath, oldSize, oldChecksum) in candidates] + \
+           [os.path.join(newDir, entry.path) for entry in added]
+    results = parallel_map(pool, fingerprints, work)
+    fingerprintIndex = collections.defaultdict(list)
+    for (i, oldFingerprints) in enumerate(results[:len(candidates)]):
+        for fingerprint in oldFingerprints:
+            fingerprintIndex[fingerprint].append(i)
+
+    work = []
+    for (entry, newFingerprints) in zip(added, results[len(candidates):]):
+        bucket = size_bucket(newSizes[entry.path])
+        shared = collections.Counter(i for fingerprint in newFingerprints for i in fingerprintIndex.get(fingerprint, ())
+                                     if abs(size_bucket(candidates[i][2]) - bucket) <= 1)
+        if len(shared) == 0:
+            continue
+        ranked = sorted(shared, key=lambda i: (-shared[i], candidates[i][0]))
+        # only the old files that tie with the last one to diff are ranked by name
+        tied = [i for i in ranked if shared[i] >= shared[ranked[min(SIMILARITY_DIFFS, len(ranked)) - 1]]]
+        if len(tied) > SIMILARITY_DIFFS:
+            name = os.path.basename(entry.path)
+            tied = sorted(tied[:MAX_SIMILARITY_CANDIDATES], key=lambda i: (-shared[i],
+                              -difflib.SequenceMatcher(None, name, os.path.basename(candidates[i][0])).ratio(),
+                              abs(candidates[i][2] - newSizes[entry.path]), candidates[i][0]))
+        work.append( (entry.path, os.path.join(newDir, entry.path), newSizes[entry.path],
+                      [candidates[i] for i in tied[:SIMILARITY_DIFFS]], patchDir) )
+
+    bases = dict( (relPath, base) for (relPath, base) in parallel_map(pool, find_base, work) if base is not None )
+    result = []
+    for entry in index:
+        if entry.path in bases:
+            (source, checksumOld, payload) = bases[entry.path]
+            entry = IndexEntry('C', entry.path, checksumOld, entry.checksumNew, source, payload)
+        result.append(entry)
+    return result
+
+def find_base((relPath, newPath, newSize, candidates, patchDir)):
+    """Diffs the added file against the candidates, best first. Returns (relPath, None)
+        or (relPath, (source, checksumOld, payload)) if a diff was stored as payload."""
+    best = None
+    patchPath = temp_payload_path(patchDir, relPath)
+    for (oldRelPath, oldPath, oldSize, oldChecksum) in candidates:
+        tmpPath = patchPath + '.candidate'
+        create_delta(oldPath, newPath, tmpPath, relPath)
+        deltaSize = os.path.getsize(tmpPath)
+        if deltaSize < newSize * SIMILARITY_RATIO and (best is None or deltaSize < best[0]):
+            if os.path.exists(patchPath):
+                os.remove(patchPath)
+            os.rename(tmpPath, patchPath)
+            best = (deltaSize, oldRelPath, oldPath, oldChecksum)
+        else:
+            os.remove(tmpPath)
+
+    if best is None:
+        return (relPath, None)
+    (deltaSize, oldRelPath, oldPath, oldChecksum) = best
+    print_verbose(2, '    ' + relPath + ' is similar to ' + oldRelPath)
+    payload = store_payload(patchDir, patchPath)
+    return (relPath, (oldRelPath, oldChecksum if oldChecksum is not None else checksum(oldPath), payload))
+
+def fingerprints(path):
+    """Returns the CRC32 checksums of the content-defined chunks of the file (see chunkdelta.chunks),
+        with an average size of FINGERPRINT_BLOCK, so an insertion only changes the chunks around it.
+        Of files with more than FINGERPRINT_SAMPLED chunks, only a sample is returned. Chunks are
+        sampled by their checksum, so the same chunks are picked in every file."""
+    sampling = FINGERPRINT_SAMPLING if os.path.getsize(path) > FINGERPRINT_BLOCK * FINGERPRINT_SAMPLED else 1
+    result = set()
+    with open(path, 'rb') as f:
+        for (offset, chunk) in chunkdelta.chunks(f, FINGERPRINT_BLOCK, CHUNK_SIZE):
+            crc = zlib.crc32(chunk) & 0xffffffff
+            if crc % sampling == 0:
+                result.add(crc)
+    return result
 
-    if not filecmp.cmp(oldPath, newPath):
-        mkdir_if_not_exists(os.path.dirname(patchPath))
+def size_bucket(size):
+    return size.bit_length()
+
+def payload_path(patchDir, digest):
+    return os.path.join(patchDir, 'files', digest)
+
+def payload_name(digest):
+    """Name of the payload in the patch file"""
+    return 'files/' + digest
+
+def temp_payload_path(patchDir, relPath):
+    return os.path.join(patchDir, 'files', hashlib.sha1(relPath).hexdigest() + '.tmp')
+
+def store_payload(patchDir, tmpPath):
+    """Moves the payload at <tmpPath> to the location given by its digest and returns the digest.
+        If another file already stored the same payload, it's only kept once."""
+    digest = hash_file(tmpPath)[1]
+    dstPath = payload_path(patchDir, digest)
+    if os.path.exists(dstPath):
+        os.remove(tmpPath)
+        return digest
+    try:
+        os.rename(tmpPath, dstPath)
+    except OSError:
+        # another worker stored the same payload in the meantime
+        os.remove(tmpPath)
+    return digest
+
+def estimate_cost((relPath, oldStat, newStat, oldHash, oldPath, newPath, patchDir, hashAll, contentStore)):
+    """Estimates the work for visit_file in bytes that need to be read."""
+    if newStat is None:
+        return 0 if oldHash is not None else oldStat[0]
+    if oldStat is None:
+        return newStat[0]
+    if oldStat == newStat:
+        return newStat[0] if oldHash is None and hashAll else 0
+    if oldHash is not None:
+        return newStat[0]
+    return oldStat[0] + newStat[0]
+
+def create_pool(numWorkers):
+    """Returns a worker pool, or None if everything should run in this process."""
+    if numWorkers <= 1:
+        return None
+    return multiprocessing.Pool(processes=numWorkers, initializer=init_worker,
+                                initargs=(utils.DIFF_BACKEND, utils.CHUNK_DELTA_SIZE, utils.CHUNK_DELTA_MEMORY,
+                                          instrument.REPORT_PATH))
+
+def parallel_map(pool, func, work):
+    """Like map(), results are in the same order as <work>. The records of the workers
+        are passed back to the main process, see the instrument module."""
+    if pool is None:
+        return map(func, work)
+    return instrument.collect(pool.map(instrument.traced(func), work))
+
+def init_worker(diffBackend, chunkDeltaSize, chunkDeltaMemory, reportPath):
+    """Worker processes don't inherit runtime settings on Windows, so pass them explicitly."""
+    utils.set_diff_backend(diffBackend)
+    utils.set_chunk_delta(chunkDeltaSize, chunkDeltaMemory)
+    instrument.set_report(reportPath)
+
+def visit_added_file((relPath, newPath, newHash)):
+    """Returns the 'A' index entry for a file, <newHash> is its (checksum, digest) if known."""
+    print_verbose(2, '    ' + relPath)
+    if newHash is None:
+        start = time.time()
+        newHash = hash_file(newPath)
+        instrument.record_file('compare', relPath, time.time() - start, os.path.getsize(newPath), 0)
+    return IndexEntry('A', relPath, 0, newHash[0], '', newHash[1])
+
+def visit_file(work):
+    """<work> is the (relPath, oldStat, newStat, oldHash, oldPath, newPath, patchDir, hashAll, contentStore)
+        tuple. <oldStat> and <newStat> are the (size, mtime) tuples from the traversal,
+        or None if the file doesn't exist in that directory. <oldHash> is the
+        (checksum, digest) tuple of the old file if it is known from the manifest.
+        Returns the index entry (or None if unchanged), the digest of the file it refers to
+        and the manifest entry of the new file. Added files are compressed into the patch file later,
+        modified files get their delta from diff_modified."""
+    (relPath, oldStat, newStat, oldHash, oldPath, newPath, patchDir, hashAll, contentStore) = work
+    print_verbose(2, '    ' + relPath)
+    start = time.time()
+
+    if newStat is None:
+        if oldHash is None:
+            oldHash = hash_file(oldPath)
+        instrument.record_file('compare', relPath, time.time() - start, estimate_cost(work), 0)
+        return (IndexEntry('D', relPath, oldHash[0], 0), oldHash[1], None)
+
+    indexEntry = None
+    newHash = None
+    equal = True
+    if oldStat is None:
+        newHash = hash_file(newPath)
+        indexEntry = IndexEntry('A', relPath, 0, newHash[0], '', newHash[1])
+
+    elif oldStat == newStat:
+        # same semantics as filecmp.cmp, but reusing the stat results of the traversal
+        newHash = oldHash
+        if newHash is None and hashAll:
+            newHash = hash_file(newPath)
+
+    else:
+        if oldHash is not None:
+            newHash = hash_file(newPath)
+            equal = newHash[1] == oldHash[1]
+        else:
+            (equal, oldHash, newHash) = compare_files(oldPath, newPath)
+    # the bytes that were read are the estimated cost
+    instrument.record_file('compare', relPath, time.time() - start, estimate_cost(work), 0)
+
+    if not equal:
+        indexEntry = IndexEntry('M', relPath, oldHash[0], newHash[0], '', '')
+
+    if newHash is None:
+        return (indexEntry, None, None)
+    if contentStore is not None:
+        add_to_content_store(contentStore, newPath, newHash[1])
+    return (indexEntry, newHash[1], (relPath, newStat, newHash))
+
+
+def create_delta(oldPath, newPath, patchPath, relPath):
+    """Creates the delta payload, a bsdiff patch or chunk delta (see utils.bsdiff), or a
+        transformed delta if one of the transforms recognizes the files (see the transforms module)
+        and it's smaller. <relPath> is the name of the file in the report."""
+    start = time.time()
+    if transforms.diff_file(oldPath, newPath, patchPath):
+        # e.g. archives of already compressed files gain nothing from being expanded
+        plainPath = patchPath + '.plain'
+        bsdiff(oldPath, newPath, plainPath)
+        if os.path.getsize(plainPath) < os.path.getsize(patchPath):
+            os.remove(patchPath)
+            os.rename(plainPath, patchPath)
+        else:
+            os.remove(plainPath)
+    else:
         bsdiff(oldPath, newPath, patchPath)
-        add_to_index('M', relPath, indexPath, checksum(oldPath), checksum(newPath))
-        return
+    if instrument.ENABLED:
+        (oldSize, newSize, deltaSize) = [os.path.getsize(path) for path in (oldPath, newPath, patchPath)]
+        instrument.record_file('diff', relPath, time.time() - start, oldSize + newSize, deltaSize,
+                               instrument.ratio(deltaSize, newSize))
 
 
-def walk_new_dir(oldDir, newDir, patchDir):
-    """Traverse <newDir> and index all files as added that don't appear in <oldDir>"""
-    print 'Checking for new files...'
-    for (relPath, oldPath, newPath, patchPath, indexPath) in walk_dir(newDir, oldDir, newDir, patchDir):
-        visit_new_file(relPath, oldPath, newPath, patchPath, indexPath)
+def walk_trees(oldDir, newDir, relDir=''):
+    """Merged traversal of <oldDir> and <newDir> over sorted directory listings.
+        Yields a (relPath, oldStat, newStat) tuple for every file, see visit_file.
+        Pass None for a directory that should be treated as empty."""
+    oldEntries = list_dir(os.path.join(oldDir, relDir)) if oldDir is not None else {}
+    newEntries = list_dir(os.path.join(newDir, relDir)) if newDir is not None else {}
+    for name in sorted(set(oldEntries) | set(newEntries)):
+        relPath = os.path.join(relDir, name)
+        (oldIsDir, oldStat) = oldEntries.get(name, (False, None))
+        (newIsDir, newStat) = newEntries.get(name, (False, None))
 
+        if oldIsDir or newIsDir:
+            for entry in walk_trees(oldDir if oldIsDir else None, newDir if newIsDir else None, relPath):
+                yield entry
+        # a file on one side may be replaced by a directory on the other side
+        if oldStat is not None or newStat is not None:
+            yield (relPath, oldStat, newStat)
 
-def visit_new_file(relPath, oldPath, newPath, patchPath, indexPath):
-        print_verbose(2, '    ' + relPath)
-        if not os.path.exists(oldPath):
-            targetDir = os.path.dirname(patchPath)
-            mkdir_if_not_exists(targetDir)
-            shutil.copy(newPath, targetDir)
-            add_to_index('A', relPath, indexPath, 0, checksum(newPath))
+def list_dir(path):
+    """Returns a dict that maps the names in <path> to (isDir, (size, mtime)) tuples.
+        Uses the cached stat results of scandir where possible."""
+    result = {}
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir():
+                result[entry.name] = (True, None)
+            else:
+                stat = entry.stat()
+                result[entry.name] = (False, (stat.st_size, stat.st_mtime))
+    else:
+        for name in os.listdir(path):
+            stat = os.stat(os.path.join(path, name))
+            if statmodule.S_ISDIR(stat.st_mode):
+                result[name] = (True, None)
+            else:
+                result[name] = (False, (stat.st_size, stat.st_mtime))
+    return result
+
+def walk_manifest(oldManifest, newDir):
+    """Like walk_trees, but the old version is described by a manifest."""
+    newPaths = set()
+    for (relPath, oldStat, newStat) in walk_trees(None, newDir):
+        newPaths.add(relPath)
+        yield (relPath, oldManifest[relPath][0] if relPath in oldManifest else None, newStat)
+    for relPath in sorted(set(oldManifest) - newPaths):
+        yield (relPath, oldManifest[relPath][0], None)
 
 
-def walk_dir(rootPath, oldDir, newDir, patchDir):
-    indexPath = os.path.join(patchDir, 'index')
-    for (dirpath, dirnames, filenames) in os.walk(rootPath):
-        relDir = os.path.relpath(dirpath, rootPath)
-        for filename in filenames:
-            relPath = os.path.join(relDir, filename)
-            oldPath = os.path.join(oldDir, relPath)
-            newPath = os.path.join(newDir, relPath)
-            patchPath = os.path.join(patchDir, 'files', relPath)
-            yield (relPath, oldPath, newPath, patchPath, indexPath)
+def read_manifest(manifestPath):
+    """Reads a manifest written by write_manifest. Returns a dict that maps
+        each path to a ((size, mtime), (checksum, digest)) tuple."""
+    result = {}
+    with open(manifestPath, 'r') as manifestFile:
+        for line in manifestFile:
+            if len(line.strip()) == 0:
+                continue
+            parts = line.rstrip('\n').split(' ', 4)
+            stat = (int(parts[0]), float(parts[1]))
+            fileHash = (int(parts[2]) & 0xffffffff, parts[3])
+            result[parts[4]] = (stat, fileHash)
+    return result
 
+def write_manifest(manifestPath, entries):
+    """Writes a list of (path, (size, mtime), (checksum, digest)) tuples to <manifestPath>.
+        Each line of the manifest has the form '<size> <mtime> <checksum> <digest> <path>'."""
+    mkdir_if_not_exists(os.path.dirname(os.path.abspath(manifestPath)))
+    with open(manifestPath + '.tmp', 'w') as manifestFile:
+        for (path, (size, mtime), (fileChecksum, digest)) in sorted(entries):
+            manifestFile.write(str(size) + ' ' + repr(mtime) + ' ' + str(fileChecksum) + ' ' + digest + ' ' + path + '\n')
+    if os.path.exists(manifestPath):
+        os.remove(manifestPath)
+    os.rename(manifestPath + '.tmp', manifestPath)
 
-def add_file(srcPath, dstPath):
-    """Adds file from patch."""
+
+def content_store_path(contentStore, digest):
+    return os.path.join(contentStore, digest[0:2], digest)
+
+def add_to_content_store(contentStore, path, digest):
+    """Copies the file at <path> into the content store, unless it is already there."""
+    storePath = content_store_path(contentStore, digest)
+    if os.path.exists(storePath):
+        return
+    mkdir_if_not_exists(os.path.dirname(storePath))
+    tmpPath = storePath + '.' + str(os.getpid())
+    shutil.copyfile(path, tmpPath)
+    try:
+        os.rename(tmpPath, storePath)
+    except OSError:
+        # another worker stored the same content in the meantime
+        os.remove(tmpPath)
+
+
+def add_file(patchFile, name, dstPath):
+    """Adds file from patch, it's streamed from the patch file."""
     dstDir = os.path.dirname(dstPath)
     if not os.path.exists(dstDir):
         os.makedirs(dstDir)
-    os.rename(srcPath, dstPath)
+    patchFile.extract(name, dstPath)
 
-def modify_file(filePath, patchFile):
+def modify_file(filePath, patchFile, name):
     """Applies diff from patch to file."""
     tmpFilePath = filePath + '.patch_tmp'
-    bspatch(filePath, tmpFilePath, patchFile)
+    apply_delta(filePath, tmpFilePath, patchFile, name)
     os.remove(filePath)
     os.rename(tmpFilePath, filePath)
 
@@ -172,57 +1029,312 @@ def delete_file(filePath):
     os.remove(filePath)
 
 
-def add_to_index(operation, path, indexPath, checksumOld=0, checksumNew=0):
-    """Adds an entry to the index. Each process has its own index file.
-        They must be merged with merge_index() after all processes are done."""
-    indexPath = indexPath + '.' + str(os.getpid())
-    line = operation + ' ' + str(checksumOld) + ' ' + str(checksumNew) + ' ' + path
-    print_verbose(1, line)
-    with open(indexPath, 'a') as indexFile:
-        indexFile.write(unicode(line + '\n'))
-
-def merge_index(patchDir):
-    """Merges the index files of the separate worker processes into one."""
-    indexFiles = [ os.path.join(patchDir,f) \
-                       for f in os.listdir(patchDir) \
-                           if os.path.isfile(os.path.join(patchDir,f)) \
-                           and f.startswith('index.') ]
-    indexFile = os.path.join(patchDir, 'index')
-    with open(indexFile, 'w') as index:
-        for partialIndexFile in indexFiles:
-            with open(partialIndexFile, 'r') as partialIndex:
-                index.write(partialIndex.read())
-            os.remove(partialIndexFile)
-
-def read_index(patchDir):
-    """Read and parse the index file. Returns a list of
-        (operation, path, checksumOld, checksumNew) tuples"""
-    indexPath = os.path.join(patchDir, 'index')
-    with open(indexPath, 'r') as indexFile:
-        result = []
-        for line in indexFile.readlines():
-            if len(line) == 0:
-                continue
-            parts = line.split(' ', 3)
-            operation = parts[0]
-            checksumOld = int(parts[1])
-            checksumNew = int(parts[2])
-            path = parts[3].strip()
-            result.append( (operation, path, checksumOld, checksumNew) )
-    return result
+def stage_tree(targetDir):
+    """Creates the shadow tree of <targetDir> that a patch is applied to and returns its path.
+        Every file is a hardlink of the installed file (or a reflink or a copy, see link_file),
+        so the patch must replace files instead of writing to them, which all file operations do."""
+    stagedDir = os.path.abspath(targetDir) + STAGED_SUFFIX
+    if os.path.exists(stagedDir):
+        shutil.rmtree(stagedDir)
+    os.makedirs(stagedDir)
+    for (dirPath, dirNames, fileNames) in os.walk(targetDir):
+        dstDir = os.path.join(stagedDir, os.path.relpath(dirPath, targetDir))
+        for name in dirNames:
+            os.mkdir(os.path.join(dstDir, name))
+        for name in fileNames:
+            if not name.endswith(TEMP_SUFFIXES):
+                link_file(os.path.join(dirPath, name), os.path.join(dstDir, name))
+    return stagedDir
+
+def link_file(srcPath, dstPath):
+    """Makes <dstPath> a hardlink of <srcPath>. Where that's not supported, it's a reflink
+        (a copy-on-write clone) if the filesystem supports that, otherwise a copy."""
+    try:
+        if hasattr(os, 'link'):
+            os.link(srcPath, dstPath)
+            return
+        if os.name == 'nt' and ctypes.windll.kernel32.CreateHardLinkA(dstPath, srcPath, None):
+            return
+    except OSError:
+        pass
+    if not reflink_file(srcPath, dstPath):
+        shutil.copy2(srcPath, dstPath)
+
+def reflink_file(srcPath, dstPath):
+    if fcntl is None:
+        return False
+    with open(srcPath, 'rb') as src:
+        with open(dstPath, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                shutil.copystat(srcPath, dstPath)
+                return True
+            except IOError:
+                pass
+    os.remove(dstPath)
+    return False
+
+def commit_tree(targetDir, stagedDir):
+    """Replaces <targetDir> with <stagedDir>. The commit file next to <targetDir> is written
+        first, so if the swap is interrupted, recover_tree finishes it."""
+    commitPath = os.path.abspath(targetDir) + COMMIT_SUFFIX
+    with open(commitPath + '.tmp', 'w') as f:
+        f.write(os.path.abspath(stagedDir))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(commitPath + '.tmp', commitPath)
+    finish_commit(targetDir, stagedDir)
+
+def recover_tree(targetDir):
+    """Finishes an interrupted commit_tree and removes the leftovers of earlier runs"""
+    targetDir = os.path.abspath(targetDir)
+    commitPath = targetDir + COMMIT_SUFFIX
+    if os.path.isfile(commitPath):
+        print 'Finishing the interrupted installation in ' + targetDir
+        with open(commitPath) as f:
+            finish_commit(targetDir, f.read())
+        return
+    if os.path.exists(commitPath + '.tmp'):
+        os.remove(commitPath + '.tmp')
+    oldDir = targetDir + OLD_SUFFIX
+    if os.path.exists(oldDir):
+        if os.path.exists(targetDir):
+            shutil.rmtree(oldDir)
+        else:
+            os.rename(oldDir, targetDir)
+    if os.path.exists(targetDir + STAGED_SUFFIX):
+        shutil.rmtree(targetDir + STAGED_SUFFIX)
+
+def finish_commit(targetDir, stagedDir):
+    targetDir = os.path.abspath(targetDir)
+    commitPath = targetDir + COMMIT_SUFFIX
+    oldDir = targetDir + OLD_SUFFIX
+    # if the shadow tree is gone, it's already in place
+    if os.path.exists(stagedDir):
+        if os.path.exists(targetDir):
+            if os.path.exists(oldDir):
+                shutil.rmtree(oldDir)
+            try:
+                os.rename(targetDir, oldDir)
+            except OSError:
+                os.remove(commitPath)
+                raise
+        try:
+            os.rename(stagedDir, targetDir)
+        except OSError:
+            if os.path.exists(oldDir):
+                os.rename(oldDir, targetDir)
+            os.remove(commitPath)
+            raise
+    os.remove(commitPath)
+    if os.path.exists(oldDir):
+        shutil.rmtree(oldDir)
+
+
+class IndexEntry(collections.namedtuple('IndexEntry', ['operation', 'path', 'checksumOld', 'checksumNew', 'source', 'payload'])):
+    """<source> is the old path of a renamed or copied file, otherwise empty.
+        For these, <checksumOld> is the checksum of the source.
+        <payload> is the SHA-1 hex digest of the file in the files directory, if any."""
+    __slots__ = ()
+
+    def __new__(cls, operation, path, checksumOld, checksumNew, source='', payload=''):
+        return super(IndexEntry, cls).__new__(cls, operation, path, checksumOld, checksumNew, source, payload)
+
+INDEX_MAGIC = 'BDPI'
+INDEX_VERSION = 3
+INDEX_HEADER = struct.Struct('<4sBI')
+INDEX_RECORD = struct.Struct('<cIIHHB')
+
+def write_index(patchDir, entries):
+    """Writes the index, sorted by path. The binary format is a header (magic, version, number of
+        entries) followed by one record per entry: operation, checksumOld, checksumNew and the
+        lengths of path, source and payload, followed by the path, the source and the binary
+        payload digest themselves."""
+    entries = sorted(entries, key=lambda entry: entry.path)
+    data = [INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(entries))]
+    for entry in entries:
+        payload = binascii.unhexlify(entry.payload)
+        data.append(INDEX_RECORD.pack(entry.operation, entry.checksumOld, entry.checksumNew,
+                                      len(entry.path), len(entry.source), len(payload)))
+        data.append(entry.path)
+        data.append(entry.source)
+        data.append(payload)
+    with open(os.path.join(patchDir, 'index'), 'wb') as indexFile:
+        indexFile.write(''.join(data))
+
+def write_patch_file(patchDir, newDir, entries, patchFilePath, blobCache=None):
+    """Writes the patch file: a container with the index and every payload the entries refer to.
+        The payloads are compressed by the worker processes, each with its own codec (see
+        container.choose_codec). Added files are compressed straight from <newDir>.
+        Payloads that are already in <blobCache> aren't compressed again, new ones are added to it.
+        The entries are written in digest order, so the result doesn't depend on the scheduling
+        or on the content of the cache."""
+    print 'Compressing patch...'
+    sources = {}
+    for entry in entries:
+        if entry.operation == 'A':
+            sources.setdefault(entry.payload, os.path.join(newDir, entry.path))
+        elif entry.payload:
+            sources[entry.payload] = payload_path(patchDir, entry.payload)
+    packedDir = os.path.join(patchDir, 'packed')
+    mkdir_if_not_exists(packedDir)
+
+    blobs = {}
+    work = []
+    for (digest, sourcePath) in sources.items():
+        blob = find_blob(blobCache, digest) if blobCache is not None else None
+        if blob is not None:
+            blobs[digest] = blob
+        else:
+            work.append( (sourcePath, os.path.join(packedDir, digest), None) )
+    print_verbose(1, str(len(blobs)) + ' payloads from the blob cache, ' + str(len(work)) + ' to compress')
+
+    # biggest files first, see _diff_dirs
+    work.sort(key=lambda (sourcePath, packedPath, codec): (os.path.getsize(sourcePath), packedPath), reverse=True)
+    pool = create_pool(NUM_WORKERS)
+    try:
+        with instrument.phase('compress'):
+            if pool is None:
+                results = map(compress_payload, work)
+            else:
+                results = instrument.collect(pool.map(instrument.traced(compress_payload), work, 1))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    for ((sourcePath, packedPath, requestedCodec), (size, codec)) in zip(work, results):
+        digest = os.path.basename(packedPath)
+        if blobCache is not None:
+            blobs[digest] = add_blob(blobCache, digest, packedPath, codec)
+        else:
+            blobs[digest] = (packedPath, codec)
+
+    with ContainerWriter(patchFilePath) as patchFile:
+        patchFile.add_file('index', os.path.join(patchDir, 'index'))
+        for digest in sorted(sources):
+            (blobPath, codec) = blobs[digest]
+            print_verbose(2, '    ' + payload_name(digest) + ' ' + CODEC_NAMES[codec])
+            patchFile.add_packed(payload_name(digest), blobPath, os.path.getsize(sources[digest]), codec)
+            if blobCache is None:
+                os.remove(blobPath)
+
+def compress_payload(work):
+    """Compresses a payload with pack_file, see write_patch_file"""
+    start = time.time()
+    (size, codec) = pack_file(work)
+    packedSize = os.path.getsize(work[1])
+    instrument.record_file('compress', work[0], time.time() - start, size, packedSize, instrument.ratio(packedSize, size))
+    return (size, codec)
 
+def blob_path(blobCache, digest, codec):
+    """Compressed payloads are stored like the content store, with the codec as extension."""
+    return content_store_path(blobCache, digest) + '.' + CODEC_NAMES[codec]
 
-def validate_checksum_pre(path, expectedChecksum):
-    if checksum(path) != expectedChecksum:
-        raise ChecksumException(path, expectedChecksum, checksum(path))
+def find_blob(blobCache, digest):
+    """Returns the (path, codec) tuple of the payload in the blob cache, or None."""
+    for codec in sorted(CODEC_NAMES):
+        path = blob_path(blobCache, digest, codec)
+        if os.path.isfile(path):
+            return (path, codec)
+    return None
+
+def add_blob(blobCache, digest, packedPath, codec):
+    """Moves a payload compressed by pack_file into the blob cache, returns its (path, codec) tuple."""
+    path = blob_path(blobCache, digest, codec)
+    mkdir_if_not_exists(os.path.dirname(path))
+    shutil.move(packedPath, path)
+    return (path, codec)
+
+def prune_blob_cache(blobCache, digests):
+    """Removes all blobs except the ones for <digests>."""
+    if not os.path.isdir(blobCache):
+        return
+    for dirName in os.listdir(blobCache):
+        for name in os.listdir(os.path.join(blobCache, dirName)):
+            if name.split('.', 1)[0] not in digests:
+                os.remove(os.path.join(blobCache, dirName, name))
+
+def read_index(patchFile):
+    """Reads the index from the patch file with a single read. Returns a PatchIndex."""
+    data = patchFile.read('index')
+    (magic, version, count) = INDEX_HEADER.unpack_from(data, 0)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+        raise PatchException(['Unsupported index format'])
+    entries = []
+    offset = INDEX_HEADER.size
+    for i in xrange(count):
+        (operation, checksumOld, checksumNew, pathLength, sourceLength, payloadLength) = \
+            INDEX_RECORD.unpack_from(data, offset)
+        offset += INDEX_RECORD.size
+        path = data[offset:offset + pathLength]
+        offset += pathLength
+        source = data[offset:offset + sourceLength]
+        offset += sourceLength
+        payload = binascii.hexlify(data[offset:offset + payloadLength])
+        offset += payloadLength
+        entries.append(IndexEntry(operation, path, checksumOld, checksumNew, source, payload))
+    return PatchIndex(entries)
+
+class PatchIndex:
+    """The entries of a patch index, sorted by path."""
+    def __init__(self, entries):
+        self.entries = entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
 
-def validate_checksum_post(path, expectedChecksum):
-    if checksum(path) != expectedChecksum:
-        print 'WARNING: File ' + path + ' is corrupted! Please reinstall the full release.'
 
 def checksum(path):
-    with open(path, 'r') as f:
-        return zlib.adler32(f.read())
+    result = 1
+    for chunk in read_chunks(path):
+        result = zlib.adler32(chunk, result)
+    return result & 0xffffffff
+
+def hash_file(path):
+    """Returns the (checksum, digest) tuple of a file: the Adler32 checksum
+        used in the index and the SHA-1 hex digest used in manifests."""
+    checksumResult = 1
+    digest = hashlib.sha1()
+    for chunk in read_chunks(path):
+        checksumResult = zlib.adler32(chunk, checksumResult)
+        digest.update(chunk)
+    return (checksumResult & 0xffffffff, digest.hexdigest())
+
+def compare_files(pathA, pathB):
+    """Compares two files and calculates both hashes (see hash_file) in a single pass.
+        Returns an (equal, hashA, hashB) tuple."""
+    equal = True
+    checksumA = 1
+    checksumB = 1
+    digestA = hashlib.sha1()
+    digestB = hashlib.sha1()
+    for (chunkA, chunkB) in itertools.izip_longest(read_chunks(pathA), read_chunks(pathB)):
+        if chunkA != chunkB:
+            equal = False
+        if chunkA is not None:
+            checksumA = zlib.adler32(chunkA, checksumA)
+            digestA.update(chunkA)
+        if chunkB is not None:
+            checksumB = zlib.adler32(chunkB, checksumB)
+            digestB.update(chunkB)
+    return (equal, (checksumA & 0xffffffff, digestA.hexdigest()), (checksumB & 0xffffffff, digestB.hexdigest()))
+
+def read_chunks(path):
+    """Yields the content of the file at <path> in blocks of CHUNK_SIZE bytes.
+        The file is memory-mapped, so memory use doesn't depend on the file size."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in xrange(0, size, CHUNK_SIZE):
+                yield data[offset:offset + CHUNK_SIZE]
+        finally:
+            data.close()
 
 class ChecksumException(Exception):
     def __init__(self, path, expected, actual):
@@ -236,21 +1348,27 @@ class ChecksumException(Exception):
             ' (' + str(self.actual) + ' instead of ' + str(self.expected) + ').' + \
             ' Please reinstall the full release.'
 
+class PatchException(Exception):
+    def __init__(self, errors):
+        self.errors = errors
+
+    def msg(self):
+        return 'Failed to apply patch:\n    ' + '\n    '.join(self.errors) + \
+            '\nPlease reinstall the full release.'
+
 
 def validate_environment():
-    if not os.path.exists(BSDIFF_EXE):
-        print "Couldn't find bsdiff at path: " + BSDIFF_EXE
-        print "Please download from http://sites.inka.de/tesla/download/bsdiff4.3-win32.zip"
-        return False
-    if not os.path.exists(BSPATCH_EXE):
-        print "Couldn't find bspatch at path: " + BSPATCH_EXE
-        print "Please download from http://sites.inka.de/tesla/download/bsdiff4.3-win32.zip"
-        return False
-    if not os.path.exists(SEVENZIP_EXE):
-        print "Couldn't find 7zip at path: " + SEVENZIP_EXE
-        print "Please download from http://www.7-zip.org/a/7z1507-extra.7z"
-        return False
-    
+    if utils.DIFF_BACKEND == 'exe':
+        if not os.path.exists(BSDIFF_EXE):
+            print "Couldn't find bsdiff at path: " + BSDIFF_EXE
+            print "Please download from http://sites.inka.de/tesla/download/bsdiff4.3-win32.zip"
+            print "or use the built-in diff engine with --backend=python"
+            return False
+        if not os.path.exists(BSPATCH_EXE):
+            print "Couldn't find bspatch at path: " + BSPATCH_EXE
+            print "Please download from http://sites.inka.de/tesla/download/bsdiff4.3-win32.zip"
+            print "or use the built-in diff engine with --backend=python"
+            return False
     return True
 
 
@@ -279,10 +1397,12 @@ def parseExtraArgs(i):
     _parseExtraArgs(i)
     if VERBOSITY_LEVEL > 0 and NUM_WORKERS > 1:
         print 'WARNING: There will be no verbose log output when using multiple workers.'
+        print '         Use --report=<file> to get the timings of every file.'
 
 def _parseExtraArgs(i):
     global VERBOSITY_LEVEL
     global NUM_WORKERS
+    global OLD_MANIFEST, NEW_MANIFEST, CONTENT_STORE
     if i < len(sys.argv):
         if sys.argv[i] == '-v':            
             VERBOSITY_LEVEL = 1
@@ -293,6 +1413,27 @@ def _parseExtraArgs(i):
         elif sys.argv[i][0:2] == '-j':
             NUM_WORKERS = int(sys.argv[i][2:])
             print 'Workers: ' + str(NUM_WORKERS)
+        elif sys.argv[i].startswith('--backend='):
+            backend = sys.argv[i].split('=', 1)[1]
+            if backend not in utils.DIFF_BACKENDS:
+                print 'unknown diff backend ' + backend
+                usage()
+            utils.set_diff_backend(backend)
+            print 'Diff backend: ' + backend
+        elif sys.argv[i].startswith('--manifest-old='):
+            OLD_MANIFEST = sys.argv[i].split('=', 1)[1]
+        elif sys.argv[i].startswith('--manifest-new='):
+            NEW_MANIFEST = sys.argv[i].split('=', 1)[1]
+        elif sys.argv[i].startswith('--store='):
+            CONTENT_STORE = sys.argv[i].split('=', 1)[1]
+        elif sys.argv[i].startswith('--chunk-delta='):
+            utils.set_chunk_delta(int(sys.argv[i].split('=', 1)[1]) * 1024 * 1024, utils.CHUNK_DELTA_MEMORY)
+        elif sys.argv[i].startswith('--delta-memory='):
+            utils.set_chunk_delta(utils.CHUNK_DELTA_SIZE, int(sys.argv[i].split('=', 1)[1]) * 1024 * 1024)
+        elif sys.argv[i].startswith('--report='):
+            instrument.set_report(sys.argv[i].split('=', 1)[1])
+        elif sys.argv[i].startswith('--profile='):
+            instrument.set_profile(sys.argv[i].split('=', 1)[1])
         else:
             print 'unrecognized argument ' + sys.argv[i]
             usage()
@@ -302,12 +1443,23 @@ def usage():
     print 'Wrong arguments. Usage:'
     print '    bindirpatch.py diff <oldDir> <newDir> <outDir> [switch args]'
     print 'or'
-    print '    bindirpatch.py patch <patchFile> <targetDir> [switch args]'
+    print '    bindirpatch.py patch <patchFile> [<patchFile>...] <targetDir> [switch args]'
+    print '    (several consecutive patches are applied in one go)'
     print ''
     print 'Switch Args: '
     print '-v   Print more status messages'
     print '-vv  Print a lot of status messages (only for debugging)'
     print '-j#  Parallel processing. Replace # with the number of desired worker threads'
+    print '--backend=exe|python  Use bsdiff.exe/bspatch.exe or the built-in diff engine'
+    print '--manifest-old=<file>  Manifest of <oldDir>, unchanged files are not read again (diff only)'
+    print '--manifest-new=<file>  Write the manifest of <newDir> to this file (diff only)'
+    print '--store=<dir>  Content store for the files of <newDir>. With --manifest-old, <oldDir>'
+    print '               may be missing and is restored from the store (diff only)'
+    print '--chunk-delta=<MB>  Files of at least this size get a chunk delta instead of bsdiff, default: 256'
+    print '                    (--delta-memory / 100 with --backend=python) (diff only)'
+    print '--delta-memory=<MB>  Memory per worker for chunk deltas (diff only)'
+    print '--report=<file>  Write the time and bytes of every phase and file to a JSON report (CSV if <file> ends with .csv)'
+    print '--profile=<file>  Write cProfile statistics of the main process to <file>'
     sys.exit(1)
 
 if __name__ == '__main__':
@@ -322,15 +1474,21 @@ if __name__ == '__main__':
         newDir = sys.argv[3]
         patchDir = sys.argv[4]
         parseExtraArgs(5)
-        create_patch(oldDir, newDir, patchDir)
+        instrument.run(create_patch, oldDir, newDir, patchDir, OLD_MANIFEST, NEW_MANIFEST, CONTENT_STORE)
         
     elif operation == 'patch':
         if len(sys.argv) < 4:
             usage()
-        patchFile = sys.argv[2]
-        targetDir = sys.argv[3]
-        parseExtraArgs(4)
-        apply_patch(patchFile, targetDir)
+        numPaths = 2
+        while 2 + numPaths < len(sys.argv) and not sys.argv[2 + numPaths].startswith('-'):
+            numPaths += 1
+        patchFiles = sys.argv[2:1 + numPaths]
+        targetDir = sys.argv[1 + numPaths]
+        parseExtraArgs(2 + numPaths)
+        if len(patchFiles) == 1:
+            instrument.run(apply_patch, patchFiles[0], targetDir)
+        else:
+            instrument.run(apply_patches, patchFiles, targetDir)
     else:
         usage()
 
@@ -0,0 +1,261 @@
+import os
+import struct
+import hashlib
+import binascii
+import collections
+import mmap
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+    Block checksums of a release, for rebuilding it from the files that are already on disk
+    (like zsync).
+
+    deploy publishes a block map of the latest release: for each file, its size, SHA-1 digest,
+    block size and, for every block, a weak rolling checksum (the one of rsync) and the first
+    bytes of the SHA-1 of the block as strong checksum. A client that has an older or damaged
+    copy of the release scans its local file with the rolling checksum, so matching blocks are
+    found at any offset, and only downloads the byte ranges that aren't found locally.
+
+    The binary format is a header (magic, version, release version, number of files) followed
+    by one record per file: size, block size, digest and the length of the path, the path
+    itself and the block checksums.
+
+    The rolling checksums of a whole buffer are computed at once with NumPy if it is available,
+    otherwise the checksum is rolled forward one byte at a time (much slower).
+"""
+
+MAGIC = 'BDPB'
+VERSION = 1
+HEADER = struct.Struct('<4sBII')
+FILE_RECORD = struct.Struct('<QI20sH')
+BLOCK_RECORD = struct.Struct('<I8s')
+MIN_BLOCK_SIZE = 4096
+# bytes of the local file that are scanned at once
+SCAN_SIZE = 1024 * 1024
+# missing ranges that are closer than this are downloaded as one range
+MIN_RANGE_GAP = 64 * 1024
+
+class BlockMapEntry(collections.namedtuple('BlockMapEntry', ['path', 'size', 'digest', 'blockSize', 'blocks'])):
+    """<blocks> holds the packed (weak, strong) checksums of all blocks, see BLOCK_RECORD."""
+    __slots__ = ()
+
+    def num_blocks(self):
+        return (self.size + self.blockSize - 1) / self.blockSize
+
+    def block(self, i):
+        """Returns the (weak, strong) checksums of block <i>"""
+        return BLOCK_RECORD.unpack_from(self.blocks, i * BLOCK_RECORD.size)
+
+    def block_length(self, i):
+        return min(self.blockSize, self.size - i * self.blockSize)
+
+
+def block_size(size):
+    """About the square root of the file size (as rsync does), so big files don't get huge
+        block lists. Always a power of two."""
+    result = MIN_BLOCK_SIZE
+    while result * result < size:
+        result *= 2
+    return result
+
+def file_blocks((path, blockSize)):
+    """Returns the packed block checksums of the file at <path>"""
+    data = []
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), ''):
+            data.append(BLOCK_RECORD.pack(weak_checksum(block), strong_checksum(block)))
+    return ''.join(data)
+
+def weak_checksum(block):
+    """The rsync checksum: the sum of the bytes and the sum of the sums, 16 bits each"""
+    length = len(block)
+    if numpy is not None:
+        x = numpy.frombuffer(block, dtype=numpy.uint8).astype(numpy.int64)
+        a = int(x.sum())
+        b = int(numpy.dot(numpy.arange(length, 0, -1, dtype=numpy.int64), x))
+    else:
+        a = 0
+        b = 0
+        for (i, x) in enumerate(bytearray(block)):
+            a += x
+            b += (length - i) * x
+    return (a & 0xffff) | ((b & 0xffff) << 16)
+
+def strong_checksum(block):
+    return hashlib.sha1(block).digest()[0:8]
+
+def rolling_checksums(data, blockSize):
+    """Returns the weak checksums of all len(data) - blockSize + 1 windows of <data>"""
+    x = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int64)
+    s = numpy.zeros(len(x) + 1, dtype=numpy.int64)
+    numpy.cumsum(x, out=s[1:])
+    t = numpy.zeros(len(x) + 1, dtype=numpy.int64)
+    numpy.cumsum(x * numpy.arange(len(x), dtype=numpy.int64), out=t[1:])
+    start = numpy.arange(len(x) - blockSize + 1, dtype=numpy.int64)
+    a = s[blockSize:] - s[:-blockSize]
+    b = (start + blockSize) * a - (t[blockSize:] - t[:-blockSize])
+    return ((a & 0xffff) | ((b & 0xffff) << 16)).astype(numpy.uint32)
+
+
+def write_block_map(path, version, entries):
+    """Writes the BlockMapEntry list of release <version> to <path>"""
+    with open(path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, version, len(entries)))
+        for entry in sorted(entries):
+            f.write(FILE_RECORD.pack(entry.size, entry.blockSize, binascii.unhexlify(entry.digest), len(entry.path)))
+            f.write(entry.path)
+            f.write(entry.blocks)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(path + '.tmp', path)
+
+def read_block_map(path):
+    """Reads a block map written by write_block_map. Returns the (version, entries) tuple."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        (magic, version, releaseVersion, count) = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise BlockMapException('Unsupported block map format')
+        entries = []
+        offset = HEADER.size
+        for i in xrange(count):
+            (size, blockSize, digest, pathLength) = FILE_RECORD.unpack_from(data, offset)
+            offset += FILE_RECORD.size
+            path = data[offset:offset + pathLength]
+            offset += pathLength
+            entry = BlockMapEntry(path, size, binascii.hexlify(digest), blockSize, '')
+            blocksLength = entry.num_blocks() * BLOCK_RECORD.size
+            entries.append(entry._replace(blocks=data[offset:offset + blocksLength]))
+            offset += blocksLength
+            if offset > len(data):
+                raise BlockMapException('Truncated block map')
+    except struct.error:
+        raise BlockMapException('Corrupt block map')
+    return (releaseVersion, entries)
+
+
+def match_blocks(seedPath, entry):
+    """Looks for the blocks of <entry> anywhere in the local file at <seedPath>.
+        Returns a list with the offset in the seed file for each block, or None for blocks
+        that weren't found."""
+    sources = [None] * entry.num_blocks()
+    seedSize = os.path.getsize(seedPath)
+    if seedSize == 0 or len(sources) == 0:
+        return sources
+    blockSize = entry.blockSize
+    with open(seedPath, 'rb') as f:
+        seed = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            fullBlocks = entry.size / blockSize
+            blocks = {}
+            for i in xrange(fullBlocks):
+                (weak, strong) = entry.block(i)
+                blocks.setdefault(weak, []).append((strong, i))
+            if len(blocks) > 0 and seedSize >= blockSize:
+                if numpy is not None:
+                    _scan_numpy(seed, seedSize, blockSize, blocks, sources)
+                else:
+                    _scan_python(seed, seedSize, blockSize, blocks, sources)
+
+            # the last block may be shorter, it's only looked for behind the block before it,
+            # at the end of the seed file and at its own offset
+            if fullBlocks < len(sources):
+                length = entry.block_length(fullBlocks)
+                candidates = [seedSize - length, fullBlocks * blockSize]
+                if fullBlocks > 0 and sources[fullBlocks - 1] is not None:
+                    candidates.insert(0, sources[fullBlocks - 1] + blockSize)
+                for offset in candidates:
+                    if 0 <= offset <= seedSize - length and \
+                            strong_checksum(seed[offset:offset + length]) == entry.block(fullBlocks)[1]:
+                        sources[fullBlocks] = offset
+                        break
+        finally:
+            seed.close()
+    return sources
+
+def _match(seed, pos, blockSize, candidates, sources):
+    """Checks the strong checksums of the blocks with the same weak checksum as the window at <pos>"""
+    strong = strong_checksum(seed[pos:pos + blockSize])
+    found = False
+    for (blockStrong, i) in candidates:
+        if blockStrong == strong:
+            found = True
+            if sources[i] is None:
+                sources[i] = pos
+    return found
+
+def _scan_numpy(seed, seedSize, blockSize, blocks, sources):
+    weaks = numpy.array(sorted(blocks), dtype=numpy.uint32)
+    skipUntil = 0
+    for start in xrange(0, seedSize - blockSize + 1, SCAN_SIZE):
+        checksums = rolling_checksums(seed[start:start + SCAN_SIZE + blockSize - 1], blockSize)
+        for pos in numpy.nonzero(numpy.in1d(checksums, weaks))[0]:
+            pos = start + int(pos)
+            # after a match, the next block most likely starts right behind it
+            if pos >= skipUntil and _match(seed, pos, blockSize, blocks[int(checksums[pos - start])], sources):
+                skipUntil = pos + blockSize
+
+def _scan_python(seed, seedSize, blockSize, blocks, sources):
+    data = bytearray(seed[0:blockSize])
+    a = sum(data)
+    b = sum((blockSize - i) * x for (i, x) in enumerate(data))
+    pos = 0
+    while True:
+        weak = (a & 0xffff) | ((b & 0xffff) << 16)
+        if weak in blocks and _match(seed, pos, blockSize, blocks[weak], sources):
+            pos += blockSize
+            if pos + blockSize > seedSize:
+                return
+            data = bytearray(seed[pos:pos + blockSize])
+            a = sum(data)
+            b = sum((blockSize - i) * x for (i, x) in enumerate(data))
+            continue
+        if pos + blockSize >= seedSize:
+            return
+        old = ord(seed[pos])
+        new = ord(seed[pos + blockSize])
+        a += new - old
+        b += a - blockSize * old
+        pos += 1
+
+
+def plan_file(entry, sources):
+    """Turns the result of match_blocks into a list of (offset, length, seedOffset) segments
+        that make up the file. Segments with seedOffset None have to be downloaded. Short copies
+        between two downloads are downloaded as well, to save round trips."""
+    segments = []
+    for i in xrange(len(sources)):
+        offset = i * entry.blockSize
+        length = entry.block_length(i)
+        if len(segments) > 0:
+            (lastOffset, lastLength, lastSource) = segments[-1]
+            if (lastSource is None and sources[i] is None) or \
+                    (lastSource is not None and sources[i] == lastSource + lastLength):
+                segments[-1] = (lastOffset, lastLength + length, lastSource)
+                continue
+        segments.append( (offset, length, sources[i]) )
+
+    result = []
+    for segment in segments:
+        if len(result) >= 2 and result[-2][2] is None and segment[2] is None and result[-1][1] < MIN_RANGE_GAP:
+            result[-2:] = [(result[-2][0], result[-2][1] + result[-1][1] + segment[1], None)]
+        else:
+            result.append(segment)
+    return result
+
+def missing_bytes(segments):
+    return sum(length for (offset, length, seedOffset) in segments if seedOffset is None)
+
+
+class BlockMapException(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+        self.message = msg
+
+    def msg(self):
+        return self.message
@@ -0,0 +1,210 @@
+import os
+import struct
+import hashlib
+
+from blockmap import numpy, rolling_checksums, weak_checksum
+from delta import DeltaException
+
+"""
+    Delta of content-defined chunks, for files that are too big for bsdiff.
+
+    Both files are cut into chunks where a rolling hash of the last WINDOW bytes hits a
+    boundary value, so an insertion only changes the chunks around it and the following
+    boundaries are found again. The chunks of the old file are indexed by their SHA-1 digest,
+    then each chunk of the new file is either copied from the old file (consecutive copies
+    are merged) or inserted literally.
+
+    Both files are streamed through a buffer of fixed size. The average chunk size grows
+    with the size of the old file, so that the index of its chunks stays within the memory
+    budget (see chunk_params). Unlike bsdiff, the memory use doesn't depend on the file size.
+
+    A delta starts with MAGIC and the size of the new file, followed by the operations:
+    'C' with the offset and length in the old file, or 'I' with the length and the data.
+    Deltas are applied in a single pass over the delta, with random access to the old file.
+"""
+
+MAGIC = 'BDPCHUNK'
+HEADER = struct.Struct('<8sQ')
+COPY = struct.Struct('<cQQ')
+INSERT = struct.Struct('<cQ')
+LENGTHS = struct.Struct('<QQ')
+LENGTH = struct.Struct('<Q')
+WINDOW = 48
+MIN_AVERAGE_CHUNK = 8 * 1024
+# approximate memory used per chunk of the old file in the index
+INDEX_ENTRY_SIZE = 160
+# approximate memory used per byte of the buffer while searching for boundaries
+BUFFER_OVERHEAD = 64
+IO_BLOCK_SIZE = 1024 * 1024
+
+def chunk_params(oldSize, memoryBudget):
+    """Returns the (averageChunk, bufferSize) tuple for a delta against an old file of <oldSize>
+        bytes. Half of the budget is for the index of the old file, half for the buffer."""
+    average = MIN_AVERAGE_CHUNK
+    while oldSize / average * INDEX_ENTRY_SIZE > memoryBudget / 2:
+        average *= 2
+    # the buffer must hold several chunks of the maximum size (4 * average)
+    return (average, max(memoryBudget / 2 / BUFFER_OVERHEAD, average * 16))
+
+def diff_file(oldFile, newFile, patchFile, memoryBudget):
+    """Creates a chunk delta between <oldFile> and <newFile> and stores it in <patchFile>"""
+    (average, bufferSize) = chunk_params(os.path.getsize(oldFile), memoryBudget)
+    index = {}
+    with open(oldFile, 'rb') as f:
+        for (offset, chunk) in chunks(f, average, bufferSize):
+            index.setdefault(hashlib.sha1(chunk).digest(), offset)
+
+    with open(newFile, 'rb') as f:
+        with open(patchFile, 'wb') as outFile:
+            outFile.write(HEADER.pack(MAGIC, os.fstat(f.fileno()).st_size))
+            copy = None
+            for (offset, chunk) in chunks(f, average, bufferSize):
+                oldOffset = index.get(hashlib.sha1(chunk).digest())
+                if oldOffset is not None and copy is not None and copy[0] + copy[1] == oldOffset:
+                    copy = (copy[0], copy[1] + len(chunk))
+                    continue
+                if copy is not None:
+                    outFile.write(COPY.pack('C', copy[0], copy[1]))
+                    copy = None
+                if oldOffset is not None:
+                    copy = (oldOffset, len(chunk))
+                else:
+                    outFile.write(INSERT.pack('I', len(chunk)))
+                    outFile.write(chunk)
+            if copy is not None:
+                outFile.write(COPY.pack('C', copy[0], copy[1]))
+
+def patch_file(oldFile, newFile, patchFile):
+    """Applies the chunk delta <patchFile> to <oldFile> and writes the result to <newFile>"""
+    with open(patchFile, 'rb') as f:
+        with open(newFile, 'wb') as outFile:
+            patch_stream(oldFile, outFile, iter(lambda: f.read(IO_BLOCK_SIZE), ''))
+
+def patch_stream(oldFile, outFile, patchChunks):
+    """Applies the chunk delta, given as blocks of any size, to <oldFile> and writes the result to <outFile>"""
+    reader = _Reader(patchChunks)
+    header = reader.read(HEADER.size)
+    if len(header) < HEADER.size or not header.startswith(MAGIC):
+        raise DeltaException('Corrupt patch: invalid header')
+    newSize = HEADER.unpack(header)[1]
+    written = 0
+    with open(oldFile, 'rb') as f:
+        oldSize = os.fstat(f.fileno()).st_size
+        while True:
+            operation = reader.read(1)
+            if operation == '':
+                break
+            if operation == 'C':
+                (oldOffset, length) = LENGTHS.unpack(_read_exactly(reader, LENGTHS.size))
+                if oldOffset + length > oldSize:
+                    raise DeltaException('Corrupt patch: copy exceeds the old file')
+                f.seek(oldOffset)
+                source = f
+            elif operation == 'I':
+                length = LENGTH.unpack(_read_exactly(reader, LENGTH.size))[0]
+                source = reader
+            else:
+                raise DeltaException('Corrupt patch: unknown operation')
+            written += length
+            if written > newSize:
+                raise DeltaException('Corrupt patch: output size mismatch')
+            while length > 0:
+                block = _read_exactly(source, min(length, IO_BLOCK_SIZE))
+                outFile.write(block)
+                length -= len(block)
+    if written != newSize:
+        raise DeltaException('Corrupt patch: output size mismatch')
+
+def is_chunk_delta_file(patchFile):
+    with open(patchFile, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def chunks(f, average, bufferSize):
+    """Cuts the file <f> into content-defined chunks, yields (offset, chunk) tuples"""
+    offset = 0
+    data = ''
+    eof = False
+    while not eof or len(data) > 0:
+        if not eof:
+            block = f.read(bufferSize - len(data))
+            eof = len(block) == 0
+            data += block
+        start = 0
+        for cut in cut_points(data, average, eof):
+            yield (offset + start, data[start:cut])
+            start = cut
+        offset += start
+        data = data[start:]
+
+def cut_points(data, average, final):
+    """Returns the chunk boundaries in <data>, which starts at a boundary. Chunks are at least
+        average / 4 and at most average * 4 bytes long. Unless <final> is set, the data after
+        the last boundary is left for the next call, as it may continue in the next buffer."""
+    minSize = average / 4
+    maxSize = average * 4
+    candidates = _candidates(data, (1 << 32) / average)
+    result = []
+    last = 0
+    i = 0
+    while True:
+        while i < len(candidates) and candidates[i] < last + minSize:
+            i += 1
+        if i < len(candidates) and candidates[i] <= last + maxSize:
+            last = candidates[i]
+        elif last + maxSize <= len(data):
+            last += maxSize
+        else:
+            break
+        result.append(last)
+    if final and last < len(data):
+        result.append(len(data))
+    return result
+
+def _candidates(data, threshold):
+    """Positions behind every window of WINDOW bytes whose mixed rolling checksum is below
+        <threshold>, in ascending order"""
+    if len(data) < WINDOW:
+        return []
+    if numpy is not None:
+        mixed = (rolling_checksums(data, WINDOW).astype(numpy.uint64) * 0x9E3779B1) & 0xffffffff
+        return (numpy.nonzero(mixed < threshold)[0] + WINDOW).tolist()
+    result = []
+    block = bytearray(data[0:WINDOW])
+    a = sum(block)
+    b = weak_checksum(data[0:WINDOW]) >> 16
+    pos = WINDOW
+    while True:
+        if (((a & 0xffff) | ((b & 0xffff) << 16)) * 0x9E3779B1) & 0xffffffff < threshold:
+            result.append(pos)
+        if pos >= len(data):
+            return result
+        old = ord(data[pos - WINDOW])
+        a += ord(data[pos]) - old
+        b += a - WINDOW * old
+        pos += 1
+
+
+def _read_exactly(reader, size):
+    data = reader.read(size)
+    if len(data) != size:
+        raise DeltaException('Corrupt patch: unexpected end of data')
+    return data
+
+class _Reader:
+    """File-like access to an iterator of blocks"""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.offset = 0
+
+    def read(self, size):
+        while len(self.buffer) - self.offset < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer = self.buffer[self.offset:] + chunk
+            self.offset = 0
+        result = self.buffer[self.offset:self.offset + size]
+        self.offset += len(result)
+        return result
@@ -0,0 +1,290 @@
+import os
+import struct
+import zlib
+import bz2
+import math
+import mmap
+import shutil
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+"""
+    Single-file container for patches.
+
+    Unlike a 7z archive, the entries can be read directly from the container file without
+    extracting it first. The file starts with a header (magic, version, offset of the table
+    of contents and number of entries), followed by the individually compressed entries.
+    The table of contents at the end of the file has one record per entry, sorted by name:
+    offset and compressed size in the container, uncompressed size, codec and the name itself.
+
+    The container is memory-mapped for reading, so only the parts that are actually used
+    are read from disk.
+
+    Each entry has its own codec (store, zlib or bz2), chosen by choose_codec from the byte
+    entropy of a few samples of the file: already compressed data (images, audio, archives,
+    bsdiff patches) is stored as is, everything else with bz2. lzma is not picked because the
+    clients may not have it; lzma entries of older containers can still be read if the module
+    is available (Python 3 or the backports.lzma package). Entries can be compressed by worker
+    processes with pack_file and added with ContainerWriter.add_packed; the result only
+    depends on the content, not on the number of workers.
+"""
+
+MAGIC = 'BDPC'
+VERSION = 1
+HEADER = struct.Struct('<4sBQI')
+TOC_RECORD = struct.Struct('<QQQBH')
+CHUNK_SIZE = 1024 * 1024
+
+# codecs
+STORE = 0
+ZLIB = 1
+BZ2 = 2
+LZMA = 3
+CODEC_NAMES = {STORE: 'store', ZLIB: 'zlib', BZ2: 'bz2', LZMA: 'lzma'}
+# codec policy, see choose_codec
+SAMPLE_SIZE = 64 * 1024
+NUM_SAMPLES = 4
+SMALL_ENTRY_SIZE = 4096
+STORE_ENTROPY = 7.5
+
+class ContainerWriter:
+    """Writes a container to <path>. Entries are stored in the order they are added."""
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+        self.entries = []
+        self.names = set()
+
+    def add_file(self, name, filePath, codec=None):
+        """Compresses the file with <codec> (default: see choose_codec) and adds it"""
+        if codec is None:
+            codec = choose_codec(filePath)
+        with open(filePath, 'rb') as f:
+            self._write(name, iter(lambda: f.read(CHUNK_SIZE), ''), codec)
+
+    def add_packed(self, name, packedPath, size, codec):
+        """Adds an entry that was already compressed by pack_file"""
+        with open(packedPath, 'rb') as f:
+            self._write(name, iter(lambda: f.read(CHUNK_SIZE), ''), codec, size)
+
+    def _write(self, name, chunks, codec, size=None):
+        if name in self.names:
+            raise ContainerException('Duplicate entry ' + name)
+        offset = self.file.tell()
+        if size is None:
+            size = _compress(chunks, self.file, codec)
+        else:
+            for chunk in chunks:
+                self.file.write(chunk)
+        self.entries.append((name, offset, self.file.tell() - offset, size, codec))
+        self.names.add(name)
+
+    def close(self):
+        tocOffset = self.file.tell()
+        for (name, offset, packedSize, size, codec) in sorted(self.entries):
+            self.file.write(TOC_RECORD.pack(offset, packedSize, size, codec, len(name)))
+            self.file.write(name)
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, tocOffset, len(self.entries)))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class Container:
+    """Read access to the container at <path>."""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            self.file.close()
+            raise ContainerException('Not a patch container: ' + path)
+        self.entries = {}
+        try:
+            self._read_toc()
+        except (struct.error, ContainerException):
+            self.close()
+            raise ContainerException('Not a patch container or corrupt: ' + path)
+
+    def _read_toc(self):
+        (magic, version, offset, count) = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ContainerException('Unsupported container format')
+        for i in xrange(count):
+            (entryOffset, packedSize, size, codec, nameLength) = TOC_RECORD.unpack_from(self.data, offset)
+            offset += TOC_RECORD.size
+            name = self.data[offset:offset + nameLength]
+            offset += nameLength
+            if entryOffset + packedSize > len(self.data):
+                raise ContainerException('Entry ' + name + ' exceeds the container')
+            self.entries[name] = (entryOffset, packedSize, size, codec)
+
+    def names(self):
+        return sorted(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def size(self, name):
+        """Uncompressed size of the entry"""
+        return self._entry(name)[2]
+
+    def read(self, name):
+        return ''.join(self.read_chunks(name))
+
+    def read_chunks(self, name):
+        """Yields the uncompressed content of the entry in blocks"""
+        (offset, packedSize, size, codec) = self._entry(name)
+        if codec not in CODEC_NAMES or (codec == LZMA and lzma is None):
+            raise ContainerException('Unsupported codec for entry ' + name)
+        decompressor = _decompressor(codec)
+        length = 0
+        for start in xrange(offset, offset + packedSize, CHUNK_SIZE):
+            chunk = self.data[start:min(start + CHUNK_SIZE, offset + packedSize)]
+            chunk = self._decompress(name, decompressor.decompress, chunk)
+            length += len(chunk)
+            yield chunk
+        if hasattr(decompressor, 'flush'):
+            chunk = self._decompress(name, decompressor.flush)
+            length += len(chunk)
+            yield chunk
+        if length != size:
+            raise ContainerException('Corrupt entry ' + name)
+
+    def _decompress(self, name, func, *args):
+        try:
+            return func(*args)
+        except DECOMPRESS_ERRORS:
+            raise ContainerException('Corrupt entry ' + name)
+
+    def peek(self, name, size):
+        """Returns the first <size> bytes of the entry, only the beginning is decompressed"""
+        data = ''
+        for chunk in self.read_chunks(name):
+            data += chunk
+            if len(data) >= size:
+                break
+        return data[0:size]
+
+    def extract(self, name, dstPath):
+        """Writes the uncompressed content of the entry to <dstPath>"""
+        with open(dstPath, 'wb') as f:
+            for chunk in self.read_chunks(name):
+                f.write(chunk)
+
+    def _entry(self, name):
+        if name not in self.entries:
+            raise ContainerException('Missing entry ' + name)
+        return self.entries[name]
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def choose_codec(filePath):
+    """Picks the codec for a file from the byte entropy of up to NUM_SAMPLES blocks,
+        taken at fixed positions so the choice is the same on every run."""
+    size = os.path.getsize(filePath)
+    if size < SMALL_ENTRY_SIZE:
+        return ZLIB
+    with open(filePath, 'rb') as f:
+        if size <= SAMPLE_SIZE * NUM_SAMPLES:
+            sample = f.read()
+        else:
+            samples = []
+            for i in xrange(NUM_SAMPLES):
+                f.seek((size - SAMPLE_SIZE) * i / max(NUM_SAMPLES - 1, 1))
+                samples.append(f.read(SAMPLE_SIZE))
+            sample = ''.join(samples)
+    if entropy(sample) >= STORE_ENTROPY:
+        return STORE
+    return BZ2
+
+def entropy(data):
+    """Shannon entropy of <data> in bits per byte"""
+    if len(data) == 0:
+        return 0.0
+    result = 0.0
+    for count in (data.count(chr(i)) for i in xrange(256)):
+        if count > 0:
+            p = count / float(len(data))
+            result -= p * math.log(p, 2)
+    return result
+
+def pack_file((filePath, packedPath, codec)):
+    """Compresses the file at <filePath> to <packedPath>, for ContainerWriter.add_packed.
+        If compression doesn't make it smaller, the file is stored instead.
+        Returns the (size, codec) tuple."""
+    if codec is None:
+        codec = choose_codec(filePath)
+    with open(filePath, 'rb') as f:
+        with open(packedPath, 'wb') as packedFile:
+            size = _compress(iter(lambda: f.read(CHUNK_SIZE), ''), packedFile, codec)
+    if codec != STORE and os.path.getsize(packedPath) >= size:
+        shutil.copyfile(filePath, packedPath)
+        codec = STORE
+    return (size, codec)
+
+def _compress(chunks, outFile, codec):
+    """Writes the compressed <chunks> to <outFile>, returns the uncompressed size"""
+    compressor = _compressor(codec)
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        outFile.write(compressor.compress(chunk) if compressor is not None else chunk)
+    if compressor is not None:
+        outFile.write(compressor.flush())
+    return size
+
+def _compressor(codec):
+    if codec == ZLIB:
+        return zlib.compressobj(9)
+    if codec == BZ2:
+        return bz2.BZ2Compressor(9)
+    if codec == LZMA:
+        if lzma is None:
+            raise ContainerException('lzma is not available')
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=lzma.CHECK_NONE, preset=9)
+    return None
+
+def _decompressor(codec):
+    if codec == ZLIB:
+        return zlib.decompressobj()
+    if codec == BZ2:
+        return bz2.BZ2Decompressor()
+    if codec == LZMA:
+        return lzma.LZMADecompressor()
+    return _Store()
+
+class _Store:
+    def decompress(self, data):
+        return data
+
+DECOMPRESS_ERRORS = (zlib.error, IOError, EOFError, ValueError) + ((lzma.LZMAError,) if lzma is not None else ())
+
+
+class ContainerException(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+        self.message = msg
+
+    def msg(self):
+        return self.message
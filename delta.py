@@ -0,0 +1,501 @@
+import array
+import bz2
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+    In-process implementation of bsdiff/bspatch.
+
+    Patches use the BSDIFF40 format, so they are interchangeable with the ones
+    produced and consumed by the bsdiff.exe/bspatch.exe command-line tools:
+    a 32 byte header followed by the bzip2-compressed control, diff and extra blocks.
+
+    With NumPy, the matches for a whole window of the new file are looked up at once in the
+    positions of the old file sorted by their first bytes, and only matches longer than that
+    are searched in the suffix array of the old file, which is built with NumPy as well.
+    Without NumPy, every match is searched in the suffix array, and a (much slower) pure Python
+    fallback builds it.
+"""
+
+MAGIC = 'BSDIFF40'
+HEADER_SIZE = 32
+# positions the scan for a match goes one by one before it skips ahead, see _Matcher.skip
+SKIP_AFTER = 32
+
+def diff_file(oldFile, newFile, patchFile):
+    """Creates a binary diff between <oldFile> and <newFile> and stores it in <patchFile>"""
+    with open(oldFile, 'rb') as f:
+        oldData = f.read()
+    with open(newFile, 'rb') as f:
+        newData = f.read()
+    with open(patchFile, 'wb') as f:
+        f.write(diff(oldData, newData))
+
+def patch_file(oldFile, newFile, patchFile):
+    """Applies the <patchFile> to the <oldFile> and writes the result to <newFile>"""
+    with open(oldFile, 'rb') as f:
+        oldData = f.read()
+    with open(patchFile, 'rb') as f:
+        patchData = f.read()
+    with open(newFile, 'wb') as f:
+        f.write(patch(oldData, patchData))
+
+
+def diff(oldData, newData):
+    """Returns a BSDIFF40 patch that converts <oldData> to <newData>"""
+    old = bytearray(oldData)
+    new = bytearray(newData)
+    oldSize = len(old)
+    newSize = len(new)
+    if numpy is not None and oldSize > 0:
+        matcher = _Matcher(oldData, newData)
+    else:
+        matcher = _SuffixArrayMatcher(oldData, newData)
+
+    ctrl = []
+    diffBlocks = []
+    extraBlocks = []
+
+    scan = 0
+    length = 0
+    pos = 0
+    lastScan = 0
+    lastPos = 0
+    lastOffset = 0
+    while scan < newSize:
+        oldScore = 0
+        scan += length
+        scsc = scan
+        stretchStart = scan
+        while scan < newSize:
+            if scan - stretchStart >= SKIP_AFTER:
+                (scan, scsc, oldScore) = matcher.skip(scan, scsc, oldScore, lastOffset)
+            (length, pos) = matcher.search(scan)
+            if scsc < scan + length:
+                oldScore += matcher.count_equal(scsc, scan + length, lastOffset)
+                scsc = scan + length
+            if (length == oldScore and length != 0) or length > oldScore + 8:
+                break
+            if scan + lastOffset < oldSize and old[scan + lastOffset] == new[scan]:
+                oldScore -= 1
+            scan += 1
+
+        if length != oldScore or scan == newSize:
+            # extend the previous match forwards
+            lenf = matcher.extend(lastPos, lastScan, min(scan - lastScan, oldSize - lastPos), 1)
+            # extend the current match backwards
+            lenb = 0
+            if scan < newSize:
+                lenb = matcher.extend(pos - 1, scan - 1, min(scan - lastScan, pos), -1)
+
+            # resolve overlap between the two extensions
+            if lastScan + lenf > scan - lenb:
+                overlap = (lastScan + lenf) - (scan - lenb)
+                lens = matcher.split_overlap(lastPos + lenf - overlap, lastScan + lenf - overlap, pos - lenb, scan - lenb, overlap)
+                lenf += lens - overlap
+                lenb -= lens
+
+            diffBlocks.append(_subtract(new, lastScan, old, lastPos, lenf))
+            extraLength = (scan - lenb) - (lastScan + lenf)
+            extraBlocks.append(newData[lastScan + lenf:lastScan + lenf + extraLength])
+            ctrl.append((lenf, extraLength, (pos - lenb) - (lastPos + lenf)))
+
+            lastScan = scan - lenb
+            lastPos = pos - lenb
+            lastOffset = pos - scan
+
+    ctrlBlock = bz2.compress(''.join(_pack_offset(x) + _pack_offset(y) + _pack_offset(z) for (x, y, z) in ctrl))
+    diffBlock = bz2.compress(''.join(diffBlocks))
+    extraBlock = bz2.compress(''.join(extraBlocks))
+    header = MAGIC + _pack_offset(len(ctrlBlock)) + _pack_offset(len(diffBlock)) + _pack_offset(newSize)
+    return header + ctrlBlock + diffBlock + extraBlock
+
+
+class _SuffixArrayMatcher:
+    """Match search and extension of bsdiff, one byte at a time"""
+    def __init__(self, oldData, newData):
+        self.oldData = oldData
+        self.newData = newData
+        self.old = bytearray(oldData)
+        self.new = bytearray(newData)
+        self._sa = None
+
+    def suffix_array(self):
+        # only built once a match needs it, dissimilar files may not need it at all (see _Matcher)
+        if self._sa is None:
+            self._sa = suffix_array(self.oldData)
+        return self._sa
+
+    def search(self, scan):
+        """Returns the (length, position) of the longest match of new[scan:] in the old data"""
+        return _search(self.suffix_array(), self.oldData, self.newData, scan)
+
+    def skip(self, scan, scsc, oldScore, offset):
+        """Advances the scan of diff over positions where it wouldn't stop, returns the new
+            (scan, scsc, oldScore). Without NumPy, it stays where it is."""
+        return (scan, scsc, oldScore)
+
+    def count_equal(self, start, end, offset):
+        """Number of positions i in [start, end) with old[i + offset] == new[i]"""
+        count = 0
+        for i in xrange(max(start, -offset), min(end, len(self.old) - offset)):
+            if self.old[i + offset] == self.new[i]:
+                count += 1
+        return count
+
+    def extend(self, oldPos, newPos, limit, step):
+        """Length of the best extension of a match from old[oldPos] and new[newPos], going
+            <step> bytes at a time, that has more matching than differing bytes"""
+        s = 0
+        best = 0
+        length = 0
+        for i in xrange(limit):
+            if self.old[oldPos + i * step] == self.new[newPos + i * step]:
+                s += 1
+            if s * 2 - (i + 1) > best * 2 - length:
+                best = s
+                length = i + 1
+        return length
+
+    def split_overlap(self, oldPosF, newPosF, oldPosB, newPosB, overlap):
+        """Length of the overlapping part that goes to the forward extension"""
+        s = 0
+        ss = 0
+        lens = 0
+        for i in xrange(overlap):
+            if self.new[newPosF + i] == self.old[oldPosF + i]:
+                s += 1
+            if self.new[newPosB + i] == self.old[oldPosB + i]:
+                s -= 1
+            if s > ss:
+                ss = s
+                lens = i + 1
+        return lens
+
+class _Matcher(_SuffixArrayMatcher):
+    """Match search and extension with NumPy.
+        The positions of the old data are sorted by their first KEY_SIZE bytes, and the matches
+        for a window of the new data are looked up all at once with a binary search in them.
+        Matches that are shorter than KEY_SIZE are complete that way, only longer ones are
+        searched in the suffix array. Extensions compare whole ranges and take the best prefix."""
+    KEY_SIZE = 8
+    WINDOW = 64 * 1024
+    MIN_VECTOR_LENGTH = 64
+
+    def __init__(self, oldData, newData):
+        _SuffixArrayMatcher.__init__(self, oldData, newData)
+        self.oldArray = numpy.frombuffer(oldData, dtype=numpy.uint8)
+        self.newArray = numpy.frombuffer(newData, dtype=numpy.uint8)
+        keys = self._keys(self.oldArray, 0, len(oldData))
+        self.order = numpy.argsort(keys, kind='mergesort')
+        self.sortedKeys = keys[self.order]
+        self.windowStart = 0
+        self.windowEnd = 0
+
+    def suffix_array(self):
+        # start the prefix doubling from the sorted keys: the rank of a key, and the length for
+        # the suffixes at the end, which are shorter than their zero padded keys
+        if self._sa is None:
+            n = len(self.oldData)
+            groups = numpy.empty(n, dtype=numpy.int64)
+            groups[0] = 0
+            groups[1:] = self.sortedKeys[1:] != self.sortedKeys[:-1]
+            rank = numpy.empty(n, dtype=numpy.int64)
+            rank[self.order] = numpy.cumsum(groups) * (self.KEY_SIZE + 1)
+            rank += numpy.minimum(n - numpy.arange(n), self.KEY_SIZE)
+            self._sa = suffix_array(self.oldData, rank, self.KEY_SIZE)
+        return self._sa
+
+    def search(self, scan):
+        if not self.windowStart <= scan < self.windowEnd:
+            self._search_window(scan, min(scan + self.WINDOW, len(self.newData)))
+        i = scan - self.windowStart
+        if self.exact[i]:
+            return _SuffixArrayMatcher.search(self, scan)
+        return (self.lengths[i], self.positions[i])
+
+    def _search_window(self, start, end):
+        keys = self._keys(self.newArray, start, end)
+        index = numpy.searchsorted(self.sortedKeys, keys)
+        left = numpy.clip(index - 1, 0, len(self.sortedKeys) - 1)
+        right = numpy.clip(index, 0, len(self.sortedKeys) - 1)
+        leftLength = self._common_prefix(keys, self.sortedKeys[left])
+        rightLength = self._common_prefix(keys, self.sortedKeys[right])
+        useRight = rightLength >= leftLength
+        keyLength = numpy.where(useRight, rightLength, leftLength)
+        positions = self.order[numpy.where(useRight, right, left)]
+        # the keys are padded with zeros, which must not count as a match
+        limit = numpy.minimum(len(self.newData) - numpy.arange(start, end), len(self.oldData) - positions)
+        self.lengthArray = numpy.minimum(keyLength, limit)
+        self.exactArray = (keyLength == self.KEY_SIZE) & (limit > self.KEY_SIZE)
+        self.lengths = self.lengthArray.tolist()
+        self.positions = positions.tolist()
+        self.exact = self.exactArray.tolist()
+        self.windowStart = start
+        self.windowEnd = end
+
+    def skip(self, scan, scsc, oldScore, offset):
+        # oldScore at each position is the number of bytes that match at the offset of the
+        # previous match between the position and the end of the furthest match so far
+        # the last position is left to diff, which needs its match
+        last = len(self.newData) - 1
+        block = 64
+        while scan < last:
+            if not self.windowStart <= scan < self.windowEnd:
+                self._search_window(scan, min(scan + self.WINDOW, len(self.newData)))
+            start = scan - self.windowStart
+            end = min(start + block, self.windowEnd - self.windowStart, last - self.windowStart)
+            lengths = self.lengthArray[start:end]
+            positions = numpy.arange(scan, scan + end - start)
+            reach = numpy.maximum.accumulate(numpy.maximum(positions + lengths, scsc))
+            base = min(scan, scsc)
+            counts = numpy.zeros(max(int(reach[-1]), positions[-1] + 1) - base + 1, dtype=numpy.int64)
+            counts[1:] = numpy.cumsum(self._equal(base, base + len(counts) - 1, offset))
+            scores = oldScore + (counts[reach - base] - counts[scsc - base]) - (counts[positions - base] - counts[scan - base])
+            stop = self.exactArray[start:end] | ((lengths == scores) & (lengths != 0)) | (lengths > scores + 8)
+            n = int(numpy.argmax(stop)) if stop.any() else len(stop)
+            if n > 0:
+                oldScore = int(oldScore + (counts[reach[n - 1] - base] - counts[scsc - base]) - (counts[scan + n - base] - counts[scan - base]))
+                scsc = int(reach[n - 1])
+                scan += n
+            if n < len(stop):
+                break
+            block = min(block * 2, self.WINDOW)
+        return (scan, scsc, oldScore)
+
+    def _equal(self, start, end, offset):
+        """old[i + offset] == new[i] for the positions i in [start, end), False outside the old data"""
+        equal = numpy.zeros(end - start, dtype=numpy.bool_)
+        first = max(start, -offset)
+        last = min(end, len(self.oldData) - offset)
+        if first < last:
+            equal[first - start:last - start] = self.oldArray[first + offset:last + offset] == self.newArray[first:last]
+        return equal
+
+    def _keys(self, data, start, end):
+        """The next KEY_SIZE bytes from each position in [start, end) as big endian integers"""
+        padded = numpy.zeros(end - start + self.KEY_SIZE - 1, dtype=numpy.uint64)
+        chunk = data[start:end + self.KEY_SIZE - 1]
+        padded[:len(chunk)] = chunk
+        keys = numpy.zeros(end - start, dtype=numpy.uint64)
+        for i in xrange(self.KEY_SIZE):
+            keys = (keys << numpy.uint64(8)) | padded[i:i + end - start]
+        return keys
+
+    def _common_prefix(self, a, b):
+        """Number of equal leading bytes of the keys"""
+        diff = a ^ b
+        length = numpy.zeros(len(a), dtype=numpy.int64)
+        for i in xrange(self.KEY_SIZE):
+            length += (diff >> numpy.uint64(8 * (self.KEY_SIZE - 1 - i))) == 0
+        return length
+
+    def count_equal(self, start, end, offset):
+        start = max(start, -offset)
+        end = min(end, len(self.oldData) - offset)
+        if end - start < self.MIN_VECTOR_LENGTH:
+            return _SuffixArrayMatcher.count_equal(self, start, end, offset)
+        return int(numpy.count_nonzero(self.oldArray[start + offset:end + offset] == self.newArray[start:end]))
+
+    def extend(self, oldPos, newPos, limit, step):
+        if limit < self.MIN_VECTOR_LENGTH:
+            return _SuffixArrayMatcher.extend(self, oldPos, newPos, limit, step)
+        if step > 0:
+            equal = self.oldArray[oldPos:oldPos + limit] == self.newArray[newPos:newPos + limit]
+        else:
+            equal = (self.oldArray[oldPos - limit + 1:oldPos + 1] == self.newArray[newPos - limit + 1:newPos + 1])[::-1]
+        scores = 2 * numpy.cumsum(equal) - numpy.arange(1, limit + 1)
+        best = int(numpy.argmax(scores))
+        return best + 1 if scores[best] > 0 else 0
+
+    def split_overlap(self, oldPosF, newPosF, oldPosB, newPosB, overlap):
+        if overlap < self.MIN_VECTOR_LENGTH:
+            return _SuffixArrayMatcher.split_overlap(self, oldPosF, newPosF, oldPosB, newPosB, overlap)
+        forward = self.newArray[newPosF:newPosF + overlap] == self.oldArray[oldPosF:oldPosF + overlap]
+        backward = self.newArray[newPosB:newPosB + overlap] == self.oldArray[oldPosB:oldPosB + overlap]
+        scores = numpy.cumsum(forward.astype(numpy.int64) - backward)
+        best = int(numpy.argmax(scores))
+        return best + 1 if scores[best] > 0 else 0
+
+
+def patch(oldData, patchData):
+    """Applies the BSDIFF40 patch <patchData> to <oldData> and returns the result"""
+    if len(patchData) < HEADER_SIZE or patchData[0:8] != MAGIC:
+        raise DeltaException('Corrupt patch: invalid header')
+    ctrlLength = _unpack_offset(patchData, 8)
+    diffLength = _unpack_offset(patchData, 16)
+    newSize = _unpack_offset(patchData, 24)
+    if ctrlLength < 0 or diffLength < 0 or newSize < 0:
+        raise DeltaException('Corrupt patch: negative block size')
+
+    ctrlStart = HEADER_SIZE
+    diffStart = ctrlStart + ctrlLength
+    extraStart = diffStart + diffLength
+    ctrlBlock = bz2.decompress(patchData[ctrlStart:diffStart])
+    diffBlock = bz2.decompress(patchData[diffStart:extraStart])
+    extraBlock = bz2.decompress(patchData[extraStart:])
+
+    oldSize = len(oldData)
+    result = []
+    newPos = 0
+    oldPos = 0
+    diffPos = 0
+    extraPos = 0
+    for ctrlPos in xrange(0, len(ctrlBlock), 24):
+        x = _unpack_offset(ctrlBlock, ctrlPos)
+        y = _unpack_offset(ctrlBlock, ctrlPos + 8)
+        z = _unpack_offset(ctrlBlock, ctrlPos + 16)
+        if newPos + x > newSize or newPos + x + y > newSize:
+            raise DeltaException('Corrupt patch: control block exceeds output size')
+
+        # bytes outside of the old file are treated as zero
+        start = min(max(oldPos, 0), oldSize)
+        end = min(max(oldPos + x, 0), oldSize)
+        oldChunk = '\0' * (start - oldPos) + oldData[start:end]
+        oldChunk += '\0' * (x - len(oldChunk))
+        result.append(_add(diffBlock[diffPos:diffPos + x], oldChunk))
+        diffPos += x
+        newPos += x
+        oldPos += x
+
+        result.append(extraBlock[extraPos:extraPos + y])
+        extraPos += y
+        newPos += y
+        oldPos += z
+
+    if newPos != newSize:
+        raise DeltaException('Corrupt patch: output size mismatch')
+    return ''.join(result)
+
+
+def suffix_array(data, rank=None, k=1):
+    """Returns the sorted suffix positions of <data>, starting with the empty suffix.
+        With NumPy, <rank> can give the order of the suffixes by their first <k> bytes."""
+    if numpy is not None and len(data) > 0:
+        sa = numpy.concatenate(([len(data)], _suffix_array_numpy(data, rank, k))).astype(numpy.int32)
+        return array.array('i', sa.tostring())
+    return [len(data)] + _suffix_array_python(data)
+
+def _suffix_array_numpy(data, rank=None, k=1):
+    """Prefix doubling: sort by the rank pairs (rank[i], rank[i+k]) until all ranks are unique.
+        Both ranks are combined into one key, which sorts faster than the pair."""
+    n = len(data)
+    if rank is None:
+        rank = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int64)
+    while True:
+        secondKey = numpy.full(n, -1, dtype=numpy.int64)
+        if k < n:
+            secondKey[:n - k] = rank[k:]
+        key = rank * (int(rank.max()) + 2) + secondKey + 1
+        sa = numpy.argsort(key)
+        sortedKey = key[sa]
+        boundaries = numpy.empty(n, dtype=numpy.int64)
+        boundaries[0] = 0
+        boundaries[1:] = sortedKey[1:] != sortedKey[:-1]
+        rank = numpy.empty(n, dtype=numpy.int64)
+        rank[sa] = numpy.cumsum(boundaries)
+        if rank[sa[-1]] == n - 1 or k >= n:
+            return sa
+        k *= 2
+
+def _suffix_array_python(data):
+    n = len(data)
+    rank = list(bytearray(data))
+    sa = range(n)
+    k = 1
+    while n > 0:
+        key = lambda i: (rank[i], rank[i + k] if i + k < n else -1)
+        sa.sort(key=key)
+        newRank = [0] * n
+        for j in xrange(1, n):
+            newRank[sa[j]] = newRank[sa[j - 1]] + (1 if key(sa[j]) != key(sa[j - 1]) else 0)
+        rank = newRank
+        if rank[sa[-1]] == n - 1 or k >= n:
+            break
+        k *= 2
+    return sa
+
+
+def _search(sa, old, new, scan):
+    """Binary search in the suffix array for the longest match of new[scan:] in <old>.
+        Returns a (length, position) tuple."""
+    st = 0
+    en = len(sa) - 1
+    while en - st >= 2:
+        x = st + (en - st) / 2
+        length = _matchlen(old, sa[x], new, scan)
+        if length == min(len(old) - sa[x], len(new) - scan) or old[sa[x] + length] > new[scan + length]:
+            en = x
+        else:
+            st = x
+    x = _matchlen(old, sa[st], new, scan)
+    y = _matchlen(old, sa[en], new, scan)
+    if x > y:
+        return (x, sa[st])
+    return (y, sa[en])
+
+def _matchlen(old, oldPos, new, newPos):
+    """Length of the common prefix of old[oldPos:] and new[newPos:]"""
+    limit = min(len(old) - oldPos, len(new) - newPos)
+    n = 0
+    step = 32
+    while n < limit:
+        k = min(step, limit - n)
+        if old[oldPos + n:oldPos + n + k] != new[newPos + n:newPos + n + k]:
+            lo = 0
+            hi = k
+            while hi - lo > 1:
+                mid = (lo + hi) / 2
+                if old[oldPos + n:oldPos + n + mid] == new[newPos + n:newPos + n + mid]:
+                    lo = mid
+                else:
+                    hi = mid
+            if old[oldPos + n + lo] == new[newPos + n + lo]:
+                lo += 1
+            return n + lo
+        n += k
+        step *= 2
+    return limit
+
+
+def _subtract(new, newPos, old, oldPos, length):
+    if numpy is not None:
+        a = numpy.frombuffer(new, dtype=numpy.uint8, count=length, offset=newPos)
+        b = numpy.frombuffer(old, dtype=numpy.uint8, count=length, offset=oldPos)
+        return (a - b).tostring()
+    return str(bytearray((new[newPos + i] - old[oldPos + i]) & 0xff for i in xrange(length)))
+
+def _add(diffChunk, oldChunk):
+    if numpy is not None:
+        a = numpy.frombuffer(diffChunk, dtype=numpy.uint8)
+        b = numpy.frombuffer(oldChunk, dtype=numpy.uint8)
+        return (a + b).tostring()
+    d = bytearray(diffChunk)
+    o = bytearray(oldChunk)
+    return str(bytearray((d[i] + o[i]) & 0xff for i in xrange(len(d))))
+
+
+def _pack_offset(value):
+    """bsdiff stores 64 bit integers as little endian sign-magnitude"""
+    if value < 0:
+        return struct.pack('<Q', -value | (1 << 63))
+    return struct.pack('<Q', value)
+
+def _unpack_offset(data, pos):
+    value = struct.unpack_from('<Q', data, pos)[0]
+    if value & (1 << 63):
+        return -(value & ~(1 << 63))
+    return value
+
+
+class DeltaException(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+        self.message = msg
+
+    def msg(self):
+        return self.message
@@ -1,10 +1,14 @@
 import os
 import sys
 import shutil
-from ftplib import FTP
+import time
+from ftplib import error_perm
 
 import bindirpatch
-from utils import find_application_version, zip_directory, Progress
+import blockmap
+import instrument
+import utils
+from utils import find_application_version, Progress
 
 OLD_DIR = None
 NEW_DIR = None
@@ -14,17 +18,26 @@ UPDATE_SERVER_URL = None
 UPDATE_SERVER_USER = None
 UPDATE_SERVER_PWD = None
 UPDATE_SERVER_PATH = None
+CONTENT_STORE = None
+# also create patches that skip from these many versions back to the new version (needs CONTENT_STORE)
+SKIP_DISTANCES = []
+# compressed files of the latest release, default: <outDir>/blobs
+BLOB_CACHE = None
 
 def deploy():
     increment_version()
     clear_temp_dir()
     create_patch()
-    zip_full_game()
-    upload()
+    pack_full_game()
+    with instrument.phase('blockmap'):
+        create_block_map()
+    update_release_manifest()
+    with instrument.phase('upload'):
+        upload()
 
 def increment_version():
     print 'incrementing version'
-    oldVersion = find_application_version(OLD_DIR)
+    oldVersion = find_old_version()
     versionFileName = os.path.join(NEW_DIR, 'VERSION')
     with open(versionFileName, 'w') as versionFile:
         versionFile.write(str(oldVersion+1))
@@ -36,55 +49,207 @@ def clear_temp_dir():
         shutil.rmtree(TEMP_DIR + '_deleteme')
     os.makedirs(TEMP_DIR)
 
+def find_old_version():
+    """The old version can also be restored from its manifest and the content store,
+        so the old directory doesn't need to be kept around when a content store is used."""
+    if os.path.exists(OLD_DIR) or CONTENT_STORE is None:
+        return find_application_version(OLD_DIR)
+    manifestDir = os.path.join(OUT_DIR, 'manifests')
+    if not os.path.isdir(manifestDir):
+        return None
+    versions = [int(x[1:]) for x in os.listdir(manifestDir) if x[1:].isdigit()]
+    return max(versions) if len(versions) > 0 else None
+
+def manifest_path(version):
+    return os.path.join(OUT_DIR, 'manifests', 'v' + str(version))
+
+def patch_name(oldVersion, newVersion):
+    """Patches to the next version are named v<new>, patches that skip versions v<old>-<new>."""
+    if oldVersion == newVersion - 1:
+        return 'v' + str(newVersion)
+    return 'v' + str(oldVersion) + '-' + str(newVersion)
+
 def create_patch():
     print 'creating patch'
-    tmpFile = bindirpatch.create_patch(OLD_DIR, NEW_DIR, TEMP_DIR)
+    oldVersion = find_old_version()
     newVersion = find_application_version(NEW_DIR)
-    outFile = os.path.join(OUT_DIR, 'patches', 'v' + str(newVersion))
+    make_patch(OLD_DIR, manifest_path(oldVersion), manifest_path(newVersion), patch_name(oldVersion, newVersion))
+
+    for distance in SKIP_DISTANCES:
+        skipVersion = newVersion - distance
+        if distance <= 1 or skipVersion < 1:
+            continue
+        if CONTENT_STORE is None or not os.path.isfile(manifest_path(skipVersion)):
+            print 'WARNING: Version ' + str(skipVersion) + ' is not in the content store, no skip patch created'
+            continue
+        print 'creating skip patch from version ' + str(skipVersion)
+        make_patch(None, manifest_path(skipVersion), None, patch_name(skipVersion, newVersion))
+
+def make_patch(oldDir, oldManifestPath, newManifestPath, name):
+    tmpFile = bindirpatch.create_patch(oldDir, NEW_DIR, TEMP_DIR, oldManifestPath, newManifestPath, CONTENT_STORE)
+    outFile = os.path.join(OUT_DIR, 'patches', name)
+    if os.path.exists(outFile):
+        os.remove(outFile)
     os.rename(tmpFile, outFile)
+    shutil.rmtree(os.path.join(TEMP_DIR, 'patch_temp'))
 
-def zip_full_game():
-    print 'zipping game'
-    binDir = os.path.join(TEMP_DIR, 'bin')
-    if os.path.exists(binDir):
-        print 'WARNING: Replacing directory ', binDir
-        shutil.rmtree(binDir)
-    outFile = os.path.join(OUT_DIR, 'latest.7z')
+def find_new_patches():
+    """Names of the patches created for the new version."""
+    newVersion = find_application_version(NEW_DIR)
+    names = [patch_name(newVersion - distance, newVersion) for distance in [1] + SKIP_DISTANCES]
+    return [name for name in names if os.path.isfile(os.path.join(OUT_DIR, 'patches', name))]
+
+def pack_full_game():
+    """The full game is a patch from an empty directory, so it's compressed the same way.
+        The compressed files are cached in the blob cache, so only changed files are compressed
+        and the hashes of unchanged files are taken from the manifest of the new version."""
+    print 'packing game'
+    outFile = os.path.join(OUT_DIR, 'latest')
     if os.path.exists(outFile):
         print 'WARNING: Replacing archive ', outFile
         os.remove(outFile)
-    os.rename(NEW_DIR, binDir)
-    zip_directory(binDir, outFile)
-    os.rename(binDir, NEW_DIR)
+    blobCache = BLOB_CACHE if BLOB_CACHE is not None else os.path.join(OUT_DIR, 'blobs')
+    newManifest = manifest_path(find_application_version(NEW_DIR))
+    tmpFile = bindirpatch.create_archive(NEW_DIR, TEMP_DIR, newManifest, blobCache)
+    os.rename(tmpFile, outFile)
+    shutil.rmtree(os.path.join(TEMP_DIR, 'patch_temp'))
+
+def create_block_map():
+    """Writes the block map of the new version (see the blockmap module), for clients that rebuild
+        it from their local files. The block checksums of files that didn't change are taken from
+        the previous block map."""
+    print 'creating block map'
+    newVersion = find_application_version(NEW_DIR)
+    manifest = bindirpatch.read_manifest(manifest_path(newVersion))
+    mapPath = os.path.join(OUT_DIR, utils.BLOCK_MAP)
+    known = {}
+    if os.path.isfile(mapPath):
+        known = dict( (entry.digest, entry) for entry in blockmap.read_block_map(mapPath)[1] )
+
+    entries = []
+    changed = []
+    for (relPath, ((size, mtime), (fileChecksum, digest))) in sorted(manifest.items()):
+        if digest in known:
+            entries.append(known[digest]._replace(path=relPath))
+        else:
+            changed.append(len(entries))
+            entries.append(blockmap.BlockMapEntry(relPath, size, digest, blockmap.block_size(size), ''))
+    work = [(os.path.join(NEW_DIR, entries[i].path), entries[i].blockSize) for i in changed]
+    pool = bindirpatch.create_pool(bindirpatch.NUM_WORKERS)
+    try:
+        results = bindirpatch.parallel_map(pool, blockmap.file_blocks, work)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    for (i, blocks) in zip(changed, results):
+        entries[i] = entries[i]._replace(blocks=blocks)
+    blockmap.write_block_map(mapPath, newVersion, entries)
+
+def update_release_manifest():
+    """Lists the full game and all patches with their sizes and digests, so that clients can
+        decide what to download from this single file. Only new patches are hashed."""
+    print 'updating release manifest'
+    manifestPath = os.path.join(OUT_DIR, utils.RELEASE_MANIFEST)
+    known = {}
+    if os.path.isfile(manifestPath):
+        releases = utils.read_release_manifest(manifestPath)
+        if releases is not None:
+            known = dict( (name, (size, digest)) for (name, size, digest) in releases[1] )
+    newPatches = set(find_new_patches())
+
+    patches = []
+    patchDir = os.path.join(OUT_DIR, 'patches')
+    for name in sorted(os.listdir(patchDir)):
+        size = os.path.getsize(os.path.join(patchDir, name))
+        if name in known and name not in newPatches and known[name][0] == size:
+            digest = known[name][1]
+        else:
+            digest = bindirpatch.hash_file(os.path.join(patchDir, name))[1]
+        patches.append( (name, size, digest) )
+    fullGamePath = os.path.join(OUT_DIR, 'latest')
+    latest = (find_application_version(NEW_DIR), os.path.getsize(fullGamePath), bindirpatch.hash_file(fullGamePath)[1])
+    utils.write_release_manifest(manifestPath, latest, patches)
 
 def upload():
     print 'Connecting to Server...'
     print UPDATE_SERVER_USER + ' ' + UPDATE_SERVER_PWD + ' ' + UPDATE_SERVER_PATH
-    ftp = FTP(UPDATE_SERVER_URL)
+    ftp = utils.open_ftp(UPDATE_SERVER_URL)
     ftp.login(UPDATE_SERVER_USER, UPDATE_SERVER_PWD)
     ftp.cwd(UPDATE_SERVER_PATH)
 
     print 'Uploading full game...'
-    fullGamePath = os.path.join(OUT_DIR, 'latest.7z')
+    fullGamePath = os.path.join(OUT_DIR, 'latest')
     progress = Progress(os.stat(fullGamePath).st_size, 50)
     progress.print_header(10)
-    with open(fullGamePath, 'rb') as f:
-        ftp.storbinary('STOR latest', f, blocksize=8192, callback = lambda x: progress.add_progress(8192))
+    store_file(ftp, fullGamePath, 'latest', progress)
 
-    print 'Uploading patch...'
-    version = find_application_version(NEW_DIR)
-    patchPath = os.path.join(OUT_DIR, 'patches', 'v' + str(version))
-    progress = Progress(os.stat(patchPath).st_size, 50)
-    progress.print_header(10)
-    with open(patchPath, 'rb') as f:
-        ftp.cwd('patches')
-        ftp.storbinary('STOR v' + str(version), f, blocksize=8192, callback = lambda x: progress.add_progress(8192))
+    ftp.cwd('patches')
+    for patch in find_new_patches():
+        print 'Uploading patch ' + patch + '...'
+        patchPath = os.path.join(OUT_DIR, 'patches', patch)
+        progress = Progress(os.stat(patchPath).st_size, 50)
+        progress.print_header(10)
+        store_file(ftp, patchPath, patch, progress)
+
+    ftp.cwd('..')
+    upload_file_store(ftp)
+    print 'Uploading manifest...'
+    newVersion = find_application_version(NEW_DIR)
+    change_dir(ftp, utils.VERSION_MANIFESTS)
+    store_file(ftp, manifest_path(newVersion), 'v' + str(newVersion))
+    ftp.cwd('..')
+    print 'Uploading block map...'
+    store_file(ftp, os.path.join(OUT_DIR, utils.BLOCK_MAP), utils.BLOCK_MAP)
+
+    # the release manifest goes last, so clients never see files that aren't there yet
+    print 'Uploading release manifest...'
+    store_file(ftp, os.path.join(OUT_DIR, utils.RELEASE_MANIFEST), utils.RELEASE_MANIFEST)
 
     ftp.quit()
     print 'Upload Complete'
 
+def store_file(ftp, localPath, remoteFileName, progress=None):
+    """Uploads the file at <localPath> to the current directory of the server"""
+    start = time.time()
+    callback = (lambda x: progress.add_progress(len(x))) if progress is not None else None
+    with open(localPath, 'rb') as f:
+        ftp.storbinary('STOR ' + remoteFileName, f, blocksize=8192, callback=callback)
+    size = os.path.getsize(localPath)
+    instrument.record_file('upload', remoteFileName, time.time() - start, size, size)
+
+def upload_file_store(ftp):
+    """Uploads the files of the new version that aren't on the server yet to its file store,
+        named by their SHA-1 digest. Clients download the parts of them they don't have."""
+    change_dir(ftp, utils.FILE_STORE)
+    try:
+        existing = set(ftp.nlst())
+    except error_perm:
+        # some servers report an empty directory as an error
+        existing = set()
+    files = {}
+    for entry in blockmap.read_block_map(os.path.join(OUT_DIR, utils.BLOCK_MAP))[1]:
+        if entry.digest not in existing:
+            files.setdefault(entry.digest, entry)
+    if len(files) > 0:
+        print 'Uploading ' + str(len(files)) + ' changed files...'
+        progress = Progress(max(sum(entry.size for entry in files.values()), 1), 50)
+        progress.print_header(10)
+        for digest in sorted(files):
+            store_file(ftp, os.path.join(NEW_DIR, files[digest].path), digest, progress)
+    ftp.cwd('..')
+
+def change_dir(ftp, name):
+    """Changes to the directory <name> on the server, it's created if it doesn't exist"""
+    try:
+        ftp.cwd(name)
+    except error_perm:
+        ftp.mkd(name)
+        ftp.cwd(name)
+
 
 def parseExtraArgs(i):
+    global CONTENT_STORE, SKIP_DISTANCES, BLOB_CACHE
     if len(sys.argv) <= i:
         return
     arg = sys.argv[i]
@@ -92,6 +257,30 @@ def parseExtraArgs(i):
     if arg.startswith('-j'):
         bindirpatch.NUM_WORKERS = int(arg[2:])
 
+    elif arg.startswith('--backend='):
+        utils.set_diff_backend(arg.split('=', 1)[1])
+
+    elif arg.startswith('--store='):
+        CONTENT_STORE = arg.split('=', 1)[1]
+
+    elif arg.startswith('--skip='):
+        SKIP_DISTANCES = [int(x) for x in arg.split('=', 1)[1].split(',')]
+
+    elif arg.startswith('--blobs='):
+        BLOB_CACHE = arg.split('=', 1)[1]
+
+    elif arg.startswith('--chunk-delta='):
+        utils.set_chunk_delta(int(arg.split('=', 1)[1]) * 1024 * 1024, utils.CHUNK_DELTA_MEMORY)
+
+    elif arg.startswith('--delta-memory='):
+        utils.set_chunk_delta(utils.CHUNK_DELTA_SIZE, int(arg.split('=', 1)[1]) * 1024 * 1024)
+
+    elif arg.startswith('--report='):
+        instrument.set_report(arg.split('=', 1)[1])
+
+    elif arg.startswith('--profile='):
+        instrument.set_profile(arg.split('=', 1)[1])
+
     else:
         print 'Invalid argument: ' + sys.argv[i]
         usage()
@@ -105,13 +294,22 @@ def usage():
     print '  newDir: build to be deployed'
     print '  tempDir: Where to put temp files. This directory will be deleted!'
     print '  outDir: where to put the result files'
-    print '  url: url of the ftp server'
+    print '  url: url of the ftp server, optionally with port (host:port)'
     print '  user: username for uploading on the server'
     print '  password: password for ftp user'
     print '  remotePath: path on the ftp server to store the files'
     print ''
     print 'Options:'
-    print ' -j#     Jobs, sets number of worker processes for patch building, ex: -j4'
+    print ' -j#     Jobs, sets number of worker processes for patch building and compression, ex: -j4'
+    print ' --backend=exe|python  Diff engine: bsdiff.exe or the built-in one'
+    print ' --store=dir  Keep the files of every release in this content store,'
+    print '              then oldDir is optional'
+    print ' --skip=5,20  Also create patches from 5 and 20 versions back (needs --store)'
+    print ' --blobs=dir  Cache of the compressed files of the full game, default: outDir/blobs'
+    print ' --chunk-delta=MB  Files of at least this size get a chunk delta instead of bsdiff, default: 256 (--delta-memory / 100 with --backend=python)'
+    print ' --delta-memory=MB  Memory per worker for chunk deltas, default: 64'
+    print ' --report=file  Write the time and bytes of every phase and file to a JSON (or .csv) report'
+    print ' --profile=file  Write cProfile statistics of the main process to this file'
     sys.exit(0)
 
 if __name__ == '__main__':
@@ -129,4 +327,4 @@ if __name__ == '__main__':
     print 'Update server path: ' + UPDATE_SERVER_PATH
         
     parseExtraArgs(9)
-    deploy()
+    instrument.run(deploy)
@@ -0,0 +1,142 @@
+import time
+import json
+import csv
+import threading
+import contextlib
+import cProfile
+
+"""
+    Timing and byte counts per phase and per file, written to a JSON or CSV report.
+
+    Phases (walk, compare, diff, index, compress, blockmap, upload, download, check, stage, apply,
+    validate, commit) are timed in the main process with the phase context manager. The work on single files records
+    its time, the bytes read and written and, for deltas and compression, the ratio of the output
+    to the new file with record_file. Nothing is recorded unless a report is requested.
+
+    Records of worker processes stay in the worker until the job is done, so functions that run
+    in a pool are wrapped with traced, which returns the records along with the result, and the
+    results are unwrapped with collect (see bindirpatch.parallel_map).
+
+    The report has one entry per phase, with the total time, number of files and bytes of the
+    phase, followed by the file records. With a profile path, the main process also runs under
+    cProfile and the statistics are written to that file (worker processes aren't profiled).
+"""
+
+ENABLED = False
+REPORT_PATH = None
+PROFILE_PATH = None
+FIELDS = ['kind', 'phase', 'path', 'seconds', 'files', 'bytesRead', 'bytesWritten', 'ratio']
+
+_records = []
+_lock = threading.Lock()
+
+def set_report(path):
+    global ENABLED, REPORT_PATH
+    REPORT_PATH = path
+    ENABLED = path is not None
+
+def set_profile(path):
+    global PROFILE_PATH
+    PROFILE_PATH = path
+
+def record_file(phase, path, seconds, bytesRead, bytesWritten, ratio=None):
+    if ENABLED:
+        with _lock:
+            _records.append( ('file', phase, path, seconds, bytesRead, bytesWritten, ratio) )
+
+@contextlib.contextmanager
+def phase(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        if ENABLED:
+            with _lock:
+                _records.append( ('phase', name, None, time.time() - start, 0, 0, None) )
+
+def ratio(output, size):
+    return round(output / float(size), 4) if size > 0 else None
+
+
+class _Traced:
+    """Calls <func> and returns its result together with the records it produced"""
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, args):
+        with _lock:
+            start = len(_records)
+        result = self.func(args)
+        with _lock:
+            records = _records[start:]
+            del _records[start:]
+        return (result, records)
+
+def traced(func):
+    """Wraps a function that runs in a worker process, see collect"""
+    return _Traced(func) if ENABLED else func
+
+def collect(results):
+    """Takes the records out of the results of a traced function and returns the plain results"""
+    if not ENABLED:
+        return results
+    plainResults = []
+    for (result, records) in results:
+        with _lock:
+            _records.extend(records)
+        plainResults.append(result)
+    return plainResults
+
+
+def run(func, *args):
+    """Calls func(*args), under the profiler if a profile path is set, and writes the report if
+        one was requested. Returns the result of <func>."""
+    profiler = cProfile.Profile() if PROFILE_PATH is not None else None
+    try:
+        if profiler is not None:
+            return profiler.runcall(func, *args)
+        return func(*args)
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(PROFILE_PATH)
+        if REPORT_PATH is not None:
+            write_report(REPORT_PATH)
+
+def report():
+    """Returns the phase summaries and the file records as lists of dicts, see FIELDS"""
+    phases = []
+    byName = {}
+    with _lock:
+        records = list(_records)
+    for (kind, phaseName, path, seconds, bytesRead, bytesWritten, fileRatio) in records:
+        if kind == 'phase' and phaseName not in byName:
+            byName[phaseName] = dict(kind='phase', phase=phaseName, path=None, seconds=0.0, files=0,
+                                     bytesRead=0, bytesWritten=0, ratio=None)
+            phases.append(byName[phaseName])
+        if kind == 'phase':
+            byName[phaseName]['seconds'] += seconds
+    files = []
+    for (kind, phaseName, path, seconds, bytesRead, bytesWritten, fileRatio) in records:
+        if kind != 'file':
+            continue
+        files.append(dict(kind='file', phase=phaseName, path=path, seconds=seconds, files=1,
+                          bytesRead=bytesRead, bytesWritten=bytesWritten, ratio=fileRatio))
+        if phaseName in byName:
+            byName[phaseName]['files'] += 1
+            byName[phaseName]['bytesRead'] += bytesRead
+            byName[phaseName]['bytesWritten'] += bytesWritten
+    return (phases, files)
+
+def write_report(path):
+    """Writes the report as CSV if <path> ends with .csv, otherwise as JSON"""
+    (phases, files) = report()
+    if path.lower().endswith('.csv'):
+        with open(path, 'wb') as f:
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            for row in phases + files:
+                writer.writerow(row)
+    else:
+        with open(path, 'w') as f:
+            json.dump({'phases': phases, 'files': files}, f, indent=1, sort_keys=True)
+    print 'Report written to ' + path
@@ -0,0 +1,219 @@
+import os
+import sys
+import time
+import socket
+import threading
+import SocketServer
+
+"""
+    Minimal FTP server that serves a local directory, for testing deploy and autoupdate
+    without a real update server. It runs in a background thread of the calling process:
+
+        server = LocalFTPServer(rootDir)
+        server.start()
+        ...                                # connect to '127.0.0.1:<server.port>'
+        server.stop()
+
+    or from the command line: localftp.py <rootDir> [port]
+
+    Supports the commands used by deploy and autoupdate (passive mode only): USER, PASS, PWD,
+    CWD, CDUP, MKD, TYPE, SIZE, MDTM, NLST, RETR, STOR, REST, PASV, NOOP and QUIT. Any user name and
+    password are accepted. With <delay>, every reply is delayed by that many seconds to
+    simulate a high-latency link.
+"""
+
+class LocalFTPServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, rootDir, port=0, delay=0):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', port), FTPHandler)
+        self.rootDir = os.path.abspath(rootDir)
+        self.port = self.server_address[1]
+        self.delay = delay
+        self.thread = None
+        self.commandCount = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class FTPHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        self.cwd = '/'
+        self.restOffset = 0
+        self.dataSocket = None
+        self.reply('220 localftp ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            line = line.rstrip('\r\n')
+            (command, _, arg) = line.partition(' ')
+            command = command.upper()
+            with self.server.lock:
+                self.server.commandCount += 1
+            if self.server.delay > 0:
+                time.sleep(self.server.delay)
+            handler = getattr(self, 'ftp_' + command, None)
+            if handler is None:
+                self.reply('502 Command not implemented')
+                continue
+            try:
+                if handler(arg) == False:
+                    break
+            except (IOError, OSError):
+                self.reply('550 ' + str(sys.exc_info()[1]))
+        self.close_data()
+
+    def reply(self, text):
+        self.wfile.write(text + '\r\n')
+        self.wfile.flush()
+
+    def local_path(self, path):
+        """Maps a path on the server to the local file system, without leaving the root directory"""
+        path = os.path.normpath(os.path.join(self.cwd, path)).replace('\\', '/')
+        if not path.startswith('/'):
+            path = '/' + path
+        return (path, os.path.join(self.server.rootDir, *[x for x in path.split('/') if x not in ('', '..')]))
+
+    def ftp_USER(self, arg):
+        self.reply('331 Password required')
+
+    def ftp_PASS(self, arg):
+        self.reply('230 Logged in')
+
+    def ftp_PWD(self, arg):
+        self.reply('257 "' + self.cwd + '"')
+
+    def ftp_CWD(self, arg):
+        (path, localPath) = self.local_path(arg)
+        if not os.path.isdir(localPath):
+            self.reply('550 No such directory')
+            return
+        self.cwd = path
+        self.reply('250 OK')
+
+    def ftp_MKD(self, arg):
+        (path, localPath) = self.local_path(arg)
+        os.mkdir(localPath)
+        self.reply('257 "' + path + '" created')
+
+    def ftp_CDUP(self, arg):
+        self.ftp_CWD('..')
+
+    def ftp_TYPE(self, arg):
+        self.reply('200 Type set')
+
+    def ftp_NOOP(self, arg):
+        self.reply('200 OK')
+
+    def ftp_SIZE(self, arg):
+        localPath = self.local_path(arg)[1]
+        if not os.path.isfile(localPath):
+            self.reply('550 No such file')
+            return
+        self.reply('213 ' + str(os.path.getsize(localPath)))
+
+    def ftp_MDTM(self, arg):
+        localPath = self.local_path(arg)[1]
+        if not os.path.isfile(localPath):
+            self.reply('550 No such file')
+            return
+        self.reply('213 ' + time.strftime('%Y%m%d%H%M%S', time.gmtime(os.path.getmtime(localPath))))
+
+    def ftp_REST(self, arg):
+        self.restOffset = int(arg)
+        self.reply('350 Restarting at ' + arg)
+
+    def ftp_PASV(self, arg):
+        self.close_data()
+        self.dataSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.dataSocket.bind(('127.0.0.1', 0))
+        self.dataSocket.listen(1)
+        port = self.dataSocket.getsockname()[1]
+        self.reply('227 Entering Passive Mode (127,0,0,1,' + str(port >> 8) + ',' + str(port & 0xff) + ')')
+
+    def ftp_NLST(self, arg):
+        localPath = self.local_path(arg)[1]
+        if not os.path.isdir(localPath):
+            self.reply('550 No such directory')
+            return
+        self.send_data(''.join(name + '\r\n' for name in sorted(os.listdir(localPath))))
+
+    def ftp_RETR(self, arg):
+        localPath = self.local_path(arg)[1]
+        if not os.path.isfile(localPath):
+            self.reply('550 No such file')
+            self.restOffset = 0
+            return
+        with open(localPath, 'rb') as f:
+            f.seek(self.restOffset)
+            self.restOffset = 0
+            self.send_data(iter(lambda: f.read(65536), ''))
+
+    def ftp_STOR(self, arg):
+        localPath = self.local_path(arg)[1]
+        connection = self.open_data()
+        if connection is None:
+            return
+        with open(localPath, 'wb') as f:
+            while True:
+                block = connection.recv(65536)
+                if not block:
+                    break
+                f.write(block)
+        connection.close()
+        self.reply('226 Transfer complete')
+
+    def ftp_QUIT(self, arg):
+        self.reply('221 Bye')
+        return False
+
+    def open_data(self):
+        if self.dataSocket is None:
+            self.reply('425 Use PASV first')
+            return None
+        self.reply('150 Opening data connection')
+        (connection, address) = self.dataSocket.accept()
+        self.close_data()
+        return connection
+
+    def send_data(self, data):
+        connection = self.open_data()
+        if connection is None:
+            return
+        try:
+            for block in ([data] if isinstance(data, str) else data):
+                connection.sendall(block)
+        except socket.error:
+            connection.close()
+            self.reply('426 Transfer aborted')
+            return
+        connection.close()
+        self.reply('226 Transfer complete')
+
+    def close_data(self):
+        if self.dataSocket is not None:
+            self.dataSocket.close()
+            self.dataSocket = None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print 'Usage: localftp.py <rootDir> [port]'
+        sys.exit(1)
+    server = LocalFTPServer(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 2121)
+    print 'Serving ' + server.rootDir + ' at 127.0.0.1:' + str(server.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
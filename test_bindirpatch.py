@@ -0,0 +1,117 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import utils
+import bindirpatch
+
+"""
+    Tests of creating and applying patches between directory trees.
+    Run with: python -m unittest test_bindirpatch
+"""
+
+class PatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.backend = utils.DIFF_BACKEND
+        utils.set_diff_backend('python')
+        bindirpatch.NUM_WORKERS = 1
+
+    def tearDown(self):
+        utils.set_diff_backend(self.backend)
+        bindirpatch.NUM_WORKERS = 1
+        shutil.rmtree(self.tempDir)
+
+    def random_bytes(self, size, seed):
+        rng = random.Random(seed)
+        return ''.join(chr(rng.getrandbits(8)) for i in xrange(size))
+
+    def write_tree(self, name, files):
+        """Creates the directory <name> with the files given as {relPath: content}"""
+        root = os.path.join(self.tempDir, name)
+        os.makedirs(root)
+        for (relPath, content) in files.items():
+            path = os.path.join(root, relPath)
+            bindirpatch.mkdir_if_not_exists(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(content)
+        return root
+
+    def read_tree(self, root):
+        files = {}
+        for (dirPath, dirNames, fileNames) in os.walk(root):
+            for name in fileNames:
+                with open(os.path.join(dirPath, name), 'rb') as f:
+                    files[os.path.relpath(os.path.join(dirPath, name), root)] = f.read()
+        return files
+
+    def create_patch(self, oldFiles, newFiles):
+        """Returns the path to a patch from <oldFiles> to <newFiles> and its index"""
+        oldDir = self.write_tree('old', oldFiles)
+        newDir = self.write_tree('new', newFiles)
+        patchFilePath = bindirpatch.create_patch(oldDir, newDir, self.tempDir)
+        try:
+            index = bindirpatch.read_index(bindirpatch.open_container(patchFilePath))
+        finally:
+            bindirpatch.close_containers()
+        return (patchFilePath, dict( (entry.path, entry) for entry in index ))
+
+    def apply_patch(self, patchFilePath, oldFiles, numWorkers=1):
+        targetDir = self.write_tree('target%d' % numWorkers, oldFiles)
+        self.assertTrue(bindirpatch.apply_patch(patchFilePath, targetDir, numWorkers))
+        return self.read_tree(targetDir)
+
+    def apply_patches(self, patchFilePaths, oldFiles, numWorkers=1):
+        targetDir = self.write_tree('chain%d' % numWorkers, oldFiles)
+        self.assertTrue(bindirpatch.apply_patches(patchFilePaths, targetDir, numWorkers))
+        return self.read_tree(targetDir)
+
+    def check_replacement(self, oldFiles, newFiles):
+        """Checks that the patch from <oldFiles> to <newFiles> applies with one and several workers"""
+        (patchFilePath, index) = self.create_patch(oldFiles, newFiles)
+        for numWorkers in (1, 4):
+            self.assertEqual(self.apply_patch(patchFilePath, oldFiles, numWorkers), newFiles)
+            self.assertEqual(self.apply_patches([patchFilePath], oldFiles, numWorkers), newFiles)
+
+    def test_shifted_copy_is_diffed_against_old_file(self):
+        level = self.random_bytes(200000, 1)
+        oldFiles = {'level12.pak': level}
+        newFiles = {'level12.pak': level, 'level12_v2.pak': level[:100] + self.random_bytes(10, 2) + level[100:]}
+        (patchFilePath, index) = self.create_patch(oldFiles, newFiles)
+        self.assertEqual(index['level12_v2.pak'].operation, 'C')
+        self.assertEqual(index['level12_v2.pak'].source, 'level12.pak')
+        self.assertEqual(self.apply_patch(patchFilePath, oldFiles), newFiles)
+
+    def test_renamed_and_shifted_file_is_found(self):
+        data = self.random_bytes(100000, 3)
+        oldFiles = {'a/textures.bin': data}
+        newFiles = {'b/sounds.dat': data[:5000] + data[5003:50000] + 'inserted' + data[50000:]}
+        (patchFilePath, index) = self.create_patch(oldFiles, newFiles)
+        self.assertEqual(index['b/sounds.dat'].operation, 'C')
+        self.assertEqual(self.apply_patch(patchFilePath, oldFiles), newFiles)
+
+    def test_small_changed_copy_is_found(self):
+        data = self.random_bytes(6000, 11)
+        oldFiles = {'small.dat': data}
+        newFiles = {'small.dat': data, 'renamed.x': data[:100] + 'Q' + data[101:]}
+        (patchFilePath, index) = self.create_patch(oldFiles, newFiles)
+        self.assertEqual(index['renamed.x'].operation, 'C')
+        self.assertEqual(self.apply_patch(patchFilePath, oldFiles), newFiles)
+
+    def test_directory_replaced_by_file(self):
+        data = self.random_bytes(10000, 5)
+        oldFiles = {'keep': 'keep', 'x/a': 'a' * 100, 'x/b/c': 'c' * 100, 'x/moved': data}
+        newFiles = {'keep': 'keep', 'x': 'x' * 100, 'y': data}
+        self.check_replacement(oldFiles, newFiles)
+
+    def test_file_replaced_by_directory(self):
+        data = self.random_bytes(10000, 6)
+        oldFiles = {'keep': 'keep', 'x': data, 'y': 'y' * 100}
+        newFiles = {'keep': 'keep', 'x/a': 'a' * 100, 'x/b/c': 'c' * 100, 'x/x': data, 'y/y': 'y' * 100}
+        self.check_replacement(oldFiles, newFiles)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,269 @@
+import os
+import struct
+import shutil
+import zlib
+import zipfile
+
+import utils
+from delta import DeltaException
+
+"""
+    Transforms that make files easier to diff.
+
+    A small change to a file inside a zip archive (or a jar, or a pak that is a zip) changes
+    the whole compressed stream of that member, so a binary diff of the archives is almost as
+    big as the archive. Instead, both archives are expanded first: the compressed members are
+    replaced by their uncompressed content. The delta is created between the expanded files,
+    and the recipe to compress the members of the new archive again is stored with it.
+
+    The recipe has the zlib parameters (level, memLevel and strategy) that reproduce each
+    member exactly. They are found by compressing the member with the common parameters
+    until one of them gives the same bytes. Members that can't be reproduced stay compressed.
+    A transformed delta is only used if rebuilding the new archive gives exactly the same file,
+    so the client must use the same zlib implementation as the build machine (the one of Python).
+
+    A transformed delta starts with MAGIC, followed by the length of the transform name and of
+    the recipe, the name, the recipe and the delta between the expanded files (bsdiff or chunk
+    delta, see utils.bsdiff). More transforms can be added to TRANSFORMS; each one is a
+    class with detect, expand_old, expand_new and rebuild methods like ZipTransform.
+"""
+
+MAGIC = 'BDPXFORM'
+HEADER = struct.Struct('<8sBI')
+IO_BLOCK_SIZE = 1024 * 1024
+# smaller archives aren't worth the effort
+MIN_ARCHIVE_SIZE = 64 * 1024
+
+def diff_file(oldFile, newFile, patchFile):
+    """Creates a transformed delta if one of the TRANSFORMS recognizes both files.
+        Returns False if none of them does, or if the new file can't be rebuilt exactly."""
+    if min(os.path.getsize(oldFile), os.path.getsize(newFile)) < MIN_ARCHIVE_SIZE:
+        return False
+    for transform in TRANSFORMS:
+        if not transform.detect(oldFile, newFile):
+            continue
+        tmpPaths = [patchFile + suffix for suffix in ('.old_tmp', '.new_tmp', '.check_tmp', '.inner_tmp')]
+        (oldExpanded, newExpanded, checkPath, innerPath) = tmpPaths
+        try:
+            try:
+                transform.expand_old(oldFile, oldExpanded)
+                recipe = transform.expand_new(newFile, newExpanded)
+                if recipe is None:
+                    continue
+                transform.rebuild(newExpanded, recipe, checkPath)
+            except (EnvironmentError, zlib.error, zipfile.BadZipfile, DeltaException):
+                continue
+            if not _equal_files(newFile, checkPath):
+                continue
+            utils.bsdiff(oldExpanded, newExpanded, innerPath)
+            with open(patchFile, 'wb') as outFile:
+                outFile.write(HEADER.pack(MAGIC, len(transform.name), len(recipe)))
+                outFile.write(transform.name)
+                outFile.write(recipe)
+                with open(innerPath, 'rb') as innerFile:
+                    shutil.copyfileobj(innerFile, outFile, IO_BLOCK_SIZE)
+            return True
+        finally:
+            for path in tmpPaths:
+                if os.path.exists(path):
+                    os.remove(path)
+    return False
+
+def patch_file(oldFile, newFile, patchFile):
+    """Applies the transformed delta <patchFile> to <oldFile> and writes the result to <newFile>"""
+    tmpPaths = [newFile + suffix for suffix in ('.old_tmp', '.new_tmp', '.inner_tmp')]
+    (oldExpanded, newExpanded, innerPath) = tmpPaths
+    try:
+        with open(patchFile, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size or not header.startswith(MAGIC):
+                raise DeltaException('Corrupt patch: invalid header')
+            (magic, nameLength, recipeLength) = HEADER.unpack(header)
+            name = f.read(nameLength)
+            recipe = f.read(recipeLength)
+            transform = find_transform(name)
+            with open(innerPath, 'wb') as innerFile:
+                shutil.copyfileobj(f, innerFile, IO_BLOCK_SIZE)
+        transform.expand_old(oldFile, oldExpanded)
+        utils.bspatch(oldExpanded, newExpanded, innerPath)
+        transform.rebuild(newExpanded, recipe, newFile)
+    except (zlib.error, zipfile.BadZipfile, struct.error) as ex:
+        raise DeltaException('Cannot rebuild ' + newFile + ': ' + str(ex))
+    finally:
+        for path in tmpPaths:
+            if os.path.exists(path):
+                os.remove(path)
+
+def find_transform(name):
+    for transform in TRANSFORMS:
+        if transform.name == name:
+            return transform
+    raise DeltaException('Unknown transform ' + name)
+
+def _equal_files(pathA, pathB):
+    with open(pathA, 'rb') as fileA:
+        with open(pathB, 'rb') as fileB:
+            while True:
+                blockA = fileA.read(IO_BLOCK_SIZE)
+                if blockA != fileB.read(IO_BLOCK_SIZE):
+                    return False
+                if not blockA:
+                    return True
+
+
+class ZipTransform:
+    """Expands the deflated members of zip archives. The expanded file is the archive with the
+        compressed data of the members replaced by the uncompressed data, everything else
+        (headers, stored members, the central directory) is left as it is."""
+    name = 'zip'
+    MEMBER = struct.Struct('<QQQBBB')
+    LOCAL_HEADER = struct.Struct('<4s22xHH')
+    # zlib parameters to try, the most common ones first
+    LEVELS = [6, 9, 1, 5, 4, 3, 2, 7, 8]
+    MEM_LEVELS = [8, 9]
+    STRATEGIES = [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED]
+
+    def __init__(self):
+        # the parameters of the last archive, it's likely that the next one used them too
+        self.lastParameters = (6, 8, zlib.Z_DEFAULT_STRATEGY)
+
+    def detect(self, oldFile, newFile):
+        return zipfile.is_zipfile(oldFile) and zipfile.is_zipfile(newFile)
+
+    def expand_old(self, path, outPath):
+        self._expand(path, outPath, self.members(path))
+
+    def expand_new(self, path, outPath):
+        """Expands the members that can be compressed again exactly, returns the recipe
+            or None if there are none."""
+        recipe = []
+        with open(path, 'rb') as f:
+            for (offset, compressedSize, size) in self.members(path):
+                parameters = self.find_parameters(f, offset, compressedSize, size)
+                if parameters is not None:
+                    recipe.append( (offset, compressedSize, size) + parameters )
+        if len(recipe) == 0:
+            return None
+        self._expand(path, outPath, [member[0:3] for member in recipe])
+        return ''.join(self.MEMBER.pack(*member) for member in recipe)
+
+    def members(self, path):
+        """Returns the (offset, compressedSize, size) tuples of the deflated members, sorted by offset.
+            Encrypted members and members that overlap others are left out."""
+        result = []
+        with zipfile.ZipFile(path) as archive:
+            infos = sorted(archive.infolist(), key=lambda info: info.header_offset)
+        with open(path, 'rb') as f:
+            end = 0
+            for info in infos:
+                if info.compress_type != zipfile.ZIP_DEFLATED or info.flag_bits & 0x1 or info.header_offset < end:
+                    continue
+                f.seek(info.header_offset)
+                header = f.read(self.LOCAL_HEADER.size)
+                if len(header) < self.LOCAL_HEADER.size:
+                    continue
+                (signature, nameLength, extraLength) = self.LOCAL_HEADER.unpack(header)
+                if signature != zipfile.stringFileHeader:
+                    continue
+                offset = info.header_offset + self.LOCAL_HEADER.size + nameLength + extraLength
+                result.append( (offset, info.compress_size, info.file_size) )
+                end = offset + info.compress_size
+        return result
+
+    def find_parameters(self, f, offset, compressedSize, size):
+        """Returns the (level, memLevel, strategy) tuple that gives exactly the compressed data
+            of the member, or None. The output is compared block by block, so wrong parameters
+            are usually ruled out after the first block."""
+        candidates = [self.lastParameters] + [(level, memLevel, strategy) for strategy in self.STRATEGIES
+                                              for memLevel in self.MEM_LEVELS for level in self.LEVELS]
+        for parameters in candidates:
+            if self._reproduces(f, offset, compressedSize, size, parameters):
+                self.lastParameters = parameters
+                return parameters
+        return None
+
+    def _reproduces(self, f, offset, compressedSize, size, (level, memLevel, strategy)):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, memLevel, strategy)
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        readPos = offset
+        compared = 0
+        pending = ''
+        uncompressed = 0
+        while True:
+            f.seek(readPos)
+            block = f.read(min(IO_BLOCK_SIZE, offset + compressedSize - readPos))
+            readPos += len(block)
+            data = decompressor.decompress(block) if block else decompressor.flush()
+            uncompressed += len(data)
+            pending += compressor.compress(data) if block else compressor.compress(data) + compressor.flush()
+            # compare what was compressed so far with the original
+            if len(pending) > 0:
+                f.seek(offset + compared)
+                if f.read(len(pending)) != pending:
+                    return False
+                compared += len(pending)
+                pending = ''
+            if not block:
+                return compared == compressedSize and uncompressed == size
+
+    def _expand(self, path, outPath, members):
+        with open(path, 'rb') as f:
+            with open(outPath, 'wb') as outFile:
+                position = 0
+                for (offset, compressedSize, size) in members:
+                    _copy(f, outFile, offset - position)
+                    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    written = 0
+                    remaining = compressedSize
+                    while remaining > 0:
+                        block = f.read(min(remaining, IO_BLOCK_SIZE))
+                        if not block:
+                            raise DeltaException('Truncated member in ' + path)
+                        remaining -= len(block)
+                        data = decompressor.decompress(block)
+                        written += len(data)
+                        outFile.write(data)
+                    data = decompressor.flush()
+                    written += len(data)
+                    outFile.write(data)
+                    if written != size:
+                        raise DeltaException('Corrupt member in ' + path)
+                    position = offset + compressedSize
+                shutil.copyfileobj(f, outFile, IO_BLOCK_SIZE)
+
+    def rebuild(self, expandedPath, recipe, outPath):
+        """Compresses the members of the expanded file again, as described by the recipe."""
+        with open(expandedPath, 'rb') as f:
+            with open(outPath, 'wb') as outFile:
+                position = 0
+                for i in xrange(0, len(recipe), self.MEMBER.size):
+                    (offset, compressedSize, size, level, memLevel, strategy) = self.MEMBER.unpack_from(recipe, i)
+                    _copy(f, outFile, offset - position)
+                    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, memLevel, strategy)
+                    written = 0
+                    remaining = size
+                    while remaining > 0:
+                        block = f.read(min(remaining, IO_BLOCK_SIZE))
+                        if not block:
+                            raise DeltaException('Truncated member in ' + expandedPath)
+                        remaining -= len(block)
+                        data = compressor.compress(block)
+                        written += len(data)
+                        outFile.write(data)
+                    data = compressor.flush()
+                    written += len(data)
+                    outFile.write(data)
+                    if written != compressedSize:
+                        raise DeltaException('Member at ' + str(offset) + ' compresses differently, zlib version mismatch?')
+                    position = offset + compressedSize
+                shutil.copyfileobj(f, outFile, IO_BLOCK_SIZE)
+
+def _copy(inFile, outFile, length):
+    while length > 0:
+        block = inFile.read(min(length, IO_BLOCK_SIZE))
+        if not block:
+            raise DeltaException('Unexpected end of file')
+        outFile.write(block)
+        length -= len(block)
+
+TRANSFORMS = [ZipTransform()]
@@ -1,27 +1,82 @@
 import os
 import subprocess
 import sys
+import threading
+from ftplib import FTP
+from distutils.spawn import find_executable
+
+import delta
+import chunkdelta
 
-SEVENZIP_EXE = os.path.join('.', '7zip', 'x64', '7za.exe')
 BSDIFF_EXE = os.path.join('.', 'bsdiff', 'bsdiff.exe')
 BSPATCH_EXE = os.path.join('.', 'bsdiff', 'bspatch.exe')
+# elsewhere, the bsdiff tools are used if they are installed
+if os.name != 'nt' and find_executable('bsdiff') and find_executable('bspatch'):
+    BSDIFF_EXE = find_executable('bsdiff')
+    BSPATCH_EXE = find_executable('bspatch')
+
+# 'exe' runs the external bsdiff/bspatch tools, 'python' uses the built-in delta module.
+# Both produce the same BSDIFF40 patch format. The external tools are much faster.
+DIFF_BACKENDS = ['exe', 'python']
+DIFF_BACKEND = 'exe' if os.name == 'nt' or os.path.exists(BSDIFF_EXE) else 'python'
+# files of at least this size get a chunk delta instead, which needs about CHUNK_DELTA_MEMORY
+# bytes no matter how big the files are (bsdiff needs many times the file size).
+# None for the default of the diff backend, see chunk_delta_size
+CHUNK_DELTA_SIZE = None
+CHUNK_DELTA_EXE_SIZE = 256 * 1024 * 1024
+CHUNK_DELTA_MEMORY = 64 * 1024 * 1024
+# the built-in engine needs about this many times the file size in memory
+PYTHON_DELTA_OVERHEAD = 100
+
+# published by deploy next to the full release, see write_release_manifest
+RELEASE_MANIFEST = 'releases'
+# block checksums of the latest release and the directory with its files by SHA-1 digest,
+# see the blockmap module
+BLOCK_MAP = 'blockmap'
+FILE_STORE = 'files'
+# manifests of the published versions (see bindirpatch.write_manifest), for checking installations
+VERSION_MANIFESTS = 'manifests'
 
 
 def bsdiff(oldFile, newFile, patchFile, silent=False):
-    """Creates a binary diff between <oldFile> and <newFile> and stores it in <patchFile>"""
-    subprocess.call([BSDIFF_EXE, oldFile, newFile, patchFile], stdout=get_stdout(silent))
+    """Creates a binary diff between <oldFile> and <newFile> and stores it in <patchFile>.
+        Big files are diffed with the chunkdelta module, see CHUNK_DELTA_SIZE."""
+    if max(os.path.getsize(oldFile), os.path.getsize(newFile)) >= chunk_delta_size():
+        chunkdelta.diff_file(oldFile, newFile, patchFile, CHUNK_DELTA_MEMORY)
+    elif DIFF_BACKEND == 'python':
+        delta.diff_file(oldFile, newFile, patchFile)
+    else:
+        subprocess.call([BSDIFF_EXE, oldFile, newFile, patchFile], stdout=get_stdout(silent))
 
 def bspatch(oldFile, newFile, patchFile, silent=False):
     """Applies the <patchFile> to the <oldFile> and writes the result to <newFile>"""
-    subprocess.call([BSPATCH_EXE, oldFile, newFile, patchFile], stdout=get_stdout(silent))
+    if chunkdelta.is_chunk_delta_file(patchFile):
+        chunkdelta.patch_file(oldFile, newFile, patchFile)
+    elif DIFF_BACKEND == 'python':
+        delta.patch_file(oldFile, newFile, patchFile)
+    else:
+        subprocess.call([BSPATCH_EXE, oldFile, newFile, patchFile], stdout=get_stdout(silent))
 
-def zip_directory(directory, zipPath, silent=False):
-    """Creates a 7z archive at <zipPath> containing the files from <directory>."""
-    subprocess.call([SEVENZIP_EXE, 'a', zipPath, directory, '-mx9', '-t7z'], stdout=get_stdout(silent))
-    
-def unzip_directory(zipPath, directory, silent=False):
-    """Extracts the 7z archive <zipPath> and puts the content into directory <directory>"""
-    subprocess.call([SEVENZIP_EXE, 'x', zipPath, '-o' + directory], stdout=get_stdout(silent))
+def set_diff_backend(backend):
+    global DIFF_BACKEND
+    if backend not in DIFF_BACKENDS:
+        raise ValueError('unknown diff backend ' + backend)
+    DIFF_BACKEND = backend
+
+def chunk_delta_size():
+    """The built-in engine needs about PYTHON_DELTA_OVERHEAD times the file size in memory, so it
+        hands over to chunk deltas at the size that fits in CHUNK_DELTA_MEMORY"""
+    if CHUNK_DELTA_SIZE is not None:
+        return CHUNK_DELTA_SIZE
+    if DIFF_BACKEND == 'python':
+        return CHUNK_DELTA_MEMORY / PYTHON_DELTA_OVERHEAD
+    return CHUNK_DELTA_EXE_SIZE
+
+def set_chunk_delta(size, memory):
+    """Files of at least <size> bytes get chunk deltas, using about <memory> bytes per worker"""
+    global CHUNK_DELTA_SIZE, CHUNK_DELTA_MEMORY
+    CHUNK_DELTA_SIZE = size
+    CHUNK_DELTA_MEMORY = memory
 
 def get_stdout(silent):
     if silent:
@@ -30,6 +85,45 @@ def get_stdout(silent):
         return None
 
 
+def write_release_manifest(path, latest, patches):
+    """Writes the list of files on the update server. <latest> is the (version, size, digest) tuple
+        of the full release, <patches> is a list of (name, size, digest) tuples.
+        The lines have the form 'latest <version> <size> <digest>' or 'patch <name> <size> <digest>'."""
+    with open(path + '.tmp', 'w') as manifestFile:
+        manifestFile.write('latest ' + ' '.join(str(x) for x in latest) + '\n')
+        for patch in sorted(patches):
+            manifestFile.write('patch ' + ' '.join(str(x) for x in patch) + '\n')
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(path + '.tmp', path)
+
+def read_release_manifest(path):
+    """Reads a release manifest written by write_release_manifest.
+        Returns the (latest, patches) tuple, or None if the file is invalid."""
+    latest = None
+    patches = []
+    with open(path, 'r') as manifestFile:
+        for line in manifestFile:
+            parts = line.split()
+            if len(parts) != 4 or not parts[2].isdigit():
+                continue
+            if parts[0] == 'latest' and parts[1].isdigit():
+                latest = (int(parts[1]), int(parts[2]), parts[3])
+            elif parts[0] == 'patch':
+                patches.append( (parts[1], int(parts[2]), parts[3]) )
+    if latest is None:
+        return None
+    return (latest, patches)
+
+
+def open_ftp(url):
+    """Connects to the ftp server at <url>, which may include a port (host:port)."""
+    (host, _, port) = url.partition(':')
+    ftp = FTP()
+    ftp.connect(host, int(port) if port else 21)
+    return ftp
+
+
 def find_application_version(projectDir):
     versionFilePath = os.path.join(projectDir, 'VERSION')
     try:
@@ -52,6 +146,8 @@ class Progress:
         self.current = 0
         self.dotsPrinted = 0
         self.dotsMax = dots
+        # progress may be added from several download threads
+        self.lock = threading.Lock()
 
     def print_header(self, numSegments=1):
         sys.stdout.write('[')
@@ -64,9 +160,12 @@ class Progress:
         sys.stdout.write(']\n ')
     
     def add_progress(self, progress):
-        self.set_progress(self.current + progress)
+        with self.lock:
+            self.set_progress(self.current + progress)
     
     def set_progress(self, progress):
+        # resumed or repeated downloads may add more than the total
+        progress = min(progress, self.total)
         if progress <= self.current:
             return
 